@@ -0,0 +1,108 @@
+from pathlib import Path
+import csv
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from ultralytics.engine.results import Results
+
+import ytsv
+from ytsv.benchmarks.synthetic import make_synthetic_video
+
+
+# small enough to decode in about a second, large enough for the section detector
+VIDEO_KWARGS = {'duration': 30, 'page_duration': 5, 'fps': 15, 'size': (640, 360)}
+
+
+class FakeYOLO:
+  """
+  Stand-in for the YOLO models with fixed boxes relative to the image size:
+  three systems per page, two staffs per crop
+  """
+  def __init__(self, kind:str):
+    self.kind = kind
+    self.calls = [] # batch sizes
+
+  def to(self, device):
+    return self
+
+  def __call__(self, batch, device='cpu', verbose=False, **kwargs):
+    self.calls.append(len(batch))
+
+    outputs = []
+    for i, image in enumerate(batch):
+      path = f'image{i}.jpg' if isinstance(image, np.ndarray) else str(image)
+      image = image if isinstance(image, np.ndarray) else cv2.imread(str(image))
+      h, w = image.shape[:2]
+
+      if self.kind == 'system':
+        boxes = [ [10, h * k // 4, w - 10, h * k // 4 + h // 6, 0.9 - 0.1 * k, 0] for k in range(3) ]
+      else:
+        boxes = [ [1, 2, w - 1, 12, 0.8, 0], [1, 20, w - 1, 31, 0.7, 0] ]
+
+      outputs.append( Results(image, path, {0: 'system'}, boxes=torch.tensor(boxes, dtype=torch.float32)) )
+
+    return outputs
+
+
+@pytest.fixture
+def fake_yolo_models(monkeypatch):
+  models = [FakeYOLO('system'), FakeYOLO('staff')]
+  monkeypatch.setattr(ytsv, 'load_yolo_models', lambda *args, **kwargs: models)
+  return models
+
+
+@pytest.fixture(scope='session')
+def synthetic_videos(tmp_path_factory) -> list[tuple[Path, dict]]:
+  """
+  Two synthetic score videos with a silent title page, four music pages and a silent blank page,
+  [(mp4 path, ground truth of make_synthetic_video), ...]
+  """
+  video_dir = tmp_path_factory.mktemp('videos')
+  return [
+    (video_dir / f'vid{seed}.mp4', make_synthetic_video(video_dir / f'vid{seed}.mp4', seed=seed, **VIDEO_KWARGS))
+    for seed in range(2)
+  ]
+
+
+def make_dataset(dataset_dir:Path, video_paths:list[Path], staff_count:str='1-0') -> Path:
+  """
+  Copy videos into <dataset_dir>/mp4 and write their metadata file
+
+  :return: path of the metadata file
+  """
+  (dataset_dir / 'mp4').mkdir(parents=True, exist_ok=True)
+
+  rows = []
+  for video_path in video_paths:
+    shutil.copy(video_path, dataset_dir / 'mp4' / video_path.name)
+    rows.append( [video_path.stem] + ['x'] * 13 + [staff_count] )
+
+  metadata_path = dataset_dir / 'metadata.csv'
+  with open(metadata_path, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow( ['yt_id'] + [f'field{i}' for i in range(13)] + ['staff_count'] )
+    writer.writerows(rows)
+
+  return metadata_path
+
+
+def run(dataset:tuple[Path, Path], **kwargs):
+  """
+  Process a (dataset dir, metadata path) pair from scratch with the stand-in models
+
+  :param kwargs: passed on to ytsv.process_videos_from_scratch
+  """
+  dataset_dir, metadata_path = dataset
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), **kwargs)
+
+
+@pytest.fixture
+def dataset(tmp_path, synthetic_videos) -> tuple[Path, Path]:
+  """
+  (dataset dir, metadata path) of a dataset with the synthetic videos
+  """
+  dataset_dir = tmp_path / 'dataset'
+  return dataset_dir, make_dataset(dataset_dir, [ video_path for video_path, _ in synthetic_videos ])
@@ -0,0 +1,141 @@
+import wave
+
+import numpy as np
+import pytest
+from pydub import AudioSegment, silence
+
+from ytsv.audio_utils import LoudnessEnvelope, AudioTrackReader, get_audio_track_paths
+from ytsv.slide_utils import extract_pages_and_audios
+
+
+def make_noisy_track(num_frames:int, frame_rate:int, channels:int=2, seed:int=0) -> np.ndarray:
+  """
+  Noise whose level changes every few milliseconds around the -50 dBFS silence threshold,
+  so that many windows are close to it
+  """
+  rng = np.random.default_rng(seed)
+
+  chunk_frames = frame_rate // 200
+  num_chunks = num_frames // chunk_frames + 1
+  levels = np.repeat(rng.uniform(40, 200, num_chunks), chunk_frames)[:num_frames]
+
+  samples = rng.normal(0, 1, (num_frames, channels)) * levels[:, None]
+  return np.clip(samples, -32768, 32767).astype(np.int16)
+
+
+def get_pydub_ratio(audio_segment:AudioSegment, start_ms:float, end_ms:float, num_sections:int=100, silence_thresh:float=-50):
+  """
+  Non-silent ratio as extract_pages_and_audios computed it with pydub
+  """
+  page_audio = audio_segment[start_ms:end_ms]
+  min_silence_len = len(page_audio) // num_sections
+  if min_silence_len < 1:
+    return None
+
+  segments = silence.detect_nonsilent(page_audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=min_silence_len)
+  return sum( end - start for start, end in segments ) / len(page_audio)
+
+
+def get_page_windows(duration:float, fps:float, rng:np.random.Generator, num_windows:int) -> list[tuple[float, float]]:
+  """
+  Windows between video frames, as find_nonsilent_page measures pages, not aligned to milliseconds
+  """
+  num_video_frames = int(duration * fps)
+  windows = []
+  for _ in range(num_windows):
+    start, end = sorted( rng.integers(0, num_video_frames + 10, 2).tolist() )
+    windows.append( (start / fps * 1000, end / fps * 1000 + 1) )
+  return windows
+
+
+@pytest.mark.parametrize('frame_rate, fps', [(44100, 29.97), (44100, 30), (44100, 25), (48000, 23.976)])
+def test_nonsilent_ratio_matches_pydub(frame_rate, fps):
+  duration = 12
+  samples = make_noisy_track(int(duration * frame_rate), frame_rate, seed=frame_rate)
+  audio_segment = AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=2)
+
+  windows = get_page_windows(duration, fps, np.random.default_rng(1), 200)
+
+  loudness = LoudnessEnvelope(frame_rate, 2)
+  loudness.watch_windows(windows)
+  # blocks that end inside a millisecond
+  for block_start in range(0, len(samples), 10007):
+    loudness.add_samples(samples[block_start:block_start + 10007])
+
+  assert len(loudness) == len(audio_segment)
+
+  for start_ms, end_ms in windows:
+    assert loudness.get_nonsilent_ratio(start_ms, end_ms) == get_pydub_ratio(audio_segment, start_ms, end_ms), (start_ms, end_ms)
+
+
+def test_rms_matches_pydub():
+  frame_rate = 44100
+  samples = make_noisy_track(frame_rate * 2, frame_rate, seed=3)
+  audio_segment = AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=2, channels=2)
+
+  rng = np.random.default_rng(2)
+  starts = rng.integers(0, len(samples), 500)
+  ends = starts + rng.integers(1, 2000, 500)
+
+  loudness = LoudnessEnvelope(frame_rate, 2)
+  loudness.watch_frames(np.concatenate([starts, np.minimum(ends, len(samples))]))
+  loudness.add_samples(samples)
+
+  expected = [ audio_segment._spawn(samples[start:end].tobytes()).rms for start, end in zip(starts, np.minimum(ends, len(samples))) ]
+  assert loudness.get_rms(starts, np.minimum(ends, len(samples))).tolist() == expected
+
+
+def test_envelope_keeps_millisecond_sums_only():
+  frame_rate = 44100
+  samples = make_noisy_track(frame_rate * 20, frame_rate, seed=4)
+
+  loudness = LoudnessEnvelope(frame_rate, 2)
+  loudness.watch_frames([1000, 5000])
+  loudness.add_samples(samples, block_frames=1<<14)
+
+  # per-frame energy is only kept for the open bucket and the last block
+  assert sum( len(energy) for _, energy in loudness._tail_blocks ) <= (1<<14) + 45
+  assert len(loudness._get_prefix()) == len(loudness) + 1
+
+  with pytest.raises(ValueError, match='was not watched'):
+    loudness.get_cumulative_energy([3001])
+
+  with pytest.raises(ValueError, match='before samples are added'):
+    loudness.watch_frames([3001])
+
+
+def read_wav_samples(wav_path) -> np.ndarray:
+  with wave.open(str(wav_path), 'rb') as wav:
+    return np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2').reshape(-1, wav.getnchannels())
+
+
+def test_single_audio_file_matches_the_page_files(synthetic_videos, tmp_path):
+  video_path, _ = synthetic_videos[0]
+
+  # same video id, one wav file per page or a single audio file
+  _, page_audio_paths = extract_pages_and_audios(video_path, tmp_path / 'pages' / 'vid0')
+  extract_pages_and_audios(video_path, tmp_path / 'single' / 'vid0', single_audio_file=True)
+
+  reader = AudioTrackReader( get_audio_track_paths(tmp_path / 'single' / 'vid0' / 'audio' / 'original', 'vid0')[0] )
+  assert len(reader) == len(page_audio_paths) == 4
+
+  for i, page_audio_path in enumerate(page_audio_paths):
+    assert reader.get_segment_name(i) == page_audio_path.name
+
+    # a view of the memory-mapped track, the padding of the last page past its end is silence
+    samples = reader[i]
+    assert np.shares_memory(samples, reader.samples)
+
+    page_samples = read_wav_samples(page_audio_path)
+    assert len(samples) > 0
+    assert np.array_equal(page_samples[:len(samples)], samples)
+    assert not page_samples[len(samples):].any()
+
+  # the exported segments are the files of the per-page layout
+  export_dir = tmp_path / 'export'
+  export_dir.mkdir()
+  exported_paths = reader.export_segments(export_dir)
+
+  assert [ path.name for path in exported_paths ] == [ path.name for path in page_audio_paths ]
+  for exported_path, page_audio_path in zip(exported_paths, page_audio_paths):
+    assert exported_path.read_bytes() == page_audio_path.read_bytes()
@@ -0,0 +1,20 @@
+from ytsv.benchmarks.synthetic import STAGE_NAMES, EXTRACT_PARTS, run_benchmark
+
+from conftest import VIDEO_KWARGS
+
+
+def test_synthetic_benchmark_times_the_pipeline_stages(tmp_path):
+  report = run_benchmark(tmp_path, num_videos=1, video_kwargs=VIDEO_KWARGS)
+  video = report['videos'][0]
+
+  assert list(report['totals']) == STAGE_NAMES
+  assert set(video['metrics']) == {'extract', 'systems', 'crop', 'staff_heights', 'resize'}
+
+  # the parts of the extract stage are timed inside it
+  assert sum( video['timings'][part] for part in EXTRACT_PARTS ) <= video['timings']['extract']
+
+  checks = video['checks']
+  assert checks['kept_pages'] == checks['music_pages'] == 4
+  assert checks['kept_silent_pages'] == 0
+  assert checks['crops'] == checks['resized'] == 4 * checks['music_pages']
+  assert (tmp_path / 'synthetic' / 'segments' / 'synthetic0000' / 'manifest.json').exists()
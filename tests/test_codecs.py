@@ -0,0 +1,45 @@
+import pytest
+
+from ytsv.image_io import ImageCodec, glob_images
+from ytsv.manifest import load_manifest
+from ytsv.benchmarks.codecs import get_image_paths
+
+from conftest import run
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_none_codec_writes_no_resized_crops(dataset, fake_yolo_models, pipeline):
+  dataset_dir, _ = dataset
+  seg_dir = dataset_dir / '1-0' / 'segments' / 'vid0'
+
+  run(dataset, resized_codec='none', pipeline=pipeline)
+  manifest = load_manifest(seg_dir)
+  assert manifest['stages']['resize']['inputs']['codec'] == 'none'
+  assert manifest['stages']['resize']['outputs'] == []
+  assert glob_images(seg_dir / 'images' / 'crop_resized') == []
+  assert len(glob_images(seg_dir / 'images' / 'cropped')) > 0
+
+  # a later run only writes the resized crops
+  calls = len(fake_yolo_models[0].calls)
+  run(dataset, pipeline=pipeline)
+  assert len(fake_yolo_models[0].calls) == calls
+  assert len(glob_images(seg_dir / 'images' / 'crop_resized')) == len(glob_images(seg_dir / 'images' / 'cropped'))
+
+
+def test_none_codec_is_only_for_resized_crops():
+  with pytest.raises(ValueError, match='only available for the resized crops'):
+    ImageCodec('none')
+  assert ImageCodec('none', allow_none=True).suffix is None
+
+
+def test_benchmark_images_are_sampled_from_a_few_videos(dataset, fake_yolo_models):
+  run(dataset)
+  dataset_dir, _ = dataset
+
+  paths = get_image_paths(dataset_dir, num_images=5, num_videos=1)
+  assert [ len(paths[kind]) for kind in ['pages', 'crops', 'resized'] ] == [4, 5, 5]
+  assert len({ path.parents[2] for kind_paths in paths.values() for path in kind_paths }) == 1
+
+  paths = get_image_paths(dataset_dir, num_images=6, num_videos=2)
+  assert len(paths['crops']) == 6
+  assert { path.parents[2].name for path in paths['crops'] } == {'vid0', 'vid1'}
@@ -0,0 +1,75 @@
+import csv
+
+import numpy as np
+
+from ytsv.dataset import DatasetReader, collect_video_samples
+
+from conftest import run
+
+
+def get_keys(reader:DatasetReader) -> list[str]:
+  return [ reader[i]['key'] for i in range(len(reader)) ]
+
+
+def test_reader_matches_the_collected_samples(dataset, fake_yolo_models):
+  run(dataset)
+  dataset_dir, metadata_path = dataset
+  reader = DatasetReader(dataset_dir, metadata_path)
+
+  samples = [ sample for yt_id in ['vid0', 'vid1'] for sample in collect_video_samples(dataset_dir / '1-0' / 'segments' / yt_id) ]
+  assert len(reader) == len(samples) > 0
+
+  for i, sample in enumerate(samples):
+    item = reader[i]
+    assert item['key'] == sample['key']
+    assert (item['start_time'], item['end_time']) == (sample['start_time'], sample['end_time'])
+    assert item['systems']['bbox'].tolist() == [ system['bbox'] for system in sample['systems'] ]
+    assert item['crop_paths'] == [ system['crop_resized'] for system in sample['systems'] ]
+
+
+def test_update_appends_only_the_changed_video(dataset, fake_yolo_models):
+  run(dataset)
+  dataset_dir, metadata_path = dataset
+  index_dir = dataset_dir / 'index'
+
+  keys = get_keys(DatasetReader(dataset_dir, metadata_path))
+  tables = { name: (index_dir / name).read_bytes() for name in ['pages.bin', 'systems.bin', 'videos.jsonl'] }
+
+  # nothing changed
+  DatasetReader(dataset_dir, metadata_path)
+  assert { name: (index_dir / name).read_bytes() for name in tables } == tables
+
+  # only the resized crops of vid1 change
+  resized_dir = dataset_dir / '1-0' / 'segments' / 'vid1' / 'images' / 'crop_resized'
+  crop_path = sorted(resized_dir.iterdir())[0]
+  crop_path.unlink()
+
+  reader = DatasetReader(dataset_dir, metadata_path)
+  vid1_pages = sum( 1 for key in keys if key.startswith('vid1') )
+
+  for name, table in tables.items():
+    assert (index_dir / name).read_bytes().startswith(table)
+  assert len(reader.pages) == len(keys) + vid1_pages
+  assert [ video['yt_id'] for video in reader.videos ] == ['vid0', 'vid1', 'vid1']
+
+  assert sorted(get_keys(reader)) == sorted(keys)
+  assert crop_path not in [ path for i in range(len(reader)) for path in reader[i]['crop_paths'] ]
+
+
+def test_update_removes_videos_that_left_the_metadata(dataset, fake_yolo_models):
+  run(dataset)
+  dataset_dir, metadata_path = dataset
+  keys = get_keys(DatasetReader(dataset_dir, metadata_path))
+
+  with open(metadata_path, 'r') as f:
+    rows = list(csv.reader(f))
+  with open(metadata_path, 'w') as f:
+    csv.writer(f).writerows( row for row in rows if row[0] != 'vid0' )
+
+  reader = DatasetReader(dataset_dir, metadata_path)
+  assert get_keys(reader) == [ key for key in keys if key.startswith('vid1') ]
+
+  reader.compact()
+  assert len(reader.pages) == len(reader)
+  assert get_keys(reader) == [ key for key in keys if key.startswith('vid1') ]
+  assert np.array_equal(reader.page_rows, np.arange(len(reader)))
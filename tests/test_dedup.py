@@ -0,0 +1,98 @@
+from pathlib import Path
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+import ytsv
+from ytsv.dedup import PageHashCache, load_alias_entries, load_extract_signature, get_stale_aliases
+from ytsv.manifest import load_manifest
+
+
+def make_page(rng:np.random.Generator, size:tuple[int, int]=(360, 640)) -> np.ndarray:
+  """
+  White page with random black staff-like bars
+  """
+  page = np.full(size, 255, dtype=np.uint8)
+  for _ in range(12):
+    y, x = int(rng.integers(0, size[0] - 8)), int(rng.integers(0, size[1] // 2))
+    page[y:y+6, x:x+int(rng.integers(40, size[1] // 2))] = 0
+  return page
+
+
+def test_repeated_pages_of_a_video_are_aliased(tmp_path):
+  rng = np.random.default_rng(0)
+  image_dir = tmp_path / '1-0' / 'segments' / 'vid' / 'images' / 'original'
+  image_dir.mkdir(parents=True)
+
+  pages = [make_page(rng), make_page(rng)]
+  page_image_paths = []
+  for i, page in enumerate(pages + [pages[0]]):
+    page_image_paths.append(image_dir / f'vid:{str(i).zfill(4)}:{10 * i}.png')
+    cv2.imwrite(str(page_image_paths[-1]), page)
+
+  cache = PageHashCache(tmp_path)
+  unique, aliases = cache.dedup_pages('vid', 'signature', page_image_paths)
+
+  assert unique == [0, 1]
+  assert aliases == {'vid:0002:20': {'source': '1-0/segments/vid/images/original/vid:0000:0.png', 'extract': 'signature'}}
+
+
+def make_copy_dataset(dataset_dir:Path, synthetic_videos, tmp_path) -> Path:
+  """
+  Dataset of vid0 and vidcopy, a copy of vid0 that only duplicates its pages
+  """
+  from conftest import make_dataset
+
+  video_path, _ = synthetic_videos[0]
+  copy_path = tmp_path / 'vidcopy.mp4'
+  shutil.copy(video_path, copy_path)
+
+  return make_dataset(dataset_dir, [video_path, copy_path])
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_pages_of_an_earlier_video_are_aliased(tmp_path, synthetic_videos, fake_yolo_models, pipeline):
+  dataset_dir = tmp_path / 'dataset'
+  metadata_path = make_copy_dataset(dataset_dir, synthetic_videos, tmp_path)
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), dedup_across_videos=True, pipeline=pipeline)
+
+  seg_dir = dataset_dir / '1-0' / 'segments'
+  aliases = load_alias_entries(seg_dir / 'vidcopy')
+  signature = load_extract_signature(seg_dir / 'vid0')
+
+  assert len(aliases) == sum(fake_yolo_models[0].calls) == 4
+  for page_stem, entry in aliases.items():
+    assert entry['source'] == f'1-0/segments/vid0/images/original/{page_stem.replace("vidcopy", "vid0")}.png'
+    assert entry['extract'] == signature
+
+
+def test_aliases_of_a_reextracted_video_are_rerun(tmp_path, synthetic_videos, fake_yolo_models):
+  dataset_dir = tmp_path / 'dataset'
+  metadata_path = make_copy_dataset(dataset_dir, synthetic_videos, tmp_path)
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), dedup_across_videos=True)
+
+  seg_dir = dataset_dir / '1-0' / 'segments'
+  old_signature = load_extract_signature(seg_dir / 'vid0')
+
+  # vid0 is downloaded again, its pages are extracted anew
+  mp4_path = dataset_dir / '1-0' / 'mp4' / 'vid0.mp4'
+  os.utime(mp4_path, (mp4_path.stat().st_atime, mp4_path.stat().st_mtime + 10))
+
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), dedup_across_videos=True)
+
+  new_signature = load_extract_signature(seg_dir / 'vid0')
+  assert new_signature != old_signature
+
+  # vidcopy was extracted before, but its aliases pointed to the old pages of vid0
+  assert 'resize' in load_manifest(seg_dir / 'vidcopy')['stages']
+  assert { entry['extract'] for entry in load_alias_entries(seg_dir / 'vidcopy').values() } == {new_signature}
+  assert get_stale_aliases(seg_dir / 'vidcopy') == []
+
+  # the index keeps the old pages of vid0, they are no candidates anymore
+  cache = PageHashCache(dataset_dir, index_path=dataset_dir / 'page_hashes.jsonl')
+  page_image_path = sorted((seg_dir / 'vidcopy' / 'images' / 'original').iterdir())[0]
+  source = cache.add_video_page('vidother', 'other', page_image_path)
+  assert source['extract'] == new_signature
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import ytsv
+from ytsv.detections import (
+  YOLO_SYSTEM, SYSTEM, STAFF, DETECTION_DTYPE,
+  to_detections, save_detections, load_detections, group_bboxs, export_text_sidecars, get_detections_path
+)
+from ytsv.system_utils import detect_systems_by_batch, crop_systems, detect_staff_heights_by_batch
+
+
+def assert_same_detections(a:np.ndarray, b:np.ndarray):
+  assert len(a) == len(b)
+  for name in DETECTION_DTYPE.names:
+    assert np.array_equal(a[name], b[name]), name
+
+
+def test_store_round_trips_through_the_text_sidecars(dataset, fake_yolo_models):
+  dataset_dir, metadata_path = dataset
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'))
+
+  seg_dir = dataset_dir / '1-0' / 'segments' / 'vid0'
+  detections = load_detections(seg_dir, mmap_mode=None)
+  assert set(detections['kind'].tolist()) == {YOLO_SYSTEM, SYSTEM, STAFF}
+
+  sidecar_paths = export_text_sidecars(seg_dir)
+  assert all( path.exists() for path in sidecar_paths )
+
+  # without the store, the text files are read
+  get_detections_path(seg_dir).unlink()
+  assert_same_detections(load_detections(seg_dir), detections)
+
+
+def test_stage_replaces_its_rows_and_drops_the_later_stages(tmp_path):
+  page_stem = 'vid:0001:30'
+  save_detections(tmp_path, 'systems', [to_detections(YOLO_SYSTEM, page_stem, [[0, 50, 100, 80, 0.5], [0, 10, 100, 40, 0.9]])])
+  save_detections(tmp_path, 'crop', [to_detections(SYSTEM, page_stem, [[0, 10, 100, 40, 0.9]])])
+  save_detections(tmp_path, 'staff_heights', [to_detections(STAFF, page_stem, [[1, 2, 99, 12, 0.8]], system=0)])
+
+  detections = load_detections(tmp_path)
+  assert detections['kind'].tolist() == [YOLO_SYSTEM, YOLO_SYSTEM, SYSTEM, STAFF]
+  assert group_bboxs(detections, STAFF, 'vid') == {'vid:0001:30:0000': [[1, 2, 99, 12, np.float32(0.8)]]}
+
+  save_detections(tmp_path, 'crop', [])
+  assert load_detections(tmp_path)['kind'].tolist() == [YOLO_SYSTEM, YOLO_SYSTEM]
+
+
+def test_text_file_helpers_write_the_sidecars(tmp_path):
+  from conftest import FakeYOLO
+
+  image_dir = tmp_path / 'vid' / 'images' / 'original'
+  image_dir.mkdir(parents=True)
+  page_image_path = image_dir / 'vid:0000:15.png'
+  cv2.imwrite(str(page_image_path), np.full((360, 640, 3), 255, dtype=np.uint8))
+
+  yolo_bbox_paths = detect_systems_by_batch([page_image_path], FakeYOLO('system'))
+  assert yolo_bbox_paths == [image_dir / 'vid:0000:15_yolo_bboxs.txt']
+
+  crop_image_paths = crop_systems(yolo_bbox_paths[0])
+  assert (image_dir / 'vid:0000:15_system_bboxs.txt').exists()
+  assert len(crop_image_paths) == 3
+
+  staff_heights = detect_staff_heights_by_batch(crop_image_paths, FakeYOLO('staff'))
+  assert staff_heights == [10.5] * 3
+  assert all( path.with_name(f'{path.stem}_staff_heights.txt').exists() for path in crop_image_paths )
+
+  detections = load_detections(tmp_path / 'vid')
+  assert [ int(np.count_nonzero(detections['kind'] == kind)) for kind in [YOLO_SYSTEM, SYSTEM, STAFF] ] == [3, 3, 6]
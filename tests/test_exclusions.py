@@ -0,0 +1,36 @@
+from pathlib import Path
+import json
+
+import ytsv
+from ytsv import exclusion_list
+
+
+def get_processed_videos(dataset_dir:Path) -> list[str]:
+  return sorted( p.name for p in (dataset_dir / '1-0' / 'segments').iterdir() if (p / 'manifest.json').exists() )
+
+
+def test_exclusions_are_opt_in(dataset, fake_yolo_models, monkeypatch, tmp_path):
+  dataset_dir, metadata_path = dataset
+  monkeypatch.setattr(exclusion_list, 'exclude_videos', {'all': {'vid0'}})
+
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'))
+  assert get_processed_videos(dataset_dir) == ['vid0', 'vid1']
+
+
+def test_excluded_videos_and_pages_are_skipped(dataset, fake_yolo_models, monkeypatch, tmp_path):
+  dataset_dir, metadata_path = dataset
+  monkeypatch.setattr(exclusion_list, 'exclude_videos', {'all': {'vid0'}})
+
+  extra_path = tmp_path / 'exclusions.json'
+  extra_path.write_text(json.dumps({'exclude_pages': {'all': ['vid1:0002']}}))
+
+  # an exclusion list file turns exclusions on
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), exclusion_list_path=extra_path)
+  assert get_processed_videos(dataset_dir) == ['vid1']
+
+  page_numbers = [ int(p.stem.split(':')[1]) for p in (dataset_dir / '1-0' / 'segments' / 'vid1' / 'images' / 'original').iterdir() ]
+  assert sorted(page_numbers) == [0, 1, 3]
+
+  with open(dataset_dir / 'metrics.jsonl', 'r') as f:
+    extract = json.loads(f.readline())['stages']['extract']
+  assert (extract['pages_excluded'], extract['pages_not_decoded']) == (1, 0)
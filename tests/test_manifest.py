@@ -0,0 +1,108 @@
+from pathlib import Path
+
+import pytest
+
+import ytsv
+from ytsv.manifest import STAGES, load_manifest, get_first_stale_stage
+
+from conftest import run
+
+
+@pytest.fixture
+def extract_calls(monkeypatch) -> list[str]:
+  """
+  Names of the videos extract_pages_and_audios runs on
+  """
+  calls = []
+  extract_pages_and_audios = ytsv.extract_pages_and_audios
+
+  def counting_extract(video_path, out_path, **kwargs):
+    calls.append(Path(out_path).name)
+    return extract_pages_and_audios(video_path, out_path, **kwargs)
+
+  monkeypatch.setattr(ytsv, 'extract_pages_and_audios', counting_extract)
+  return calls
+
+
+def get_seg_dir(dataset, yt_id:str='vid0') -> Path:
+  return dataset[0] / '1-0' / 'segments' / yt_id
+
+
+def get_stage_inputs(dataset, fake_yolo_models, yt_id:str='vid0', **kwargs) -> dict:
+  mp4_path = dataset[0] / '1-0' / 'mp4' / f'{yt_id}.mp4'
+  return ytsv.get_stage_inputs(mp4_path, fake_yolo_models, **kwargs)
+
+
+def test_rerun_skips_completed_videos(dataset, fake_yolo_models, extract_calls):
+  run(dataset)
+  manifest = load_manifest(get_seg_dir(dataset))
+
+  assert list(manifest['stages']) == STAGES
+  assert sorted(extract_calls) == ['vid0', 'vid1']
+  assert get_first_stale_stage(get_seg_dir(dataset), manifest, get_stage_inputs(dataset, fake_yolo_models)) == len(STAGES)
+
+  extract_calls.clear()
+  num_calls = [ len(yolo.calls) for yolo in fake_yolo_models ]
+  run(dataset)
+
+  assert extract_calls == []
+  assert [ len(yolo.calls) for yolo in fake_yolo_models ] == num_calls
+  assert load_manifest(get_seg_dir(dataset)) == manifest
+
+
+def test_changed_target_height_only_reruns_resize(dataset, fake_yolo_models, extract_calls):
+  run(dataset)
+  manifest = load_manifest(get_seg_dir(dataset))
+
+  extract_calls.clear()
+  num_calls = [ len(yolo.calls) for yolo in fake_yolo_models ]
+  run(dataset, target_height=24)
+
+  assert extract_calls == []
+  assert [ len(yolo.calls) for yolo in fake_yolo_models ] == num_calls
+
+  resumed = load_manifest(get_seg_dir(dataset))
+  for stage in STAGES[:-1]:
+    assert resumed['stages'][stage] == manifest['stages'][stage]
+  assert resumed['stages']['resize']['inputs'] == {'target_height': 24}
+
+
+def test_missing_output_reruns_its_stage(dataset, fake_yolo_models, extract_calls):
+  run(dataset)
+  seg_dir = get_seg_dir(dataset)
+  manifest = load_manifest(seg_dir)
+
+  crop_path = seg_dir / manifest['stages']['crop']['outputs'][0]
+  crop_path.unlink()
+  assert get_first_stale_stage(seg_dir, manifest, get_stage_inputs(dataset, fake_yolo_models)) == STAGES.index('crop')
+
+  extract_calls.clear()
+  num_system_calls = len(fake_yolo_models[0].calls)
+  run(dataset)
+
+  # the crops are cut from the saved pages with the stored boxes, the system model does not run again
+  assert extract_calls == []
+  assert len(fake_yolo_models[0].calls) == num_system_calls
+  assert crop_path.exists()
+  assert list(load_manifest(seg_dir)['stages']) == STAGES
+
+
+def test_changed_video_reruns_everything(dataset, fake_yolo_models, extract_calls):
+  run(dataset)
+
+  mp4_path = dataset[0] / '1-0' / 'mp4' / 'vid1.mp4'
+  mp4_path.write_bytes( mp4_path.read_bytes() )
+
+  extract_calls.clear()
+  run(dataset)
+
+  assert extract_calls == ['vid1']
+
+
+def test_no_resume_reruns_everything(dataset, fake_yolo_models, extract_calls):
+  run(dataset)
+
+  extract_calls.clear()
+  run(dataset, resume=False)
+
+  assert sorted(extract_calls) == ['vid0', 'vid1']
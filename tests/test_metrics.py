@@ -0,0 +1,62 @@
+from pathlib import Path
+import json
+
+import pytest
+
+import ytsv
+from ytsv.manifest import STAGES
+
+
+def load_metrics(dataset_dir:Path) -> dict[str, dict]:
+  with open(dataset_dir / 'metrics.jsonl', 'r') as f:
+    return { record['yt_id']: record for record in map(json.loads, f) }
+
+
+def test_batch_counts_are_the_submitted_batches(dataset, fake_yolo_models):
+  dataset_dir, metadata_path = dataset
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), batch_size=3)
+
+  records = load_metrics(dataset_dir)
+  assert sorted(records) == ['vid0', 'vid1']
+
+  system_calls = list(fake_yolo_models[0].calls)
+  systems = [ records[yt_id]['stages']['systems'] for yt_id in ['vid0', 'vid1'] ]
+
+  assert sum( stage['batches'] for stage in systems ) == len(system_calls)
+  assert sum( stage['batch_items'] for stage in systems ) == sum(system_calls)
+  assert sum( stage['batch_slots'] for stage in systems ) == 3 * len(system_calls)
+
+  for stage in systems:
+    assert stage['batch_fill_ratio'] == stage['batch_items'] / stage['batch_slots']
+    assert stage['batch_items'] == stage['pages']
+
+  extract = records['vid0']['stages']['extract']
+  assert extract['frames_retrieved'] <= extract['frames_decoded']
+  assert 'process_peak_rss' in extract
+
+
+@pytest.mark.parametrize('batch_timeout', [0, 0.5])
+def test_pipeline_writes_metrics(dataset, fake_yolo_models, batch_timeout):
+  dataset_dir, metadata_path = dataset
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), pipeline=True, batch_size=4, batch_timeout=batch_timeout)
+
+  records = load_metrics(dataset_dir)
+  assert sorted(records) == ['vid0', 'vid1']
+
+  for record in records.values():
+    assert not record['failed']
+    assert list(record['stages']) == STAGES
+    for stage in record['stages'].values():
+      assert stage['wall_time'] > 0
+
+  # the shares of the videos in the batches add up to the batches that were run
+  for stage, yolo in [('systems', fake_yolo_models[0]), ('staff_heights', fake_yolo_models[1])]:
+    stages = [ record['stages'][stage] for record in records.values() ]
+    assert sum( stage['batch_items'] for stage in stages ) == sum(yolo.calls)
+    assert sum( stage['batches'] for stage in stages ) == pytest.approx(len(yolo.calls))
+    assert sum( stage['batch_slots'] for stage in stages ) == pytest.approx(4 * len(yolo.calls))
+
+  for record in records.values():
+    stages = record['stages']
+    assert stages['systems']['pages'] == stages['extract']['pages']
+    assert stages['crop']['crops'] == stages['staff_heights']['crops'] == stages['resize']['resized'] == 3 * stages['crop']['pages']
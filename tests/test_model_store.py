@@ -0,0 +1,137 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import os
+import threading
+
+import pytest
+
+from ytsv.model_store import ModelStore, ChecksumError, UnpinnedChecksumWarning
+
+
+CHECKPOINT = os.urandom(300_000)
+SHA256 = hashlib.sha256(CHECKPOINT).hexdigest()
+
+
+class CheckpointHandler(BaseHTTPRequestHandler):
+  """
+  Serves CHECKPOINT at /model.pt with support for range requests
+  """
+  requests = []
+
+  def do_GET(self):
+    CheckpointHandler.requests.append( (self.path, self.headers.get('Range')) )
+    if self.path != '/model.pt':
+      self.send_error(404)
+      return
+
+    start = 0
+    if self.headers.get('Range'):
+      start = int(self.headers['Range'].split('=')[1].split('-')[0])
+      if start >= len(CHECKPOINT):
+        self.send_response(416)
+        self.send_header('Content-Range', f'bytes */{len(CHECKPOINT)}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', f'bytes {start}-{len(CHECKPOINT) - 1}/{len(CHECKPOINT)}')
+    else:
+      self.send_response(200)
+
+    self.send_header('Content-Length', str(len(CHECKPOINT) - start))
+    self.end_headers()
+    self.wfile.write(CHECKPOINT[start:])
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def checkpoint_url():
+  server = ThreadingHTTPServer(('127.0.0.1', 0), CheckpointHandler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  CheckpointHandler.requests.clear()
+
+  yield f'http://127.0.0.1:{server.server_address[1]}'
+
+  server.shutdown()
+  server.server_close()
+
+
+def test_download_is_checked_against_the_pinned_sha256(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={'model.pt': SHA256}, chunk_size=4096)
+
+  path = store.fetch('model.pt')
+  assert path.read_bytes() == CHECKPOINT
+  assert not path.with_name('model.pt.part').exists()
+
+  # a verified checkpoint is not downloaded again
+  store.fetch('model.pt')
+  assert len(CheckpointHandler.requests) == 1
+
+  # a corrupted one is
+  path.write_bytes(b'corrupt')
+  assert store.fetch('model.pt').read_bytes() == CHECKPOINT
+  assert len(CheckpointHandler.requests) == 2
+
+
+def test_pinned_sha256_mismatch_fails(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={'model.pt': '0' * 64})
+
+  with pytest.raises(ChecksumError):
+    store.fetch('model.pt')
+
+  assert not (tmp_path / 'model.pt').exists()
+  assert not (tmp_path / 'model.pt.part').exists()
+
+
+def test_unpinned_checkpoint_warns(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={})
+
+  with pytest.warns(UnpinnedChecksumWarning, match=SHA256):
+    path = store.fetch('model.pt')
+  assert path.read_bytes() == CHECKPOINT
+
+  # later runs compare against the recorded hash, and still warn
+  path.write_bytes(b'corrupt')
+  with pytest.warns(UnpinnedChecksumWarning):
+    assert store.fetch('model.pt').read_bytes() == CHECKPOINT
+
+
+def test_interrupted_download_resumes_with_a_range_request(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={'model.pt': SHA256})
+  (tmp_path / 'model.pt.part').write_bytes(CHECKPOINT[:100_000])
+
+  assert store.fetch('model.pt').read_bytes() == CHECKPOINT
+  assert CheckpointHandler.requests == [('/model.pt', 'bytes=100000-')]
+
+
+def test_complete_part_is_verified_and_kept(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={'model.pt': SHA256})
+  (tmp_path / 'model.pt.part').write_bytes(CHECKPOINT)
+
+  assert store.fetch('model.pt').read_bytes() == CHECKPOINT
+  # the server answered 416, nothing was downloaded again
+  assert CheckpointHandler.requests == [('/model.pt', f'bytes={len(CHECKPOINT)}-')]
+
+
+def test_part_longer_than_the_file_is_downloaded_again(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={'model.pt': SHA256})
+  (tmp_path / 'model.pt.part').write_bytes(CHECKPOINT + b'stale')
+
+  assert store.fetch('model.pt').read_bytes() == CHECKPOINT
+  assert CheckpointHandler.requests == [('/model.pt', f'bytes={len(CHECKPOINT) + 5}-'), ('/model.pt', None)]
+
+
+def test_offline_store_never_downloads(tmp_path, checkpoint_url):
+  store = ModelStore(tmp_path, offline=True, urls={'model.pt': f'{checkpoint_url}/model.pt'}, sha256={'model.pt': SHA256})
+
+  with pytest.raises(FileNotFoundError):
+    store.fetch('model.pt')
+
+  (tmp_path / 'model.pt').write_bytes(b'corrupt')
+  with pytest.raises(ChecksumError):
+    store.fetch('model.pt')
+
+  assert CheckpointHandler.requests == []
@@ -0,0 +1,133 @@
+from pathlib import Path
+import queue
+import threading
+
+import ytsv
+import ytsv.pipeline
+from ytsv.pipeline import VIDEO_DONE, VideoJob, run_stage
+from ytsv.manifest import load_manifest
+
+
+def run_in_thread(target, timeout:float=120) -> bool:
+  """
+  :return: True if target returned within timeout
+  """
+  thread = threading.Thread(target=target, daemon=True)
+  thread.start()
+  thread.join(timeout)
+  return not thread.is_alive()
+
+
+def test_run_stage_forwards_marker_when_finish_stage_fails():
+  job = VideoJob(['vid'] + ['x'] * 14)
+
+  def finish_stage(stage):
+    raise OSError('disk full')
+  job.finish_stage = finish_stage
+
+  in_queue, out_queue = queue.Queue(), queue.Queue()
+  in_queue.put( (job, 'page') )
+  in_queue.put( (job, VIDEO_DONE) )
+  in_queue.put(None)
+
+  assert run_in_thread(lambda: run_stage(in_queue, out_queue, lambda batch: batch, name='crop'), timeout=10)
+
+  assert out_queue.get_nowait() == (job, 'page')
+  assert out_queue.get_nowait() == (job, VIDEO_DONE)
+  assert out_queue.get_nowait() is None
+  assert job.failed
+
+
+def test_pipeline_finishes_when_recording_a_stage_fails(dataset, fake_yolo_models, monkeypatch):
+  dataset_dir, metadata_path = dataset
+
+  def save_detections(seg_dir, stage, detections):
+    raise OSError('disk full')
+  monkeypatch.setattr(ytsv.pipeline, 'save_detections', save_detections)
+
+  assert run_in_thread(lambda: ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), pipeline=True))
+
+  for yt_id in ['vid0', 'vid1']:
+    manifest = load_manifest(dataset_dir / '1-0' / 'segments' / yt_id)
+    assert 'extract' in manifest['stages']
+    assert 'systems' not in manifest['stages']
+
+
+def test_pipeline_matches_sequential_run(dataset, fake_yolo_models, tmp_path, synthetic_videos):
+  from conftest import make_dataset
+
+  dataset_dir, metadata_path = dataset
+  ytsv.process_videos_from_scratch(dataset_dir, metadata_path, Path('checkpoints'), pipeline=True)
+
+  sequential_dir = tmp_path / 'sequential'
+  sequential_metadata_path = make_dataset(sequential_dir, [ video_path for video_path, _ in synthetic_videos ])
+  ytsv.process_videos_from_scratch(sequential_dir, sequential_metadata_path, Path('checkpoints'))
+
+  for yt_id in ['vid0', 'vid1']:
+    resized_dir = Path('1-0') / 'segments' / yt_id / 'images' / 'crop_resized'
+    pipelined = sorted( p.name for p in (dataset_dir / resized_dir).iterdir() )
+    sequential = sorted( p.name for p in (sequential_dir / resized_dir).iterdir() )
+
+    assert pipelined and pipelined == sequential
+    for name in pipelined:
+      assert (dataset_dir / resized_dir / name).read_bytes() == (sequential_dir / resized_dir / name).read_bytes()
+
+
+def test_workers_match_sequential_run_and_isolate_failures(tmp_path, synthetic_videos, fake_yolo_models, monkeypatch):
+  from concurrent.futures import ProcessPoolExecutor
+  from conftest import make_dataset
+
+  class CountingExecutor(ProcessPoolExecutor):
+    """
+    Records the most results that were submitted but not consumed yet
+    """
+    held = []
+    max_held = 0
+
+    def submit(self, *args, **kwargs):
+      future = super().submit(*args, **kwargs)
+      future.consumed = False
+
+      result = future.result
+      def consume(*args, **kwargs):
+        future.consumed = True
+        return result(*args, **kwargs)
+      future.result = consume
+
+      CountingExecutor.held = [ f for f in CountingExecutor.held if not f.consumed ] + [future]
+      CountingExecutor.max_held = max(CountingExecutor.max_held, len(CountingExecutor.held))
+      return future
+
+  monkeypatch.setattr(ytsv, 'ProcessPoolExecutor', CountingExecutor)
+
+  # more videos than are in flight, one of them cannot be decoded
+  video_paths = []
+  for i in range(5):
+    video_paths.append(tmp_path / f'vid{i}.mp4')
+    video_paths[-1].write_bytes( synthetic_videos[i % 2][0].read_bytes() )
+  video_paths.append(tmp_path / 'broken.mp4')
+  video_paths[-1].write_bytes(b'not a video')
+
+  extract_kwargs = {'save_pages': False}
+
+  workers_dir = tmp_path / 'workers'
+  ytsv.process_videos_from_scratch(workers_dir, make_dataset(workers_dir, video_paths), Path('checkpoints'), workers=2, extract_kwargs=extract_kwargs)
+  # 2 * workers in flight and the video whose pages are processed
+  assert CountingExecutor.max_held == 2 * 2 + 1
+
+  sequential_dir = tmp_path / 'sequential'
+  ytsv.process_videos_from_scratch(sequential_dir, make_dataset(sequential_dir, video_paths[:2]), Path('checkpoints'), extract_kwargs=extract_kwargs)
+
+  for yt_id in ['vid0', 'vid1']:
+    resized_dir = Path('1-0') / 'segments' / yt_id / 'images' / 'crop_resized'
+    with_workers = sorted( p.name for p in (workers_dir / resized_dir).iterdir() )
+    sequential = sorted( p.name for p in (sequential_dir / resized_dir).iterdir() )
+
+    assert with_workers and with_workers == sequential
+    for name in with_workers:
+      assert (workers_dir / resized_dir / name).read_bytes() == (sequential_dir / resized_dir / name).read_bytes()
+
+  # the broken video failed alone
+  for yt_id in ['vid2', 'vid3', 'vid4']:
+    assert 'resize' in load_manifest(workers_dir / '1-0' / 'segments' / yt_id)['stages']
+  assert 'extract' not in load_manifest(workers_dir / '1-0' / 'segments' / 'broken').get('stages', {})
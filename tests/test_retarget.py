@@ -0,0 +1,28 @@
+import pytest
+
+from ytsv.image_io import glob_images
+from ytsv.retarget import retarget_video, retarget_videos
+
+from conftest import run
+
+
+@pytest.mark.parametrize('save_pages', [True, False])
+def test_retarget_writes_every_height(dataset, fake_yolo_models, save_pages):
+  run(dataset, extract_kwargs={'save_pages': save_pages})
+  dataset_dir, metadata_path = dataset
+  seg_dir = dataset_dir / '1-0' / 'segments' / 'vid0'
+  num_crops = len(glob_images(seg_dir / 'images' / 'crop_resized'))
+
+  results = retarget_videos(dataset_dir, metadata_path, [24, 32])
+
+  assert sorted(results) == ['vid0', 'vid1']
+  assert results['vid0']['resized'] == 2 * num_crops
+  assert len(glob_images(seg_dir / 'images' / 'crop_resized')) == len(glob_images(seg_dir / 'images' / 'crop_resized_32')) == num_crops
+
+
+def test_retarget_needs_saved_pages_or_crops(dataset, fake_yolo_models):
+  run(dataset, extract_kwargs={'save_pages': False}, save_crops=False)
+  dataset_dir, _ = dataset
+
+  with pytest.raises(FileNotFoundError, match='needs saved pages or crops'):
+    retarget_video(dataset_dir / '1-0' / 'segments' / 'vid0', [24])
@@ -0,0 +1,61 @@
+from pathlib import Path
+import json
+import math
+import tarfile
+
+import pytest
+
+from ytsv.dataset import collect_video_samples
+from ytsv.shards import INDEX_NAME, export_shards, read_shard_sample
+
+from conftest import run
+
+
+@pytest.mark.parametrize('pages_per_shard', [None, 3])
+def test_shards_round_trip(dataset, fake_yolo_models, tmp_path, pages_per_shard):
+  run(dataset)
+  dataset_dir, metadata_path = dataset
+
+  out_dir = tmp_path / 'shards'
+  export_shards(dataset_dir, metadata_path, out_dir, pages_per_shard=pages_per_shard)
+  index = json.loads( (out_dir / INDEX_NAME).read_text() )
+
+  samples = {}
+  for yt_id in ['vid0', 'vid1']:
+    for sample in collect_video_samples(dataset_dir / '1-0' / 'segments' / yt_id):
+      samples[sample['key']] = sample
+
+  # every page once, in order, split into shards of pages_per_shard pages or one per video
+  assert [ entry['key'] for shard in index['shards'] for entry in shard['samples'] ] == list(samples)
+  assert index['num_samples'] == len(samples) == 8
+
+  if pages_per_shard:
+    assert [ shard['name'] for shard in index['shards'] ] == [ f'shard-{str(i).zfill(6)}.tar' for i in range(math.ceil(8 / 3)) ]
+    assert [ shard['num_samples'] for shard in index['shards'] ] == [3, 3, 2]
+  else:
+    assert [ shard['name'] for shard in index['shards'] ] == ['vid0.tar', 'vid1.tar']
+    assert [ shard['num_samples'] for shard in index['shards'] ] == [4, 4]
+
+  for shard in index['shards']:
+    shard_path = out_dir / shard['name']
+    with tarfile.open(shard_path) as tar:
+      member_names = tar.getnames()
+
+    read_names = []
+    for entry in shard['samples']:
+      key = entry['key']
+      sample = samples[key]
+      members = read_shard_sample(shard_path, entry['offset'], entry['size'])
+      read_names += list(members)
+
+      info = json.loads(members[f'{key}.json'])
+      assert (info['key'], info['yt_id'], info['page'], info['metadata']['yt_id']) == (key, sample['yt_id'], sample['page'], sample['yt_id'])
+      assert members[f'{key}.wav'] == Path(sample['audio']).read_bytes()
+
+      crops = [ system for system in info['systems'] if system['crop_resized'] ]
+      assert crops and len(members) == 2 + len(crops)
+      for system, crop in zip(sample['systems'], info['systems']):
+        assert members[crop['crop_resized']] == Path(system['crop_resized']).read_bytes()
+
+    # the byte ranges cover every member of the shard, in order
+    assert read_names == member_names
@@ -0,0 +1,274 @@
+import cv2
+import numpy as np
+import pytest
+
+from ytsv.slide_utils import (
+  SEEK_BACKOFF, read_frames_at, extract_pages_and_audios, get_section_list, get_section_list_sparse, get_section_list_by_chunks,
+  get_keyframe_indices, get_seek_cost
+)
+
+
+class CountingCapture:
+  """
+  cv2.VideoCapture that counts the frames it decodes
+  """
+  def __init__(self, video_path):
+    self.cap = cv2.VideoCapture(str(video_path))
+    self.reads = 0
+    self.grabs = 0
+    self.seeks = 0
+
+  def read(self):
+    self.reads += 1
+    return self.cap.read()
+
+  def grab(self):
+    self.grabs += 1
+    return self.cap.grab()
+
+  def retrieve(self):
+    return self.cap.retrieve()
+
+  def get(self, prop):
+    return self.cap.get(prop)
+
+  def set(self, prop, value):
+    self.seeks += 1
+    return self.cap.set(prop, value)
+
+  def release(self):
+    self.cap.release()
+
+
+def read_all_frames(video_path) -> list[np.ndarray]:
+  cap = cv2.VideoCapture(str(video_path))
+  frames = []
+  while True:
+    ret, frame = cap.read()
+    if not ret:
+      break
+    frames.append(frame)
+  cap.release()
+  return frames
+
+
+@pytest.mark.parametrize('seek_threshold', [300, 20])
+def test_read_frames_at_decodes_only_the_requested_frames(synthetic_videos, seek_threshold):
+  video_path, _ = synthetic_videos[0]
+  frames = read_all_frames(video_path)
+  frame_indices = [3, 4, 60, 200, len(frames) - 1]
+
+  cap = CountingCapture(video_path)
+  result = list(read_frames_at(cap, frame_indices, seek_threshold=seek_threshold))
+  cap.release()
+
+  assert [ frame_idx for frame_idx, _ in result ] == frame_indices
+  for frame_idx, frame in result:
+    assert np.array_equal(frame, frames[frame_idx])
+
+  # only the requested frames are converted, the others are grabbed or skipped by seeking
+  assert cap.reads == len(frame_indices)
+  assert cap.grabs <= len(frames)
+  if seek_threshold < 100:
+    assert cap.seeks > 0
+    assert cap.grabs < len(frames) - len(frame_indices)
+
+
+def test_read_frames_at_seeks_whenever_it_decodes_less(synthetic_videos):
+  video_path, _ = synthetic_videos[0]
+  frames = read_all_frames(video_path)
+  frame_indices = [3, 4, 60, 200, len(frames) - 1]
+
+  keyframes = get_keyframe_indices(video_path)
+  # cv2.VideoWriter writes a keyframe every 12 frames
+  assert keyframes.tolist() == list(range(0, len(frames), 12))
+
+  cap = CountingCapture(video_path)
+  result = list(read_frames_at(cap, frame_indices, keyframes=keyframes))
+  cap.release()
+
+  for frame_idx, frame in result:
+    assert np.array_equal(frame, frames[frame_idx])
+
+  # the first frames are grabbed, the long gaps are jumped, each seek decodes less than SEEK_BACKOFF and a GOP
+  assert cap.seeks == 3
+  assert cap.grabs == 3
+  assert all( get_seek_cost(keyframes, frame_idx) < SEEK_BACKOFF + 12 for frame_idx in frame_indices[2:] )
+
+
+def test_read_frames_at_stops_at_the_end_of_the_video(synthetic_videos):
+  video_path, _ = synthetic_videos[0]
+  num_frames = len(read_all_frames(video_path))
+
+  cap = cv2.VideoCapture(str(video_path))
+  result = [ frame_idx for frame_idx, _ in read_frames_at(cap, [10, num_frames - 1, num_frames + 5]) ]
+  cap.release()
+
+  assert result == [10, num_frames - 1]
+
+
+def test_extract_pages_and_audios_writes_the_middle_frame_of_each_music_page(synthetic_videos, tmp_path):
+  video_path, truth = synthetic_videos[0]
+  frames = read_all_frames(video_path)
+
+  page_image_paths, audio_paths = extract_pages_and_audios(video_path, tmp_path / 'vid0')
+
+  music_pages = [ page for page in truth['pages'] if page['kind'] == 'music' ]
+  assert len(page_image_paths) == len(music_pages) == len(audio_paths)
+
+  for page_image_path, page in zip(page_image_paths, music_pages):
+    _, page_idx, frame_idx = page_image_path.stem.split(':')
+    assert page['start_frame'] <= int(frame_idx) < page['end_frame']
+    assert np.array_equal(cv2.imread(str(page_image_path)), frames[int(frame_idx)])
+
+
+def get_transition_frames(truth:dict, fps:float, transition_duration:float=0.5) -> list[int]:
+  """
+  First frames of the fades between the pages of make_synthetic_video
+  """
+  return [ page['end_frame'] - int(transition_duration * fps) for page in truth['pages'][:-1] ]
+
+
+def test_sparse_sections_match_the_dense_detector(synthetic_videos):
+  for video_path, _ in synthetic_videos:
+    cap = cv2.VideoCapture(str(video_path))
+    dense = get_section_list(cap)
+    cap.release()
+
+    cap = cv2.VideoCapture(str(video_path))
+    sparse = get_section_list_sparse(cap)
+    cap.release()
+
+    assert sparse == dense
+
+
+def test_refined_sections_start_at_the_transitions(synthetic_videos):
+  video_path, truth = synthetic_videos[0]
+  cap = cv2.VideoCapture(str(video_path))
+  fps = cap.get(cv2.CAP_PROP_FPS)
+  step = int(fps // 3)
+
+  coarse = get_section_list_sparse(cap)
+  cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+  refined = get_section_list_sparse(cap, refine=True)
+  cap.release()
+
+  assert len(refined) == len(coarse)
+  assert [ section_type for _, _, section_type in refined ] == [ section_type for _, _, section_type in coarse ]
+
+  transition_starts = [ st for st, _, section_type in refined if section_type ]
+  assert len(transition_starts) == len(get_transition_frames(truth, fps))
+  for st, true_st in zip(transition_starts, get_transition_frames(truth, fps)):
+    # the first faded frame can be too close to the page to count as change
+    assert true_st <= st <= true_st + 1
+
+  for (coarse_st, _, _), (refined_st, _, _) in zip(coarse, refined):
+    assert coarse_st - 2 * step <= refined_st <= coarse_st
+
+
+@pytest.mark.parametrize('refine', [False, True])
+@pytest.mark.parametrize('num_chunks', [2, 3])
+def test_chunked_sections_match_a_single_pass(synthetic_videos, num_chunks, refine):
+  video_path, _ = synthetic_videos[1]
+
+  cap = cv2.VideoCapture(str(video_path))
+  sparse = get_section_list_sparse(cap, refine=refine)
+  cap.release()
+
+  assert get_section_list_by_chunks(video_path, num_chunks=num_chunks, refine=refine) == sparse
+
+
+def get_last_segment_padding(seg_dir) -> float:
+  """
+  Seconds the audio of the last page of a single audio file extends past its end time
+  """
+  index = np.load(seg_dir / 'audio' / 'original' / f'{seg_dir.name}_segments.npy')
+  return float(index[-1]['end_frame']) / 44100 - float(index[-1]['end_time'])
+
+
+def test_last_written_page_gets_the_audio_padding(synthetic_videos, tmp_path, monkeypatch):
+  import ytsv.slide_utils
+
+  video_path, _ = synthetic_videos[0]
+
+  extract_pages_and_audios(video_path, tmp_path / 'all', single_audio_file=True)
+  assert get_last_segment_padding(tmp_path / 'all') == pytest.approx(2, abs=1e-3)
+
+  # the last page is excluded
+  extract_pages_and_audios(video_path, tmp_path / 'excluded', single_audio_file=True, exclude_pages={3})
+  assert get_last_segment_padding(tmp_path / 'excluded') == pytest.approx(2, abs=1e-3)
+
+  # the video ends before the last page, e.g. a truncated download
+  def read_two_frames(cap, frame_indices, **kwargs):
+    return read_frames_at(cap, frame_indices[:2], **kwargs)
+  monkeypatch.setattr(ytsv.slide_utils, 'read_frames_at', read_two_frames)
+
+  extract_pages_and_audios(video_path, tmp_path / 'truncated', single_audio_file=True)
+  assert len(np.load(tmp_path / 'truncated' / 'audio' / 'original' / 'truncated_segments.npy')) == 2
+  assert get_last_segment_padding(tmp_path / 'truncated') == pytest.approx(2, abs=1e-3)
+
+
+
+@pytest.mark.parametrize('extract_kwargs', [{}, {'exclude_pages': {1}}, {'single_audio_file': True}])
+def test_audio_is_decoded_once(synthetic_videos, tmp_path, monkeypatch, extract_kwargs):
+  import ytsv.slide_utils, ytsv.audio_utils
+  from ytsv.audio_utils import iter_pcm_blocks
+
+  calls = []
+  def counting_iter_pcm_blocks(*args, **kwargs):
+    calls.append(args)
+    return iter_pcm_blocks(*args, **kwargs)
+  monkeypatch.setattr(ytsv.slide_utils, 'iter_pcm_blocks', counting_iter_pcm_blocks)
+  monkeypatch.setattr(ytsv.audio_utils, 'iter_pcm_blocks', counting_iter_pcm_blocks)
+
+  video_path, _ = synthetic_videos[0]
+  _, audio_paths = extract_pages_and_audios(video_path, tmp_path / 'vid0', **extract_kwargs)
+
+  assert len(calls) == 1
+  # the segments of the pages that were not written are removed
+  assert sorted((tmp_path / 'vid0' / 'audio' / 'original').iterdir()) == sorted(audio_paths)
+
+
+@pytest.mark.parametrize('section_kwargs', [{}, {'sparse_sections': True}, {'section_workers': 2}])
+def test_extract_stats_count_the_decoded_frames(synthetic_videos, tmp_path, section_kwargs):
+  video_path, _ = synthetic_videos[0]
+  num_frames = len(read_all_frames(video_path))
+
+  cap = cv2.VideoCapture(str(video_path))
+  step = int(cap.get(cv2.CAP_PROP_FPS) // 3)
+  cap.release()
+
+  stats = {}
+  extract_pages_and_audios(video_path, tmp_path / 'vid0', stats=stats, **section_kwargs)
+
+  if not section_kwargs:
+    # the dense detector reads every frame
+    num_samples = num_frames
+  elif 'section_workers' in section_kwargs:
+    # the first chunk also decodes the first sample of the second one
+    num_samples = -(-num_frames // step) + 1
+  else:
+    num_samples = -(-num_frames // step)
+
+  assert stats['frames_retrieved'] == num_samples + stats['pages']
+  # one pass for the sections, and from a keyframe to each page, at most SEEK_BACKOFF and a GOP of 12 frames
+  assert stats['frames_retrieved'] <= stats['frames_decoded'] <= num_frames + 1 + stats['pages'] * (SEEK_BACKOFF + 12)
+  assert stats['frames_decoded'] < 1.25 * num_frames
+
+
+def test_extract_stats_count_exclusions_apart_from_decode_failures(synthetic_videos, tmp_path, monkeypatch):
+  import ytsv.slide_utils
+
+  video_path, _ = synthetic_videos[0]
+
+  stats = {}
+  extract_pages_and_audios(video_path, tmp_path / 'excluded', exclude_pages={1}, stats=stats)
+  assert (stats['pages_excluded'], stats['pages_not_decoded'], stats['pages']) == (1, 0, 3)
+
+  def read_two_frames(cap, frame_indices, **kwargs):
+    return read_frames_at(cap, frame_indices[:2], **kwargs)
+  monkeypatch.setattr(ytsv.slide_utils, 'read_frames_at', read_two_frames)
+
+  stats = {}
+  extract_pages_and_audios(video_path, tmp_path / 'truncated', stats=stats)
+  assert (stats['pages_excluded'], stats['pages_not_decoded'], stats['pages']) == (0, 2, 2)
@@ -0,0 +1,121 @@
+import random
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from ytsv.image_io import glob_images, imread
+from ytsv.manifest import load_manifest
+from ytsv.system_utils import iter_prefetched_batches, detect_page_systems_by_batch, resize_systems
+
+from conftest import run
+
+
+def slow_load(item):
+  # loads finish out of order
+  time.sleep(random.uniform(0, 0.01))
+  return item * 10
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3])
+def test_prefetched_batches_keep_their_order(prefetch):
+  items = list(range(23))
+  batches = list(iter_prefetched_batches(items, slow_load, batch_size=4, prefetch=prefetch, num_threads=4))
+
+  assert [ batch for batch, _ in batches ] == [ items[i:i+4] for i in range(0, 23, 4) ]
+  assert [ loaded for _, loaded in batches ] == [ [ item * 10 for item in items[i:i+4] ] for i in range(0, 23, 4) ]
+
+
+def test_prefetch_does_not_change_the_detections(tmp_path):
+  from conftest import FakeYOLO
+
+  # pages of different sizes, so a page out of order changes its boxes
+  image_fns = []
+  for i in range(10):
+    image_fns.append(tmp_path / f'vid:{str(i).zfill(4)}:{i}.png')
+    cv2.imwrite(str(image_fns[-1]), np.full((300 + 10 * i, 600 + 20 * i, 3), 255, dtype=np.uint8))
+
+  page_bboxs = {}
+  for prefetch in [0, 2]:
+    yolo = FakeYOLO('system')
+    page_bboxs[prefetch] = detect_page_systems_by_batch(image_fns, yolo, batch_size=3, prefetch=prefetch)
+    assert yolo.calls == [3, 3, 3, 1]
+
+  assert [ image_fn for image_fn, _ in page_bboxs[0] ] == image_fns
+  assert page_bboxs[2] == page_bboxs[0]
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_loader_error_reaches_the_caller(prefetch):
+  def load(item):
+    if item == 5:
+      raise OSError(f'cannot read {item}')
+    return item
+
+  batches = []
+  with pytest.raises(OSError, match='cannot read 5'):
+    for batch, loaded in iter_prefetched_batches(list(range(10)), load, batch_size=2, prefetch=prefetch):
+      batches.append(loaded)
+
+  # the batches before the failing one were used
+  assert batches == [[0, 1], [2, 3]]
+
+
+def make_crop(rng:np.random.Generator) -> np.ndarray:
+  """
+  System crop with five staff lines and note heads, staff height 40
+  """
+  crop = np.full((400, 1600, 3), 255, dtype=np.uint8)
+  for k in range(5):
+    crop[40+60*k:44+60*k] = 0
+  for _ in range(60):
+    cv2.ellipse(crop, (int(rng.integers(0, 1580)), int(rng.integers(0, 380))), (9, 6), 0, 0, 360, (0, 0, 0), -1)
+  return crop
+
+
+def test_pyramid_levels_match_a_direct_resize(tmp_path):
+  crop_dir = tmp_path / 'vid' / 'images' / 'cropped'
+  crop_dir.mkdir(parents=True)
+  crop_image_fn = crop_dir / 'vid:0000:0:0000.png'
+  crop = make_crop(np.random.default_rng(0))
+  cv2.imwrite(str(crop_image_fn), crop)
+
+  # 8 is built from 18, 3 from 8
+  target_heights = [18, 8, 3]
+  resized_image_paths = resize_systems([crop_image_fn], [40.0], target_heights)
+  assert [ path.parent.name for path in resized_image_paths ] == ['crop_resized', 'crop_resized_8', 'crop_resized_3']
+
+  for target_height, path in zip(target_heights, resized_image_paths):
+    ratio = target_height / 40
+    direct = cv2.resize(crop, (int(crop.shape[1] * ratio), int(crop.shape[0] * ratio)), interpolation=cv2.INTER_AREA)
+    resized = imread(path)
+    assert resized.shape == direct.shape
+
+    diff = np.abs(resized.astype(np.int16) - direct.astype(np.int16))
+    if target_height == 18:
+      assert diff.max() == 0
+    else:
+      assert 0 < diff.mean() < 1 and diff.max() < 64
+
+
+def test_every_target_height_is_written(dataset, fake_yolo_models):
+  target_heights = [18, 24, 12]
+  run(dataset, target_height=target_heights)
+  dataset_dir, _ = dataset
+  seg_dir = dataset_dir / '1-0' / 'segments' / 'vid0'
+
+  assert load_manifest(seg_dir)['stages']['resize']['inputs'] == {'target_height': target_heights}
+
+  crop_image_paths = glob_images(seg_dir / 'images' / 'cropped')
+  assert crop_image_paths
+
+  # the fake staffs are 10.5 pixels high
+  for dir_name, target_height in zip(['crop_resized', 'crop_resized_24', 'crop_resized_12'], target_heights):
+    resized_image_paths = glob_images(seg_dir / 'images' / dir_name)
+    assert [ path.stem for path in resized_image_paths ] == [ path.stem for path in crop_image_paths ]
+
+    for crop_image_path, resized_image_path in zip(crop_image_paths, resized_image_paths):
+      crop_h, crop_w = imread(crop_image_path).shape[:2]
+      ratio = target_height / 10.5
+      assert imread(resized_image_path).shape[:2] == (int(crop_h * ratio), int(crop_w * ratio))
@@ -0,0 +1,86 @@
+from pathlib import Path
+import hashlib
+import threading
+import time
+
+import pytest
+
+import ytsv.utils
+from ytsv.utils import YOLO_BACKENDS, export_yolo_model, load_yolo_model
+from ytsv.manifest import get_model_inputs
+from ytsv.model_store import ModelStore
+
+
+class ExportingYOLO:
+  """
+  Stand-in for ultralytics.YOLO whose export writes the artifact next to the checkpoint
+  """
+  exports = []
+
+  def __init__(self, path, task=None):
+    self.path = Path(path)
+
+  def export(self, format, **kwargs):
+    ExportingYOLO.exports.append( (self.path.name, format) )
+    # long enough for parallel exports to overlap
+    time.sleep(0.2)
+
+    if format == 'onnx':
+      exported_path = self.path.with_suffix('.onnx')
+      exported_path.write_bytes(b'onnx:' + self.path.read_bytes())
+    else:
+      exported_path = self.path.with_name(f'{self.path.stem}_openvino_model')
+      exported_path.mkdir()
+      (exported_path / 'model.xml').write_bytes(b'openvino:' + self.path.read_bytes())
+
+    return str(exported_path)
+
+
+@pytest.fixture
+def exporting_yolo(monkeypatch):
+  ExportingYOLO.exports = []
+  monkeypatch.setattr(ytsv.utils, 'YOLO', ExportingYOLO)
+  return ExportingYOLO
+
+
+@pytest.mark.filterwarnings('ignore::ytsv.model_store.UnpinnedChecksumWarning')
+@pytest.mark.parametrize('backend', ['onnx', 'openvino'])
+def test_exported_model_is_recorded_and_reused(tmp_path, exporting_yolo, backend):
+  checkpoint_path = tmp_path / 'model.pt'
+  checkpoint_path.write_bytes(b'weights')
+  store = ModelStore(tmp_path, urls={}, sha256={})
+
+  yolo = load_yolo_model('model.pt', tmp_path, backend=backend, store=store)
+
+  # the manifest identifies the exported model by its backend and source checkpoint
+  assert get_model_inputs(yolo) == {'checkpoint': hashlib.sha256(b'weights').hexdigest(), 'backend': backend}
+  assert yolo.path == tmp_path / YOLO_BACKENDS[backend][1].format(stem='model')
+
+  load_yolo_model('model.pt', tmp_path, backend=backend, store=store)
+  assert len(exporting_yolo.exports) == 1
+
+  # a new checkpoint is exported again and replaces the artifact
+  checkpoint_path.write_bytes(b'new weights')
+  assert export_yolo_model(checkpoint_path, backend) == yolo.path
+  assert len(exporting_yolo.exports) == 2
+
+  artifact_path = yolo.path / 'model.xml' if backend == 'openvino' else yolo.path
+  assert artifact_path.read_bytes().endswith(b'new weights')
+
+  # no temporary files are left next to the checkpoint
+  assert sorted( p.name for p in tmp_path.iterdir() if p.name.endswith(('.tmp', '.old')) ) == []
+
+
+def test_parallel_exports_wait_for_one(tmp_path, exporting_yolo):
+  checkpoint_path = tmp_path / 'model.pt'
+  checkpoint_path.write_bytes(b'weights')
+
+  results = []
+  threads = [ threading.Thread(target=lambda: results.append(export_yolo_model(checkpoint_path, 'onnx'))) for _ in range(4) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert results == [tmp_path / 'model.onnx'] * 4
+  assert len(exporting_yolo.exports) == 1
@@ -0,0 +1,180 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from ytsv.work_queue import WorkQueue, NodeSummary, parse_shard, select_shard, merge_summaries, write_json
+
+
+def make_stale(lease_path, age:float=3600):
+  past = time.time() - age
+  os.utime(lease_path, (past, past))
+
+
+def read_lease(lease_path) -> dict:
+  with open(lease_path, 'r') as f:
+    return json.load(f)
+
+
+def test_claimed_video_is_not_claimed_twice(tmp_path):
+  queue_a = WorkQueue(tmp_path, node_id='a')
+  queue_b = WorkQueue(tmp_path, node_id='b')
+
+  assert queue_a.try_claim('vid0')
+  assert not queue_b.try_claim('vid0')
+  assert read_lease(queue_a.get_lease_path('vid0'))['node'] == 'a'
+
+  queue_a.complete('vid0')
+  assert not queue_a.get_lease_path('vid0').exists()
+  assert not queue_b.try_claim('vid0')
+
+
+def test_stale_lease_is_reclaimed(tmp_path):
+  queue_a = WorkQueue(tmp_path, node_id='a', lease_seconds=60)
+  queue_b = WorkQueue(tmp_path, node_id='b', lease_seconds=60)
+
+  assert queue_a.try_claim('vid0')
+  assert not queue_b.try_claim('vid0')
+
+  make_stale(queue_a.get_lease_path('vid0'))
+  assert queue_b.try_claim('vid0')
+  assert read_lease(queue_b.get_lease_path('vid0'))['node'] == 'b'
+
+
+def test_slow_node_leaves_the_reclaimed_lease_alone(tmp_path):
+  queue_a = WorkQueue(tmp_path, node_id='a', lease_seconds=60)
+  queue_b = WorkQueue(tmp_path, node_id='b', lease_seconds=60)
+  lease_path = queue_a.get_lease_path('vid0')
+
+  assert queue_a.try_claim('vid0')
+  make_stale(lease_path)
+  assert queue_b.try_claim('vid0')
+
+  # a's heartbeat comes back, it must not refresh b's lease
+  make_stale(lease_path, age=30)
+  mtime = lease_path.stat().st_mtime
+  queue_a.renew()
+  assert lease_path.stat().st_mtime == mtime
+  assert 'vid0' not in queue_a.held
+
+  # a finishes late, the result is recorded but b keeps its lease
+  queue_a.complete('vid0')
+  assert lease_path.exists()
+  assert read_lease(lease_path)['node'] == 'b'
+
+  queue_b.renew()
+  assert lease_path.stat().st_mtime > mtime
+
+  queue_b.release('vid0')
+  assert not lease_path.exists()
+  assert list(queue_b.lease_dir.iterdir()) == []
+
+
+def test_idle_node_polls_faster_than_the_heartbeat(tmp_path):
+  queue_a = WorkQueue(tmp_path, node_id='a')
+  queue_b = WorkQueue(tmp_path, node_id='b', poll_seconds=0.05)
+  assert queue_b.heartbeat_seconds == 450
+
+  assert queue_a.try_claim('vid0')
+  claimed = []
+
+  def run_b():
+    for batch in queue_b.iter_batches([['vid0'], ['vid1']]):
+      claimed.extend( row[0] for row in batch )
+      for row in batch:
+        queue_b.complete(row[0])
+
+  thread = threading.Thread(target=run_b, daemon=True)
+  thread.start()
+
+  time.sleep(0.2)
+  queue_a.complete('vid0')
+  thread.join(5)
+
+  assert not thread.is_alive()
+  assert claimed == ['vid1']
+
+
+def test_write_json_uses_a_temp_file_per_writer(tmp_path):
+  path = tmp_path / 'done.json'
+  errors = []
+
+  def write(i):
+    try:
+      for _ in range(50):
+        write_json(path, {'writer': i})
+    except Exception as e:
+      errors.append(e)
+
+  threads = [ threading.Thread(target=write, args=(i,)) for i in range(4) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert errors == []
+  assert json.loads(path.read_text())['writer'] in range(4)
+  assert [ p.name for p in tmp_path.iterdir() ] == ['done.json']
+
+
+def test_shards_partition_the_metadata():
+  metadata = [ [f'vid{i}', str(i)] for i in range(200) ]
+  shards = [ select_shard(metadata, i, 4) for i in range(4) ]
+
+  # every row in exactly one shard, each shard in metadata order
+  assert all( shards )
+  assert sorted( sum(shards, []), key=lambda row: int(row[1]) ) == metadata
+  for shard in shards:
+    assert shard == [ row for row in metadata if row in shard ]
+
+  # a row keeps its shard when other rows are added
+  more = metadata + [ [f'new{i}', '0'] for i in range(50) ]
+  assert [ [ row for row in select_shard(more, i, 4) if row in metadata ] for i in range(4) ] == shards
+
+  # and in another process, with another hash seed
+  code = 'from ytsv.work_queue import select_shard; print([ row[0] for row in select_shard([ [f"vid{i}"] for i in range(200) ], 1, 4) ])'
+  out = subprocess.run([sys.executable, '-c', code], env={**os.environ, 'PYTHONHASHSEED': '123'}, capture_output=True, text=True, check=True).stdout
+  assert out.strip() == str([ row[0] for row in shards[1] ])
+
+
+def test_parse_shard():
+  assert parse_shard('0/1') == (0, 1)
+  assert parse_shard('3/4') == (3, 4)
+
+  for shard in ['4/4', '-1/4', '0/0', '1', '1/2/3', 'a/4', '']:
+    with pytest.raises(ValueError):
+      parse_shard(shard)
+
+
+@pytest.mark.parametrize('slow_node', ['a', 'c'])
+def test_reclaimed_video_counts_once(tmp_path, slow_node):
+  queue_slow = WorkQueue(tmp_path / 'queue', node_id=slow_node, lease_seconds=60)
+  queue_b = WorkQueue(tmp_path / 'queue', node_id='b', lease_seconds=60)
+  summary_slow = NodeSummary(tmp_path / 'summaries' / f'{slow_node}.json', slow_node)
+  summary_b = NodeSummary(tmp_path / 'summaries' / 'b.json', 'b')
+
+  assert queue_slow.try_claim('vid0')
+  assert queue_b.try_claim('vid1')
+  make_stale(queue_slow.get_lease_path('vid0'))
+  assert queue_b.try_claim('vid0')
+
+  # b finishes both videos, the slow node fails vid0 after losing its lease
+  queue_b.complete('vid0')
+  queue_b.complete('vid1', error='download failed')
+  summary_b.add({'vid0': None, 'vid1': 'download failed'})
+  queue_slow.complete('vid0', error='timeout')
+  summary_slow.add({'vid0': 'timeout'})
+  assert read_lease(queue_b.get_done_path('vid0'))['error'] is None
+
+  merged = merge_summaries( list((tmp_path / 'summaries').glob('*.json')) )
+
+  # whatever the order of the node names, the success of b wins
+  assert merged['num_nodes'] == 2
+  assert merged['num_videos'] == 2
+  assert merged['failed'] == ['vid1']
+  assert merged['num_failed'] == 1
+  assert merged['processed_more_than_once'] == {'vid0': sorted([slow_node, 'b'])}
@@ -1,6 +1,8 @@
 import os
 from pathlib import Path
-import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
 
 import csv
 
@@ -10,19 +12,31 @@ from tqdm.auto import tqdm
 from ultralytics import YOLO
 
 from ytsv.slide_utils import extract_pages_and_audios
-from ytsv.system_utils import detect_systems_by_batch, crop_systems, detect_staff_heights_by_batch, resize_systems
-from ytsv.utils import load_yolo_models
+from ytsv.system_utils import detect_page_systems_by_batch, crop_system_images, detect_crop_staffs_by_batch, resize_systems, get_target_heights, get_resize_inputs
+from ytsv.utils import load_yolo_models, get_logger, format_logger_msg
+from ytsv.manifest import STAGES, load_manifest, is_stage_done, get_first_stale_stage, get_stage_outputs, mark_stage_done, get_file_signature, get_model_inputs
+from ytsv.pipeline import process_videos_pipelined
+from ytsv.exclusions import ExclusionList, filter_page_paths
+from ytsv.dedup import PageHashCache, write_aliases, get_extract_signature, get_stale_aliases
+from ytsv.detections import YOLO_SYSTEM, SYSTEM, STAFF, to_detections, split_crop_stem, load_detections, save_detections, group_bboxs
+from ytsv.image_io import IMAGE_SUFFIXES, NO_WRITE_CODEC, find_image_path, glob_images
+from ytsv.metrics import VideoMetrics, MetricsWriter, get_bytes_written
 
 
-def process_single_video(
-  metadata:list[str], 
-  dataset_dir:Path, 
-  yolo_models:list[YOLO], 
-  target_height:int=18, 
-  device:str='cpu'
-):
-  yolo_system, yolo_staff_height = yolo_models
+# keyword arguments of extract_pages_and_audios that do not change its outputs
+# exclude_pages is recorded with the systems stage, so that a changed exclusion
+# list reruns the inference stages without decoding the video again
+EXECUTION_ONLY_KWARGS = {'seek_threshold', 'section_workers', 'on_page', 'exclude_pages'}
+
+
+def get_video_paths(metadata:list[str], dataset_dir:Path) -> tuple[Path, Path]:
+  """
+  Create the output directories of a video and move its mp4 into them.
 
+  :param metadata: row of the metadata file
+  :param dataset_dir: path to the dataset directory
+  :return: (mp4 path, segment directory)
+  """
   yt_id, *_, staff_count = metadata
 
   staff_count_dir = dataset_dir / staff_count
@@ -35,49 +49,744 @@ def process_single_video(
   seg_dir.mkdir(parents=True, exist_ok=True)
 
   mp4_path = mp4_dir / f'{yt_id}.mp4'
-  
+
   default_mp4_path = dataset_dir / 'mp4' / f'{yt_id}.mp4'
   if default_mp4_path.exists():
     mp4_path = default_mp4_path.rename(mp4_path)
-  
-  extract_pages_and_audios( mp4_path, seg_dir )
 
-  page_images = sorted( (seg_dir / 'images' / 'original').glob('*.png') )
-  yolo_bbox_paths = detect_systems_by_batch(page_images, yolo_system, device=device)
-  
-  crop_image_paths = []
-  for yolo_bbox_path in yolo_bbox_paths:
-    crop_image_paths += crop_systems(yolo_bbox_path)
+  return mp4_path, seg_dir
+
+
+def get_stage_inputs(
+  mp4_path:Path, 
+  yolo_models:list[YOLO]=None, 
+  target_height:int|list[int]=18, 
+  extract_kwargs:dict=None,
+  save_crops:bool=True,
+  exclude_pages=None,
+  page_cache:PageHashCache=None,
+  crop_codec:str=None,
+  resized_codec:str=None
+) -> dict:
+  """
+  Inputs of every processing stage as recorded in the manifest, {stage: inputs}.
+  Without yolo_models only the 'extract' inputs are returned. Options that
+  are not set (None) are not recorded, so they keep older manifests valid.
+  """
+  stage_inputs = {
+    'extract': {
+      'mp4': get_file_signature(mp4_path) if mp4_path.exists() else None,
+      'extract_kwargs': { k: v for k, v in (extract_kwargs or {}).items() if k not in EXECUTION_ONLY_KWARGS and v is not None },
+    },
+  }
+
+  if yolo_models:
+    yolo_system, yolo_staff_height = yolo_models
+    systems_inputs = get_model_inputs(yolo_system)
+    # only videos with excluded pages record them, the others keep their manifests
+    if exclude_pages:
+      systems_inputs['exclude_pages'] = sorted(exclude_pages)
+    if page_cache:
+      systems_inputs['dedup'] = page_cache.get_inputs()
+
+    crop_inputs = {'save_crops': save_crops}
+    if crop_codec:
+      crop_inputs['codec'] = crop_codec
+
+    stage_inputs.update({
+      'systems': systems_inputs,
+      'crop': crop_inputs,
+      'staff_heights': get_model_inputs(yolo_staff_height),
+      'resize': get_resize_inputs(target_height, codec=resized_codec),
+    })
+
+  return stage_inputs
+
+
+def get_start_stage(
+  seg_dir:Path, 
+  manifest:dict, 
+  stage_inputs:dict, 
+  save_pages:bool=True, 
+  save_crops:bool=True, 
+  resume:bool=True
+) -> int:
+  """
+  Index in STAGES of the first stage to run for a video.
+  A stage that reads pages or crops which were kept in memory only
+  also reruns the stage that produced them.
+  Aliases of pages of a video that was extracted again since rerun the systems stage.
+  """
+  if not resume:
+    return 0
+
+  start_stage = get_first_stale_stage(seg_dir, manifest, stage_inputs)
+
+  if start_stage > STAGES.index('systems') and get_stale_aliases(seg_dir):
+    start_stage = STAGES.index('systems')
+
+  if not save_crops and STAGES.index('staff_heights') <= start_stage < len(STAGES):
+    start_stage = STAGES.index('crop')
+
+  if not save_pages and STAGES.index('systems') <= start_stage <= STAGES.index('crop'):
+    start_stage = 0
+
+  return start_stage
+
+
+def get_video_start_stage(
+  metadata:list[str], 
+  dataset_dir:Path, 
+  yolo_models:list[YOLO], 
+  target_height:int|list[int]=18, 
+  extract_kwargs:dict=None, 
+  save_crops:bool=True, 
+  resume:bool=True,
+  page_cache:PageHashCache=None,
+  crop_codec:str=None,
+  resized_codec:str=None
+) -> tuple[Path, int]:
+  """
+  :return: (segment directory, index in STAGES of the first stage to run)
+  """
+  mp4_path, seg_dir = get_video_paths(metadata, dataset_dir)
+  stage_inputs = get_stage_inputs(
+    mp4_path, 
+    yolo_models, 
+    target_height=target_height, 
+    extract_kwargs=extract_kwargs, 
+    save_crops=save_crops, 
+    exclude_pages=(extract_kwargs or {}).get('exclude_pages'),
+    page_cache=page_cache,
+    crop_codec=crop_codec,
+    resized_codec=resized_codec
+  )
+  save_pages = (extract_kwargs or {}).get('save_pages', True)
+
+  return seg_dir, get_start_stage(seg_dir, load_manifest(seg_dir), stage_inputs, save_pages=save_pages, save_crops=save_crops, resume=resume)
+
+
+def get_video_extract_kwargs(metadata:list[str], extract_kwargs:dict=None, exclusions:ExclusionList=None) -> dict:
+  """
+  extract_kwargs of one video, with its excluded pages if it has any
+  """
+  exclude_pages = exclusions.get_excluded_pages(metadata[0]) if exclusions else None
+  if not exclude_pages:
+    return extract_kwargs
+
+  return {**(extract_kwargs or {}), 'exclude_pages': sorted(exclude_pages)}
+
+
+def prepare_video(
+  metadata:list[str], 
+  dataset_dir:Path, 
+  extract_kwargs:dict=None, 
+  on_page=None, 
+  resume:bool=True,
+  keep_pages:bool=False,
+  metrics:VideoMetrics=None
+) -> tuple[Path, list]:
+  """
+  Create the output directories of a video and extract its pages and audios.
+  Does not need the YOLO models, so it can run in a worker process.
+
+  :param metadata: row of the metadata file
+  :param dataset_dir: path to the dataset directory
+  :param extract_kwargs: extra keyword arguments for extract_pages_and_audios
+  :param on_page: callback for each extracted page, see extract_pages_and_audios
+  :param resume: if True, skip extraction if the manifest says it is up to date
+  :param keep_pages: if True, also return the extracted pages
+  :param metrics: optional VideoMetrics the extract stage is recorded in
+  :return: (path to the segment directory of the video, [(page image path, page image), ...]),
+    the pages are None unless keep_pages is True and the video was extracted
+  """
+  mp4_path, seg_dir = get_video_paths(metadata, dataset_dir)
+
+  manifest = load_manifest(seg_dir)
+  inputs = get_stage_inputs(mp4_path, extract_kwargs=extract_kwargs)['extract']
+
+  if resume and is_stage_done(seg_dir, manifest, 'extract', inputs):
+    return seg_dir, None
+
+  pages = [] if keep_pages else None
 
-  average_staff_heights = detect_staff_heights_by_batch(crop_image_paths, yolo_staff_height, device=device)
-  resize_systems(crop_image_paths, average_staff_heights, target_height=target_height)
+  def handle_page(page_image_path, frame):
+    if keep_pages:
+      pages.append( (page_image_path, frame) )
+    if on_page:
+      on_page(page_image_path, frame)
+
+  metrics = metrics or VideoMetrics(seg_dir.name)
+  stats = {}
+
+  with metrics.stage('extract') as timer:
+    page_image_paths, audio_paths = extract_pages_and_audios( mp4_path, seg_dir, on_page=handle_page, stats=stats, **(extract_kwargs or {}) )
+    mark_stage_done(seg_dir, manifest, 'extract', inputs, page_image_paths + audio_paths)
+    timer.add(**stats, bytes_written=get_bytes_written(page_image_paths + audio_paths))
+
+  return seg_dir, pages
+
+
+def prepare_video_with_metrics(
+  metadata:list[str], 
+  dataset_dir:Path, 
+  extract_kwargs:dict=None, 
+  keep_pages:bool=False
+) -> tuple[Path, list, dict]:
+  """
+  prepare_video for a worker process, the stages it measured are sent back with its result.
+
+  :return: (path to the segment directory, pages, {stage: metrics})
+  """
+  metrics = VideoMetrics(metadata[0])
+  seg_dir, pages = prepare_video(metadata, dataset_dir, extract_kwargs=extract_kwargs, resume=False, keep_pages=keep_pages, metrics=metrics)
+
+  return seg_dir, pages, metrics.to_dict()['stages']
+
+
+def process_video_pages(
+  seg_dir:Path, 
+  yolo_models:list[YOLO], 
+  target_height:int|list[int]=18, 
+  device:str='cpu', 
+  start_stage:int=1,
+  pages:list=None,
+  save_crops:bool=True,
+  batch_size:int=64,
+  prefetch:int=2,
+  exclude_pages=None,
+  page_cache:PageHashCache=None,
+  crop_codec:str=None,
+  resized_codec:str=None,
+  metrics:VideoMetrics=None,
+  logger=None
+):
+  """
+  Detect, crop and resize the systems of the extracted pages of a video.
+  Pages and crops are handed from stage to stage in memory, the crops
+  are views of the page images.
+
+  :param seg_dir: path to the segment directory of the video
+  :param yolo_models: [system detection model, staff height detection model]
+  :param target_height: target staff height for resizing cropped images, or a list of heights, see resize_systems
+  :param device: device to run YOLO models on
+  :param start_stage: index in STAGES of the first stage to run, the outputs
+    of the stages before it are read from the manifest
+  :param pages: [(page image path, page image), ...] as returned by prepare_video,
+    if None the page images are read from disk
+  :param save_crops: if False, cropped images are not written
+  :param batch_size: batch size for YOLO inference, default is 64
+  :param prefetch: number of batches decoded ahead of YOLO inference, default is 2
+  :param exclude_pages: page numbers that are not passed to the YOLO models
+  :param page_cache: optional PageHashCache, duplicate pages are recorded as aliases instead of being processed,
+    call its finish_video after the video
+  :param crop_codec: codec of the cropped images, see image_io.ImageCodec, default is png
+  :param resized_codec: codec of the resized images, default is png, 'none' writes no resized images
+  :param metrics: optional VideoMetrics the stages are recorded in
+  :param logger: optional logger for skipped and failed crops
+  """
+  yolo_system, yolo_staff_height = yolo_models
+  metrics = metrics or VideoMetrics(seg_dir.name)
+
+  manifest = load_manifest(seg_dir)
+  mp4_path = seg_dir.parent.parent / 'mp4' / f'{seg_dir.name}.mp4'
+  stage_inputs = get_stage_inputs(
+    mp4_path,
+    yolo_models,
+    target_height=target_height,
+    save_crops=save_crops,
+    exclude_pages=exclude_pages,
+    page_cache=page_cache,
+    crop_codec=crop_codec,
+    resized_codec=resized_codec
+  )
+
+  is_done = lambda stage: STAGES.index(stage) < start_stage
+
+  if pages is not None:
+    page_image_paths = [ page_image_path for page_image_path, _ in pages ]
+    page_images = [ page_image for _, page_image in pages ]
+  elif 'extract' in manifest['stages']:
+    page_image_paths = get_stage_outputs(seg_dir, manifest, 'extract', suffix=IMAGE_SUFFIXES, directory='images/original')
+    page_images = None
+  else:
+    page_image_paths = glob_images(seg_dir / 'images' / 'original')
+    page_images = None
+
+  # pages extracted before they were excluded
+  num_excluded = 0
+  if page_images is None:
+    num_extracted = len(page_image_paths)
+    page_image_paths = filter_page_paths(page_image_paths, exclude_pages)
+    num_excluded = num_extracted - len(page_image_paths)
+
+  if is_done('systems'):
+    image_dir = seg_dir / 'images' / 'original'
+    page_bboxs = [
+      (find_image_path(image_dir / f'{page_stem}.png'), bboxs)
+      for page_stem, bboxs in group_bboxs(load_detections(seg_dir), YOLO_SYSTEM, seg_dir.name).items()
+    ]
+  else:
+    with metrics.stage('systems') as timer:
+      aliases = {}
+      if page_cache:
+        extract_signature = get_extract_signature(manifest['stages'].get('extract', {}).get('inputs'))
+        unique, aliases = page_cache.dedup_pages(seg_dir.name, extract_signature, page_image_paths, page_images)
+        page_image_paths = [ page_image_paths[i] for i in unique ]
+        page_images = [ page_images[i] for i in unique ] if page_images is not None else None
+
+      batch_stats = {}
+      page_bboxs = detect_page_systems_by_batch(page_image_paths, yolo_system, batch_size=batch_size, device=device, images=page_images, prefetch=prefetch, stats=batch_stats)
+      detections_path = save_detections(seg_dir, 'systems', [ to_detections(YOLO_SYSTEM, p.stem, bboxs) for p, bboxs in page_bboxs ])
+      aliases_paths = write_aliases(seg_dir, aliases)
+      mark_stage_done(seg_dir, manifest, 'systems', stage_inputs['systems'], [detections_path] + aliases_paths)
+
+      timer.add(
+        pages=len(page_image_paths), 
+        pages_excluded=num_excluded,
+        aliased=len(aliases) if page_cache else None,
+        skipped=len(page_image_paths) - len(page_bboxs), 
+        bytes_written=get_bytes_written([detections_path]),
+        **batch_stats
+      )
+
+  crop_images = None
+
+  if is_done('crop'):
+    crop_image_paths = get_stage_outputs(seg_dir, manifest, 'crop', suffix=IMAGE_SUFFIXES, directory='images/cropped')
+  else:
+    page_images_by_path = dict(pages) if pages is not None else {}
+
+    with metrics.stage('crop') as timer:
+      crop_image_paths = []
+      crop_images = []
+      detections = []
+      for page_image_path, bboxs in page_bboxs:
+        paths, images, system_bboxs = crop_system_images(page_image_path, bboxs, image=page_images_by_path.get(page_image_path), save_crops=save_crops, codec=crop_codec)
+        crop_image_paths += paths
+        crop_images += images
+        detections.append( to_detections(SYSTEM, page_image_path.stem, system_bboxs) )
+
+      detections_path = save_detections(seg_dir, 'crop', detections)
+      saved_crop_paths = crop_image_paths if save_crops else []
+      mark_stage_done(seg_dir, manifest, 'crop', stage_inputs['crop'], saved_crop_paths + [detections_path])
+
+      timer.add(
+        pages=len(page_bboxs), 
+        crops=len(crop_image_paths), 
+        bytes_written=get_bytes_written(saved_crop_paths + [detections_path])
+      )
+
+  if is_done('staff_heights'):
+    average_staff_heights = manifest['stages']['staff_heights']['staff_heights']
+  else:
+    with metrics.stage('staff_heights') as timer:
+      batch_stats = {}
+      average_staff_heights, staff_bboxs = detect_crop_staffs_by_batch(crop_image_paths, yolo_staff_height, batch_size=batch_size, device=device, crop_images=crop_images, prefetch=prefetch, stats=batch_stats)
+
+      detections = []
+      for crop_image_path, bboxs in zip(crop_image_paths, staff_bboxs):
+        page_stem, system = split_crop_stem(crop_image_path.stem)
+        detections.append( to_detections(STAFF, page_stem, bboxs, system=system) )
+
+      detections_path = save_detections(seg_dir, 'staff_heights', detections)
+      mark_stage_done(seg_dir, manifest, 'staff_heights', stage_inputs['staff_heights'], [detections_path], staff_heights=average_staff_heights)
+
+      timer.add(
+        crops=len(crop_image_paths), 
+        skipped=sum( 1 for h in average_staff_heights if not h ), 
+        bytes_written=get_bytes_written([detections_path]),
+        **batch_stats
+      )
+
+  if not is_done('resize'):
+    with metrics.stage('resize') as timer:
+      resized_image_paths = resize_systems(crop_image_paths, average_staff_heights, target_height=target_height, crop_images=crop_images, logger=logger, codec=resized_codec)
+      mark_stage_done(seg_dir, manifest, 'resize', stage_inputs['resize'], resized_image_paths)
+
+      num_skipped = sum( 1 for h in average_staff_heights if not h )
+      # the none codec writes no levels
+      num_levels = len(get_target_heights(target_height)) if resized_codec != NO_WRITE_CODEC else 0
+      timer.add(
+        crops=len(crop_image_paths), 
+        resized=len(resized_image_paths), 
+        skipped=num_skipped, 
+        failed_writes=(len(crop_image_paths) - num_skipped) * num_levels - len(resized_image_paths), 
+        bytes_written=get_bytes_written(resized_image_paths)
+      )
+
+
+def process_single_video(
+  metadata:list[str], 
+  dataset_dir:Path, 
+  yolo_models:list[YOLO], 
+  target_height:int|list[int]=18, 
+  device:str='cpu', 
+  extract_kwargs:dict=None, 
+  save_crops:bool=True,
+  batch_size:int=64,
+  prefetch:int=2,
+  resume:bool=True,
+  exclusions:ExclusionList=None,
+  page_cache:PageHashCache=None,
+  crop_codec:str=None,
+  resized_codec:str=None,
+  metrics:VideoMetrics=None,
+  logger=None
+):
+  """
+  :param metadata: row of the metadata file
+  :param dataset_dir: path to the dataset directory
+  :param yolo_models: [system detection model, staff height detection model]
+  :param target_height: target staff height for resizing cropped images, or a list of heights, see resize_systems
+  :param device: device to run YOLO models on
+  :param extract_kwargs: extra keyword arguments for extract_pages_and_audios
+  :param save_crops: if False, cropped images are not written
+  :param batch_size: batch size for YOLO inference, default is 64
+  :param prefetch: number of batches decoded ahead of YOLO inference, default is 2
+  :param resume: if True, resume at the first stage that is not up to date in the manifest
+  :param exclusions: optional ExclusionList, its excluded pages of the video are not decoded
+  :param page_cache: optional PageHashCache, duplicate pages are recorded as aliases instead of being processed
+  :param crop_codec: codec of the cropped images, see image_io.ImageCodec, default is png
+  :param resized_codec: codec of the resized images, default is png, 'none' writes no resized images
+  :param metrics: optional VideoMetrics the stages are recorded in
+  :param logger: optional logger for skipped and failed crops
+  """
+  extract_kwargs = get_video_extract_kwargs(metadata, extract_kwargs, exclusions)
+
+  seg_dir, start_stage = get_video_start_stage(
+    metadata, 
+    dataset_dir, 
+    yolo_models, 
+    target_height=target_height, 
+    extract_kwargs=extract_kwargs, 
+    save_crops=save_crops, 
+    resume=resume,
+    page_cache=page_cache,
+    crop_codec=crop_codec,
+    resized_codec=resized_codec
+  )
+
+  pages = None
+  if start_stage == 0:
+    seg_dir, pages = prepare_video(metadata, dataset_dir, extract_kwargs=extract_kwargs, resume=False, keep_pages=True, metrics=metrics)
+
+  completed = False
+  try:
+    process_video_pages(
+      seg_dir, 
+      yolo_models, 
+      target_height=target_height, 
+      device=device, 
+      start_stage=max(start_stage, 1), 
+      pages=pages, 
+      save_crops=save_crops,
+      batch_size=batch_size,
+      prefetch=prefetch,
+      exclude_pages=(extract_kwargs or {}).get('exclude_pages'),
+      page_cache=page_cache,
+      crop_codec=crop_codec,
+      resized_codec=resized_codec,
+      metrics=metrics,
+      logger=logger
+    )
+    completed = True
+  finally:
+    if page_cache:
+      page_cache.finish_video(metadata[0], completed=completed)
+
+
+def init_worker():
+  # one decoding thread per worker, the pool itself provides the parallelism
+  cv2.setNumThreads(1)
 
 
 def process_videos_from_scratch(
   dataset_dir:Path, 
   metaddata_path:Path, 
   checkpoint_dir:Path, 
-  target_height:int=18, 
-  device:str='cpu'
+  target_height:int|list[int]=18, 
+  device:str='cpu', 
+  extract_kwargs:dict=None, 
+  workers:int=1, 
+  pipeline:bool=False, 
+  queue_size:int=256, 
+  batch_size:int=64,
+  batch_timeout:float=0.5,
+  prefetch:int=2,
+  save_crops:bool=True,
+  resume:bool=True,
+  backend:str='pytorch',
+  calibration_data:str=None,
+  model_cache_dir:Path=None,
+  offline:bool=False,
+  metrics_path:Path=None,
+  prometheus_path:Path=None,
+  shard:tuple[int, int]=None,
+  work_queue_dir:Path=None,
+  node_id:str=None,
+  lease_seconds:float=1800,
+  summary_dir:Path=None,
+  exclusions:bool=False,
+  exclusion_list_path:Path=None,
+  dedup_pages:bool=False,
+  dedup_across_videos:bool=False,
+  crop_codec:str=None,
+  resized_codec:str=None
 ):
   """
   :param dataset_dir: path to the dataset directory
   :param metaddata_path: path to the metadata file
   :param checkpoint_dir: path to the YOLO model weights for staff height detection
+  :param target_height: target staff height for resizing cropped images, or a list of heights that are
+    resized from the same crops, the first to crop_resized and the others to crop_resized_<height>
+  :param extract_kwargs: extra keyword arguments for extract_pages_and_audios
+  :param workers: number of processes for page and audio extraction,
+    YOLO inference, cropping and resizing stay in this process, default is 1
+  :param pipeline: if True, run the stages as a streaming pipeline (see ytsv.pipeline),
+    workers is then the number of decoding threads
+  :param queue_size: maximum number of items waiting between two pipeline stages
+  :param batch_size: batch size for YOLO inference, default is 64
+  :param batch_timeout: seconds a partial YOLO batch of the pipeline waits for pages or crops
+    of other videos, if 0 every video is batched separately, default is 0.5
+  :param prefetch: number of batches decoded ahead of YOLO inference, default is 2
+  :param save_crops: if False, cropped images are only kept in memory until they are resized
+  :param resume: if True, skip the stages of each video that are up to date in its manifest
+  :param backend: inference backend of the YOLO models, 'pytorch' or one of utils.YOLO_BACKENDS
+  :param calibration_data: dataset yaml for INT8 calibration of the 'openvino-int8' backend
+  :param model_cache_dir: model store shared by checkpoint directories, see ytsv.model_store
+  :param offline: if True, never download checkpoints, they must be in the model store
+  :param metrics_path: JSONL file the stage metrics of every video are appended to,
+    default is <dataset_dir>/metrics.jsonl
+  :param prometheus_path: optional Prometheus text file with the metric totals of this run
+  :param shard: (i, N) to process only shard i of N of the metadata file, see ytsv.work_queue
+  :param work_queue_dir: if given, claim videos from this work queue shared with other nodes
+  :param node_id: name of this node in the work queue and its summary, default is <hostname>-<pid>
+  :param lease_seconds: seconds without heartbeat after which other nodes reclaim a video of this node
+  :param summary_dir: directory of the per-node result summaries, default is <dataset_dir>/summaries
+  :param exclusions: if True, skip the videos and pages of ytsv.exclusion_list before decoding them,
+    default is False, which processes every video of the metadata file
+  :param exclusion_list_path: optional JSON file with more exclusions, see ytsv.exclusions,
+    turns on exclusions
+  :param dedup_pages: if True, pages that repeat an earlier page of the video are recorded as aliases
+    of it instead of being detected, cropped and resized again, see ytsv.dedup
+  :param dedup_across_videos: if True, also alias pages of earlier videos, their hashes are kept in
+    <dataset_dir>/page_hashes.jsonl
+  :param crop_codec: codec of the cropped images, see image_io.ImageCodec, default is png
+  :param resized_codec: codec of the resized images, default is png, 'none' writes no resized images
   """
 
+  # not at module level, python -m ytsv.work_queue would import it twice
+  from ytsv.work_queue import WorkQueue, NodeSummary, select_shard, get_default_node_id
+
   with open(metaddata_path, 'r') as f:
     reader = csv.reader(f)
     header = next(reader)
     metadata = list(reader)
-  
-  yolo_models = load_yolo_models(checkpoint_dir)
-
-  for row in tqdm(metadata):
-    process_single_video(
-      row, 
-      dataset_dir, 
-      yolo_models,
-      target_height=target_height,
-      device=device
-    )
\ No newline at end of file
+
+  if shard is not None:
+    metadata = select_shard(metadata, *shard)
+
+  logger = get_logger(dataset_dir / 'ytsv.log')
+
+  exclusion_list = ExclusionList.load(exclusion_list_path) if exclusions or exclusion_list_path else None
+  if exclusion_list:
+    metadata, excluded = exclusion_list.filter_metadata(metadata)
+    if excluded:
+      logger.info(format_logger_msg('exclusions', {'excluded_videos': ' '.join( row[0] for row in excluded )}))
+
+  metrics_writer = MetricsWriter(metrics_path or dataset_dir / 'metrics.jsonl', prometheus_path)
+
+  page_cache = None
+  if dedup_pages or dedup_across_videos:
+    page_cache = PageHashCache(dataset_dir, index_path=dataset_dir / 'page_hashes.jsonl' if dedup_across_videos else None)
+
+  yolo_models = load_yolo_models(checkpoint_dir, backend=backend, calibration_data=calibration_data, cache_dir=model_cache_dir, offline=offline)
+
+  # pages that are not written to disk are sent back from the workers
+  keep_pages = not (extract_kwargs or {}).get('save_pages', True)
+
+  def process_pages(row, seg_dir, start_stage, pages=None, metrics=None):
+    metrics = metrics or VideoMetrics(row[0])
+    try:
+      process_video_pages(
+        seg_dir,
+        yolo_models,
+        target_height=target_height,
+        device=device,
+        start_stage=start_stage,
+        pages=pages,
+        save_crops=save_crops,
+        batch_size=batch_size,
+        prefetch=prefetch,
+        exclude_pages=exclusion_list.get_excluded_pages(row[0]) if exclusion_list else None,
+        page_cache=page_cache,
+        crop_codec=crop_codec,
+        resized_codec=resized_codec,
+        metrics=metrics,
+        logger=logger
+      )
+    except Exception as e:
+      metrics.error = repr(e)
+      logger.exception(format_logger_msg('process_video_pages', {'yt_id': row[0], 'error': repr(e)}))
+
+    if page_cache:
+      page_cache.finish_video(row[0], completed=metrics.error is None)
+
+    metrics_writer.write(metrics)
+    return metrics.error
+
+  def process_rows(rows, executor=None) -> dict:
+    """
+    :return: {yt_id: error or None} of the rows
+    """
+    if pipeline:
+      failed = process_videos_pipelined(
+        rows,
+        dataset_dir,
+        yolo_models,
+        target_height=target_height,
+        device=device,
+        extract_kwargs=extract_kwargs,
+        batch_size=batch_size,
+        queue_size=queue_size,
+        decode_threads=max(1, workers),
+        batch_timeout=batch_timeout,
+        save_crops=save_crops,
+        resume=resume,
+        exclusions=exclusion_list,
+        page_cache=page_cache,
+        crop_codec=crop_codec,
+        resized_codec=resized_codec,
+        metrics_writer=metrics_writer,
+        logger=logger
+      )
+      return { row[0]: 'failed, see ytsv.log' if row[0] in failed else None for row in rows }
+
+    results = {}
+
+    if executor is None:
+      for row in tqdm(rows):
+        metrics = VideoMetrics(row[0])
+        try:
+          process_single_video(
+            row,
+            dataset_dir,
+            yolo_models,
+            target_height=target_height,
+            device=device,
+            extract_kwargs=extract_kwargs,
+            save_crops=save_crops,
+            batch_size=batch_size,
+            prefetch=prefetch,
+            resume=resume,
+            exclusions=exclusion_list,
+            page_cache=page_cache,
+            crop_codec=crop_codec,
+            resized_codec=resized_codec,
+            metrics=metrics,
+            logger=logger
+          )
+        except Exception as e:
+          metrics.error = repr(e)
+          logger.exception(format_logger_msg('process_single_video', {'yt_id': row[0], 'error': repr(e)}))
+
+        metrics_writer.write(metrics)
+        results[row[0]] = metrics.error
+
+      return results
+
+    to_extract = []
+    resumed = []
+
+    for row in rows:
+      video_extract_kwargs = get_video_extract_kwargs(row, extract_kwargs, exclusion_list)
+      try:
+        seg_dir, start_stage = get_video_start_stage(row, dataset_dir, yolo_models, target_height, video_extract_kwargs, save_crops, resume, page_cache, crop_codec, resized_codec)
+      except Exception as e:
+        results[row[0]] = repr(e)
+        logger.exception(format_logger_msg('get_video_start_stage', {'yt_id': row[0], 'error': repr(e)}))
+        continue
+
+      if start_stage == 0:
+        to_extract.append( (row, video_extract_kwargs) )
+      else:
+        resumed.append( (row, seg_dir, start_stage) )
+
+    # the results hold the pages of a video if they are not saved, so only a few videos are
+    # submitted at a time, more as their results are consumed
+    max_in_flight = 2 * workers
+    futures = {}
+
+    def submit_videos():
+      while to_extract and len(futures) < max_in_flight:
+        row, video_extract_kwargs = to_extract.pop(0)
+        futures[executor.submit(prepare_video_with_metrics, row, dataset_dir, video_extract_kwargs, keep_pages)] = row
+
+    submit_videos()
+    pbar = tqdm(total=len(futures) + len(to_extract) + len(resumed))
+
+    # the workers extract pages meanwhile
+    for row, seg_dir, start_stage in resumed:
+      results[row[0]] = None
+      if start_stage < len(STAGES):
+        results[row[0]] = process_pages(row, seg_dir, start_stage)
+      pbar.update(1)
+
+    while futures:
+      done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+      for future in done:
+        row = futures.pop(future)
+        # the workers go on with the next videos while the pages of this one are processed
+        submit_videos()
+        pbar.update(1)
+
+        metrics = VideoMetrics(row[0])
+        try:
+          seg_dir, pages, stages = future.result()
+        except Exception as e:
+          metrics.error = repr(e)
+          metrics_writer.write(metrics)
+          results[row[0]] = metrics.error
+          logger.exception(format_logger_msg('prepare_video', {'yt_id': row[0], 'error': repr(e)}))
+          continue
+
+        metrics.update(stages)
+        results[row[0]] = process_pages(row, seg_dir, 1, pages, metrics)
+
+    pbar.close()
+    return results
+
+  node_id = node_id or get_default_node_id()
+  summary = NodeSummary(Path(summary_dir or dataset_dir / 'summaries') / f'{node_id}.json', node_id, shard=shard)
+  summary.write()
+
+  with ExitStack() as stack:
+    executor = None
+    if workers > 1 and not pipeline:
+      # spawn, since forking a process that already initialized torch is unsafe
+      executor = stack.enter_context(ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker
+      ))
+
+    if work_queue_dir is None:
+      summary.add(process_rows(metadata, executor))
+      return
+
+    work_queue = stack.enter_context(WorkQueue(work_queue_dir, node_id=node_id, lease_seconds=lease_seconds, logger=logger))
+
+    # few videos per claim, so that idle nodes still find work at the end of the list
+    claim_size = 1
+    if pipeline:
+      claim_size = 4 * max(1, workers)
+    elif executor is not None:
+      claim_size = 2 * workers
+
+    for rows in work_queue.iter_batches(metadata, batch_size=claim_size):
+      results = process_rows(rows, executor)
+      for yt_id, error in results.items():
+        work_queue.complete(yt_id, error)
+      summary.add(results)
@@ -2,6 +2,12 @@ from pathlib import Path
 import argparse
 
 from . import process_videos_from_scratch
+from .shards import export_shards
+from .utils import YOLO_BACKENDS
+from .work_queue import parse_shard
+from .retarget import retarget_videos
+from .detections import export_dataset_text_sidecars
+from .image_io import parse_codec, parse_resized_codec
 
 def create_argparser():
   parser = argparse.ArgumentParser(
@@ -12,9 +18,45 @@ def create_argparser():
   parser.add_argument('-d', '--dataset-dir', type=str, required=True, help='Path to dataset directory')
   parser.add_argument('-m', '--metadata-path', type=str, required=True, help='Path to list of video metadata in .cmsv format')
   parser.add_argument('-c', '--checkpoint-dir', type=str, default='checkpoints', help='Path to YOLO model checkpoints directory')
+  parser.add_argument('--model-cache-dir', type=str, default=None, help='Model store shared by checkpoint directories and runs, default is $YTSV_MODEL_CACHE or the checkpoint directory')
+  parser.add_argument('--offline', action='store_true', help='Never download checkpoints, they must already be in the model store (also YTSV_OFFLINE=1)')
   
-  parser.add_argument('--target-height', type=int, default=18, help='Target staff height for resizing cropped images, default is 18')
+  parser.add_argument('--target-height', type=int, nargs='+', default=[18], metavar='HEIGHT', help='Target staff heights for resizing cropped images, all are resized from the same crops, the first is written to crop_resized, the others to crop_resized_<height>, default is 18')
   parser.add_argument('--device', type=str, required=False, default='cpu', help='Device to run YOLO models on, e.g., "cpu" or "cuda"')
+  parser.add_argument('--backend', type=str, default='pytorch', choices=['pytorch', *YOLO_BACKENDS], help='Inference backend of the YOLO models, exported models are cached next to the checkpoints, default is pytorch')
+  parser.add_argument('--calibration-data', type=str, default=None, help='Dataset yaml for INT8 calibration of the openvino-int8 backend')
+
+  parser.add_argument('--sparse-sections', action='store_true', help='Detect slide transitions on sampled thumbnails instead of every decoded frame')
+  parser.add_argument('--refine-sections', action='store_true', help='Refine sparse section boundaries to the exact transition frame')
+  parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes extracting pages and audios of different videos, default is 1')
+  parser.add_argument('--no-resume', action='store_true', help='Rerun every stage even if the manifest of a video says it is up to date')
+  parser.add_argument('--pipeline', action='store_true', help='Stream pages through decode, YOLO, crop and resize stages running concurrently')
+  parser.add_argument('--batch-size', type=int, default=64, help='Batch size for YOLO inference, default is 64')
+  parser.add_argument('--batch-timeout', type=float, default=0.5, help='Seconds a partial YOLO batch of the pipeline waits for pages or crops of other videos, 0 batches every video separately, default is 0.5')
+  parser.add_argument('--prefetch', type=int, default=2, help='Number of YOLO batches decoded on loader threads ahead of inference, 0 disables prefetching, default is 2')
+  parser.add_argument('--queue-size', type=int, default=256, help='Maximum number of pages or crops waiting between two pipeline stages, default is 256')
+  parser.add_argument('--no-save-pages', action='store_true', help='Do not write page images, pages are passed to system detection and cropping in memory')
+  parser.add_argument('--no-save-crops', action='store_true', help='Do not write cropped images, crops are passed to staff height detection and resizing in memory')
+  parser.add_argument('--page-codec', type=parse_codec, default=None, help='Codec of the page images: png, png:<0-9> (zlib level), webp (lossless) or npy (raw array), default is png')
+  parser.add_argument('--crop-codec', type=parse_codec, default=None, help='Codec of the cropped images, as --page-codec, default is png')
+  parser.add_argument('--resized-codec', type=parse_resized_codec, default=None, help='Codec of the resized images, also of --retarget, as --page-codec or none to write no resized images (e.g. to write them later with --retarget), default is png')
+  parser.add_argument('--single-audio-file', action='store_true', help='Write one audio file per video with an index of page offsets instead of one audio file per page')
+  parser.add_argument('--tar-dir', type=str, default=None, help='If given, pack the processed videos into tar files (webdataset shards) with an index in this directory')
+  parser.add_argument('--pages-per-tar', type=int, default=None, help='Number of pages per tar file, by default every video is one tar file')
+  parser.add_argument('--metrics-path', type=str, default=None, help='JSONL file the per-stage metrics of every video are appended to, default is <dataset-dir>/metrics.jsonl')
+  parser.add_argument('--prometheus-path', type=str, default=None, help='If given, keep a Prometheus text file with the metric totals of the run, e.g. in the textfile collector directory of node_exporter')
+  parser.add_argument('--shard', type=str, default=None, help='Process only shard i of N of the metadata file, given as i/N, shards are assigned by a stable hash of the video id')
+  parser.add_argument('--work-queue-dir', type=str, default=None, help='If given, claim videos from a work queue in this directory, shared with other nodes on the same filesystem')
+  parser.add_argument('--node-id', type=str, default=None, help='Name of this node in the work queue and its summary, default is <hostname>-<pid>')
+  parser.add_argument('--lease-seconds', type=float, default=1800, help='Seconds without heartbeat after which other nodes reclaim a video claimed by this node, default is 1800')
+  parser.add_argument('--summary-dir', type=str, default=None, help='Directory of the per-node result summaries, default is <dataset-dir>/summaries')
+  parser.add_argument('--exclusions', action='store_true', help='Skip the videos and pages of ytsv/exclusion_list.py before decoding them, off by default')
+  parser.add_argument('--exclusion-list', type=str, default=None, help='JSON file with more composers, videos and pages to exclude, see ytsv.exclusions, implies --exclusions')
+  parser.add_argument('--dedup-pages', action='store_true', help='Record pages that repeat an earlier page of the video as aliases of it instead of detecting, cropping and resizing them again')
+  parser.add_argument('--dedup-across-videos', action='store_true', help='Also alias pages of earlier videos, their hashes are kept in <dataset-dir>/page_hashes.jsonl')
+  parser.add_argument('--retarget', type=int, nargs='+', default=None, metavar='HEIGHT', help='Only rebuild the resized crops of processed videos for these target heights from the stored boxes and staff heights, without decoding or YOLO, the first height is written to crop_resized, the others to crop_resized_<height>')
+  parser.add_argument('--export-bbox-text', action='store_true', help='After processing, also write the boxes of every video as the text files <page>_yolo_bboxs.txt, <page>_system_bboxs.txt and <crop>_staff_heights.txt')
+  parser.add_argument('--section-workers', type=int, default=1, help='Number of processes that detect sections on chunks of one video, default is 1')
 
   return parser
 
@@ -23,11 +65,59 @@ if __name__ == '__main__':
   parser = create_argparser()
   
   args = parser.parse_args()
-  
+
+  if args.retarget:
+    retarget_videos(Path(args.dataset_dir), Path(args.metadata_path), args.retarget, workers=args.workers, codec=args.resized_codec)
+    raise SystemExit
+
   process_videos_from_scratch(
     dataset_dir=Path(args.dataset_dir),
     metaddata_path=Path(args.metadata_path),
-    checkpoint_dir=Path.cwd() / 'checkpoints',
+    checkpoint_dir=Path(args.checkpoint_dir),
     target_height=args.target_height,
-    device=args.device
-  )
\ No newline at end of file
+    device=args.device,
+    extract_kwargs={
+      'sparse_sections': args.sparse_sections,
+      'refine_sections': args.refine_sections,
+      'section_workers': args.section_workers,
+      'save_pages': not args.no_save_pages,
+      'page_codec': args.page_codec,
+      'single_audio_file': args.single_audio_file,
+    },
+    workers=args.workers,
+    pipeline=args.pipeline,
+    queue_size=args.queue_size,
+    batch_size=args.batch_size,
+    batch_timeout=args.batch_timeout,
+    prefetch=args.prefetch,
+    save_crops=not args.no_save_crops,
+    resume=not args.no_resume,
+    backend=args.backend,
+    calibration_data=args.calibration_data,
+    model_cache_dir=Path(args.model_cache_dir) if args.model_cache_dir else None,
+    offline=args.offline,
+    metrics_path=Path(args.metrics_path) if args.metrics_path else None,
+    prometheus_path=Path(args.prometheus_path) if args.prometheus_path else None,
+    shard=parse_shard(args.shard) if args.shard else None,
+    work_queue_dir=Path(args.work_queue_dir) if args.work_queue_dir else None,
+    node_id=args.node_id,
+    lease_seconds=args.lease_seconds,
+    summary_dir=Path(args.summary_dir) if args.summary_dir else None,
+    exclusions=args.exclusions,
+    exclusion_list_path=Path(args.exclusion_list) if args.exclusion_list else None,
+    dedup_pages=args.dedup_pages,
+    dedup_across_videos=args.dedup_across_videos,
+    crop_codec=args.crop_codec,
+    resized_codec=args.resized_codec
+  )
+
+  if args.export_bbox_text:
+    export_dataset_text_sidecars(Path(args.dataset_dir), Path(args.metadata_path))
+
+  if args.tar_dir:
+    export_shards(
+      dataset_dir=Path(args.dataset_dir),
+      metadata_path=Path(args.metadata_path),
+      out_dir=Path(args.tar_dir),
+      pages_per_shard=args.pages_per_tar
+    )
@@ -0,0 +1,630 @@
+"""
+Loudness envelope of a whole soundtrack for silence detection.
+
+The energy (squared samples summed over the channels) of the track is kept
+as int64 sums over 1 ms buckets, with the bucket edges on the same frames
+pydub uses for millisecond positions, and their prefix sums: 8 bytes per
+millisecond instead of the samples themselves. The energy of a frame range
+is then a difference of two prefix sums plus the frames of the two
+boundary buckets before the range edges. Those partial sums are taken while
+the samples stream past, for the frames watched in advance (the windows the
+silence trimming measures) and for the last frames of the track, so they
+equal the sums audioop.rms computes and the non-silent ratio of a page
+costs a few array lookups instead of slicing an AudioSegment and scanning
+it with pydub.silence.
+
+The soundtrack itself is streamed from ffmpeg as raw PCM blocks once. The
+same pass builds the envelope and writes a segment for every page found in
+the video (AudioSegmentWriter), and the segments of the pages that survive
+the silence trimming are cut to length afterwards (truncate_wav), so no
+full-length wav is written and only the envelope grows with the length of
+the video.
+
+Alternatively the whole track is kept as one wav file per video next to an
+index of the frame range of every page, see AudioTrackReader.
+"""
+
+from pathlib import Path
+import io
+import subprocess
+import wave
+
+import numpy as np
+
+from moviepy.config import get_setting
+
+
+# frame ranges of the pages in a single audio file per video
+SEGMENT_INDEX_DTYPE = np.dtype([
+  ('page', np.int32),
+  ('start_frame', np.int64),
+  ('end_frame', np.int64), # may lie past the end of the track, the rest is silence
+  ('start_time', np.float64),
+  ('end_time', np.float64),
+])
+
+
+def get_audio_track_paths(audio_dir:Path, video_id:str) -> tuple[Path, Path]:
+  """
+  :return: (wav file of the whole track, segment index) of a video
+  """
+  return audio_dir / f'{video_id}.wav', audio_dir / f'{video_id}_segments.npy'
+
+
+def get_segment_name(video_id:str, page:int, start_time:float, end_time:float) -> str:
+  """
+  File name of the audio segment of a page
+  """
+  return f'{video_id}:{str(page).zfill(4)}:{start_time}:{end_time}.wav'
+
+
+def open_wav_writer(wav_path, frame_rate:int=44100, channels:int=2):
+  """
+  :param wav_path: path or writable file object
+  """
+  wav = wave.open(wav_path if hasattr(wav_path, 'write') else str(wav_path), 'wb')
+  wav.setnchannels(channels)
+  wav.setsampwidth(2)
+  wav.setframerate(frame_rate)
+  return wav
+
+
+def get_wav_data_offset(wav_path:Path) -> int:
+  """
+  Byte offset of the samples in a wav file
+  """
+  with open(wav_path, 'rb') as f:
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+      raise ValueError(f'{wav_path} is not a wav file')
+
+    while True:
+      chunk_header = f.read(8)
+      if len(chunk_header) < 8:
+        raise ValueError(f'{wav_path} has no data chunk')
+
+      chunk_id, chunk_size = chunk_header[:4], int.from_bytes(chunk_header[4:], 'little')
+      if chunk_id == b'data':
+        return f.tell()
+
+      # chunks are padded to an even size
+      f.seek(chunk_size + (chunk_size & 1), 1)
+
+
+class AudioTrackReader:
+  def __init__(self, wav_path:Path, index_path:Path=None):
+    """
+    Pages of a single audio file per video as views of a memory-mapped file.
+
+    :param wav_path: wav file of the whole track
+    :param index_path: segment index, by default <wav stem>_segments.npy next to wav_path
+    """
+    wav_path = Path(wav_path)
+    if index_path is None:
+      index_path = wav_path.with_name(f'{wav_path.stem}_segments.npy')
+
+    with wave.open(str(wav_path), 'rb') as wav:
+      if wav.getsampwidth() != 2:
+        raise ValueError(f'{wav_path} is not 16 bit PCM')
+
+      self.frame_rate = wav.getframerate()
+      self.channels = wav.getnchannels()
+      num_frames = wav.getnframes()
+
+    self.video_id = wav_path.stem
+    self.index = np.load(index_path)
+
+    self.samples = np.memmap(
+      wav_path, 
+      dtype='<i2', 
+      mode='r', 
+      offset=get_wav_data_offset(wav_path), 
+      shape=(num_frames, self.channels)
+    )
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, i:int) -> np.ndarray:
+    """
+    :return: int16 samples of the i-th page, shape (frames, channels), a view of the file
+    """
+    entry = self.index[i]
+    return self.samples[entry['start_frame']:min(entry['end_frame'], len(self.samples))]
+
+  def get_segment_name(self, i:int) -> str:
+    entry = self.index[i]
+    return get_segment_name(self.video_id, int(entry['page']), float(entry['start_time']), float(entry['end_time']))
+
+  def get_segment_bytes(self, i:int) -> bytes:
+    """
+    The i-th page as the wav file extract_pages_and_audios writes per page
+    """
+    entry = self.index[i]
+    segment = self[i]
+
+    f = io.BytesIO()
+    with open_wav_writer(f, self.frame_rate, self.channels) as wav:
+      wav.writeframesraw(segment.tobytes())
+
+      num_missing = int(entry['end_frame'] - entry['start_frame']) - len(segment)
+      if num_missing > 0:
+        wav.writeframesraw( bytes(num_missing * self.channels * 2) )
+
+    return f.getvalue()
+
+  def export_segment(self, i:int, out_dir:Path) -> Path:
+    segment_path = Path(out_dir) / self.get_segment_name(i)
+    segment_path.write_bytes( self.get_segment_bytes(i) )
+
+    return segment_path
+
+  def export_segments(self, out_dir:Path) -> list[Path]:
+    return [ self.export_segment(i, out_dir) for i in range(len(self)) ]
+
+
+def iter_pcm_blocks(
+  video_path:Path, 
+  frame_rate:int=44100, 
+  channels:int=2, 
+  block_frames:int=1<<16
+):
+  """
+  Decode the audio track of a video with ffmpeg and yield it in blocks.
+
+  :param video_path: path to the video file
+  :param frame_rate: sample rate to resample to
+  :param channels: number of channels to mix to
+  :param block_frames: frames per yielded block
+  :return: generator of int16 arrays of shape (frames, channels)
+  """
+  cmd = [
+    get_setting('FFMPEG_BINARY'),
+    '-i', str(video_path), '-vn',
+    '-loglevel', 'error',
+    '-f', 's16le',
+    '-acodec', 'pcm_s16le',
+    '-ar', str(frame_rate),
+    '-ac', str(channels),
+    '-'
+  ]
+
+  block_bytes = block_frames * channels * 2
+
+  with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL) as proc:
+    try:
+      while True:
+        data = proc.stdout.read(block_bytes)
+        if not data:
+          break
+
+        # a block always holds whole frames, ffmpeg writes them in order
+        yield np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+    finally:
+      proc.stdout.close()
+      error = proc.stderr.read().decode(errors='replace')
+      proc.wait()
+
+    if proc.returncode != 0:
+      raise OSError(f'ffmpeg failed to decode the audio of {video_path}: {error.strip()}')
+
+
+class AudioSegmentWriter:
+  def __init__(
+    self, 
+    segments:list[tuple[int, int, Path]], 
+    frame_rate:int=44100, 
+    channels:int=2
+  ):
+    """
+    Write frame ranges of a streamed audio track as wav files. Ranges may
+    overlap, frames past the end of the track are written as silence when
+    the writer is closed.
+
+    :param segments: [(start_frame, end_frame, wav_path), ...]
+    :param frame_rate: sample rate of the written files
+    :param channels: number of channels of the written files
+    """
+    self.frame_rate = frame_rate
+    self.channels = channels
+
+    self.pending = sorted(segments, key=lambda segment: segment[0])
+    self.active = [] # [(start_frame, end_frame, wave writer), ...]
+    self.num_frames = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def add_samples(self, block:np.ndarray):
+    """
+    :param block: next int16 samples of the track, shape (frames, channels)
+    """
+    block_start, block_end = self.num_frames, self.num_frames + len(block)
+
+    while self.pending and self.pending[0][0] < block_end:
+      start_frame, end_frame, wav_path = self.pending.pop(0)
+      self.active.append( (start_frame, end_frame, open_wav_writer(wav_path, self.frame_rate, self.channels)) )
+
+    still_active = []
+    for start_frame, end_frame, wav in self.active:
+      lo, hi = max(start_frame, block_start), min(end_frame, block_end)
+      if lo < hi:
+        wav.writeframesraw( block[lo-block_start:hi-block_start].tobytes() )
+
+      if end_frame <= block_end:
+        wav.close()
+      else:
+        still_active.append( (start_frame, end_frame, wav) )
+
+    self.active = still_active
+    self.num_frames = block_end
+
+  def close(self):
+    # segments that reach past the end of the track
+    for start_frame, end_frame, wav_path in self.pending:
+      self.active.append( (start_frame, end_frame, open_wav_writer(wav_path, self.frame_rate, self.channels)) )
+    self.pending = []
+
+    try:
+      for start_frame, end_frame, wav in self.active:
+        num_missing = end_frame - max(start_frame, self.num_frames)
+        if num_missing > 0:
+          wav.writeframesraw( bytes(num_missing * self.channels * 2) )
+        wav.close()
+      self.active = []
+    finally:
+      self.abort()
+
+  def abort(self):
+    """
+    Close the open files without completing them
+    """
+    for _, _, wav in self.active:
+      wav.close()
+    self.active = []
+
+
+def write_audio_segments(
+  video_path:Path, 
+  segments:list[tuple[int, int, Path]], 
+  frame_rate:int=44100, 
+  channels:int=2
+):
+  """
+  Write frame ranges of the audio track of a video as wav files in one
+  decoding pass, see AudioSegmentWriter.
+
+  :param video_path: path to the video file
+  :param segments: [(start_frame, end_frame, wav_path), ...]
+  :param frame_rate: sample rate of the written files
+  :param channels: number of channels of the written files
+  """
+  with AudioSegmentWriter(segments, frame_rate, channels) as writer:
+    for block in iter_pcm_blocks(video_path, frame_rate, channels):
+      writer.add_samples(block)
+
+
+def truncate_wav(wav_path:Path, num_frames:int):
+  """
+  Keep only the first frames of a 16 bit PCM wav file, in place
+
+  :param wav_path: wav file with the data chunk last, as open_wav_writer writes it
+  :param num_frames: frames to keep, at most those of the file
+  """
+  with wave.open(str(wav_path), 'rb') as wav:
+    data_size = min(num_frames, wav.getnframes()) * wav.getnchannels() * wav.getsampwidth()
+
+  data_offset = get_wav_data_offset(wav_path)
+
+  with open(wav_path, 'r+b') as f:
+    f.truncate(data_offset + data_size)
+
+    # sizes of the data chunk and of the RIFF chunk
+    f.seek(data_offset - 4)
+    f.write( data_size.to_bytes(4, 'little') )
+    f.seek(4)
+    f.write( (data_offset + data_size - 8).to_bytes(4, 'little') )
+
+
+def db_to_float(db:float) -> float:
+  return 10 ** (db / 20)
+
+
+class LoudnessEnvelope:
+  def __init__(self, frame_rate:int, channels:int=2, sample_width:int=2):
+    """
+    :param frame_rate: sample rate of the track in Hz
+    :param channels: number of interleaved channels
+    :param sample_width: bytes per sample
+    """
+    self.frame_rate = frame_rate
+    self.channels = channels
+    self.sample_width = sample_width
+    self.max_possible_amplitude = (2 ** (sample_width * 8)) / 2
+
+    self.num_frames = 0
+
+    # squared samples summed over the channels, one sum per complete millisecond bucket
+    self._bucket_sums = [] # one array per added block
+    self._num_buckets = 0
+    self._open_bucket = np.zeros(0, dtype=np.int64) # per-frame energy of the incomplete last bucket
+
+    # energy inside their bucket before the watched frames, see watch_frames
+    self._watched = np.zeros(0, dtype=np.int64)
+    self._watched_partial = np.zeros(0, dtype=np.int64)
+
+    # per-frame energy of the last frames of the track, at least the last bucket, see watch_windows
+    self._tail_frames = int(np.ceil(frame_rate / 1000))
+    self._tail_blocks = [] # [(first frame, energy), ...]
+
+    self._prefix = None
+    self._tail_prefix = None
+
+  def __len__(self):
+    """
+    length of the track in milliseconds, as len() of an AudioSegment
+    """
+    return round(1000 * (self.num_frames / self.frame_rate))
+
+  def ms_to_frame(self, ms):
+    """
+    Frame of a millisecond position, as AudioSegment slicing computes it
+    """
+    return np.floor( np.asarray(ms, dtype=np.float64) * (self.frame_rate / 1000.0) ).astype(np.int64)
+
+  def frame_to_bucket(self, frames) -> np.ndarray:
+    """
+    Index of the millisecond bucket that contains each frame
+    """
+    frames = np.asarray(frames, dtype=np.int64)
+    buckets = np.floor(frames / (self.frame_rate / 1000.0)).astype(np.int64)
+
+    # the float division can be one bucket off at the edges
+    buckets -= self.ms_to_frame(buckets) > frames
+    buckets += self.ms_to_frame(buckets + 1) <= frames
+
+    return buckets
+
+  def watch_frames(self, frames):
+    """
+    Keep the energy of the bucket of each frame before it, so that
+    get_cumulative_energy is exact at these frames. Frames on bucket edges
+    and in the last frames of the track need no watching.
+
+    :param frames: frame positions, watched before any samples are added
+    """
+    if self.num_frames:
+      raise ValueError('frames have to be watched before samples are added')
+
+    self._watched = np.union1d(self._watched, np.asarray(frames, dtype=np.int64).ravel())
+    self._watched_partial = np.zeros(len(self._watched), dtype=np.int64)
+
+  def watch_windows(self, windows:list[tuple[float, float]], num_sections:int=100):
+    """
+    Watch the frames get_nonsilent_ratio measures for each window. A window
+    cut short by the end of the track is measured from the last frames of
+    the track instead, as many of them as the longest window are kept.
+
+    :param windows: [(start_ms, end_ms), ...], watched before any samples are added
+    :param num_sections: as passed to get_nonsilent_ratio
+    """
+    frames = []
+    max_window_frames = 0
+
+    for start_ms, end_ms in windows:
+      slices = self._get_slices(start_ms, end_ms, num_sections)
+      if slices is None:
+        continue
+
+      _, _, slice_start_frames, slice_end_frames, end_frame = slices
+      frames += [np.minimum(slice_start_frames, end_frame), np.minimum(slice_end_frames, end_frame)]
+      max_window_frames = max(max_window_frames, end_frame - int(slice_start_frames[0]))
+
+    self.watch_frames(np.concatenate(frames) if frames else [])
+
+    # the end of the track may lie inside a bucket, the start of a cut window as well
+    bucket_frames = int(np.ceil(self.frame_rate / 1000))
+    self._tail_frames = max(self._tail_frames, max_window_frames + 2 * bucket_frames + 1)
+
+  def add_samples(self, samples:np.ndarray, block_frames:int=1<<20):
+    """
+    Append the next part of the track.
+
+    :param samples: interleaved integer samples, shape (frames, channels) or flat
+    :param block_frames: frames processed at once, bounds temporary memory
+    """
+    samples = samples.reshape(-1, self.channels)
+
+    for block_start in range(0, len(samples), block_frames):
+      block = samples[block_start:block_start+block_frames]
+      # exact, the squares of 16 bit samples and their sums over a few channels fit in float64
+      self._add_energy( np.square(block, dtype=np.float64).sum(axis=1).astype(np.int64) )
+
+  def _add_energy(self, energy:np.ndarray):
+    first_frame = self.num_frames - len(self._open_bucket) # start of the incomplete bucket
+    end_frame = self.num_frames + len(energy)
+
+    energy = np.concatenate([self._open_bucket, energy])
+    energy_sums = np.concatenate([[0], np.cumsum(energy)])
+
+    # buckets completed by this block, the one containing end_frame stays open
+    end_bucket = int(self.frame_to_bucket(end_frame))
+    edges = self.ms_to_frame(np.arange(self._num_buckets, end_bucket + 1)) - first_frame
+
+    self._bucket_sums.append( np.diff(energy_sums[edges]) )
+    self._num_buckets = end_bucket
+    self._open_bucket = energy[edges[-1]:].copy()
+
+    # the watched frames of this block, their buckets start at first_frame or later
+    lo = np.searchsorted(self._watched, first_frame, side='left')
+    hi = np.searchsorted(self._watched, end_frame, side='right')
+    frames = self._watched[lo:hi]
+    bucket_starts = self.ms_to_frame(self.frame_to_bucket(frames))
+    self._watched_partial[lo:hi] = energy_sums[frames - first_frame] - energy_sums[bucket_starts - first_frame]
+
+    self._tail_blocks.append( (first_frame, energy) )
+    while len(self._tail_blocks) > 1 and self._tail_blocks[1][0] <= end_frame - self._tail_frames:
+      self._tail_blocks.pop(0)
+
+    self.num_frames = end_frame
+    self._prefix = None
+
+  def _get_prefix(self):
+    """
+    Sums of the energy before every millisecond bucket
+    """
+    if self._prefix is None:
+      self._bucket_sums = [ np.concatenate([np.zeros(0, dtype=np.int64)] + self._bucket_sums) ]
+
+      # the incomplete last bucket counts as a bucket
+      bucket_sums = self._bucket_sums + ([self._open_bucket.sum(keepdims=True)] if len(self._open_bucket) else [])
+      self._prefix = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(np.concatenate(bucket_sums))])
+
+      # blocks overlap by their open buckets, each starts at its first frame
+      tail_start = self._tail_blocks[0][0] if self._tail_blocks else self.num_frames
+      tail_energy = np.zeros(self.num_frames - tail_start, dtype=np.int64)
+      for first_frame, energy in self._tail_blocks:
+        tail_energy[first_frame-tail_start:first_frame-tail_start+len(energy)] = energy
+      self._tail_prefix = (tail_start, np.concatenate([[0], np.cumsum(tail_energy)]))
+
+    return self._prefix
+
+  def _get_partial_energy(self, frames:np.ndarray, bucket_starts:np.ndarray) -> np.ndarray:
+    """
+    Energy of the frames in [bucket_start, frame) of the watched frames and
+    of the last frames of the track
+    """
+    partial = np.zeros(len(frames), dtype=np.int64)
+
+    idx = np.minimum(np.searchsorted(self._watched, frames), max(len(self._watched) - 1, 0))
+    watched = self._watched[idx] == frames if len(self._watched) else np.zeros(len(frames), dtype=bool)
+    partial[watched] = self._watched_partial[idx[watched]]
+
+    tail_start, tail_prefix = self._tail_prefix
+    rest = ~watched
+    if (bucket_starts[rest] < tail_start).any():
+      raise ValueError(f'frame {int(frames[rest][bucket_starts[rest] < tail_start][0])} was not watched')
+
+    partial[rest] = tail_prefix[frames[rest] - tail_start] - tail_prefix[bucket_starts[rest] - tail_start]
+
+    return partial
+
+  def get_cumulative_energy(self, frames) -> np.ndarray:
+    """
+    Exact sum of squared samples before each frame: the sums of the whole
+    buckets before it plus the frames of its own bucket before it, known
+    for the watched frames and the last frames of the track
+    """
+    prefix = self._get_prefix()
+
+    frames = np.clip(np.asarray(frames, dtype=np.int64), 0, self.num_frames)
+    buckets = np.minimum(self.frame_to_bucket(frames), len(prefix) - 1)
+    bucket_starts = np.minimum(self.ms_to_frame(buckets), frames)
+
+    partial = np.zeros(frames.shape, dtype=np.int64)
+    inside = frames > bucket_starts
+    if inside.any():
+      partial[inside] = self._get_partial_energy(frames[inside], bucket_starts[inside])
+
+    return prefix[buckets] + partial
+
+  def get_rms(self, start_frames, end_frames, limit_frame:int=None) -> np.ndarray:
+    """
+    RMS of the samples in [start_frame, end_frame) for each pair, as
+    AudioSegment.rms.
+
+    :param limit_frame: frames from here on count as silence, like the
+      padding of an AudioSegment sliced past its end
+    """
+    start_frames = np.asarray(start_frames, dtype=np.int64)
+    end_frames = np.asarray(end_frames, dtype=np.int64)
+    num_samples = (end_frames - start_frames) * self.channels
+
+    if limit_frame is not None:
+      start_frames = np.minimum(start_frames, limit_frame)
+      end_frames = np.minimum(end_frames, limit_frame)
+
+    energy = self.get_cumulative_energy(end_frames) - self.get_cumulative_energy(start_frames)
+
+    rms = np.sqrt( np.maximum(energy, 0) / np.maximum(num_samples, 1) )
+
+    return np.where(num_samples > 0, np.floor(rms), 0)
+
+  def get_nonsilent_ratio(self, start_ms:float, end_ms:float, num_sections:int=100, silence_thresh:float=-50):
+    """
+    Non-silent share of audio_segment[start_ms:end_ms], as computed with
+    pydub.silence.detect_nonsilent(page_audio, min_silence_len, silence_thresh,
+    seek_step=min_silence_len) with min_silence_len = len(page_audio) // num_sections.
+
+    :param start_ms: start of the range in milliseconds
+    :param end_ms: end of the range in milliseconds
+    :param num_sections: number of windows the range is searched in
+    :param silence_thresh: upper bound for how quiet is silent in dBFS
+    :return: ratio in [0, 1], None if the range is too short to be searched
+    """
+    slices = self._get_slices(start_ms, end_ms, num_sections, track_len=len(self))
+    if slices is None:
+      return None
+
+    seg_len, slice_starts, slice_start_frames, slice_end_frames, end_frame = slices
+    min_silence_len = seg_len // num_sections
+
+    rms = self.get_rms(slice_start_frames, slice_end_frames, limit_frame=end_frame)
+    threshold = db_to_float(silence_thresh) * self.max_possible_amplitude
+
+    silence_starts = slice_starts[rms <= threshold].tolist()
+
+    if not silence_starts:
+      return 1.0
+
+    # combine overlapping silent windows into ranges, as detect_silence does
+    silent_len = 0
+    range_start = prev_start = silence_starts[0]
+
+    for silence_start in silence_starts[1:]:
+      continuous = silence_start == prev_start + min_silence_len
+      has_gap = silence_start > prev_start + min_silence_len
+
+      if not continuous and has_gap:
+        silent_len += prev_start + min_silence_len - range_start
+        range_start = silence_start
+
+      prev_start = silence_start
+
+    silent_len += prev_start + min_silence_len - range_start
+
+    return (seg_len - silent_len) / seg_len
+
+  def _get_slices(self, start_ms:float, end_ms:float, num_sections:int, track_len:float=np.inf):
+    """
+    Windows detect_nonsilent searches audio_segment[start_ms:end_ms] in
+
+    :param track_len: length of the track in milliseconds, the range is cut at it
+    :return: (seg_len, slice_starts in ms, slice start frames, slice end frames, end frame), None if too short
+    """
+    start_frame = int( self.ms_to_frame(min(start_ms, track_len)) )
+    end_frame = int( self.ms_to_frame(min(end_ms, track_len)) )
+
+    seg_len = round(1000 * ((end_frame - start_frame) / self.frame_rate))
+    min_silence_len = seg_len // num_sections
+
+    if min_silence_len < 1:
+      return None
+
+    last_slice_start = seg_len - min_silence_len
+    slice_starts = np.arange(0, last_slice_start + 1, min_silence_len)
+
+    # the last portion of the range is always searched
+    if last_slice_start % min_silence_len:
+      slice_starts = np.append(slice_starts, last_slice_start)
+
+    slice_start_frames = start_frame + self.ms_to_frame(np.minimum(slice_starts, seg_len))
+    slice_end_frames = start_frame + self.ms_to_frame(np.minimum(slice_starts + min_silence_len, seg_len))
+
+    return seg_len, slice_starts, slice_start_frames, slice_end_frames, end_frame
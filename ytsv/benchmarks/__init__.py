@@ -0,0 +1,3 @@
+"""
+Benchmarks of the processing stages, run as python -m ytsv.benchmarks.<name>
+"""
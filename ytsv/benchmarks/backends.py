@@ -0,0 +1,193 @@
+"""
+Parity and speed of the exported YOLO backends against the PyTorch models.
+
+Both models run on the same page images, the staff height model on the
+left halves of the system crops found by the PyTorch system model. Boxes
+are compared as they are saved by system_utils (integer xyxy, conf):
+
+  python -m ytsv.benchmarks.backends -c checkpoints -i <dataset dir> --backends onnx openvino
+"""
+
+from pathlib import Path
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+
+from ..system_utils import inference_by_batch, zip_bboxs_confs, crop_left_half
+from ..utils import load_yolo_models, YOLO_BACKENDS
+from ..image_io import IMAGE_SUFFIXES, imread
+
+
+def run_model(yolo, images:list[np.ndarray], batch_size:int=16, device:str='cpu') -> tuple[list, float]:
+  """
+  :return: (boxes of every image as returned by zip_bboxs_confs, seconds)
+  """
+  names = [ f'{i}.png' for i in range(len(images)) ]
+
+  # warm up, the first call of an exported model builds its session
+  inference_by_batch(names[:1], yolo, batch_size=1, device=device, images=images[:1], prefetch=0)
+
+  start = time.perf_counter()
+  outputs = inference_by_batch(names, yolo, batch_size=batch_size, device=device, images=images)
+  seconds = time.perf_counter() - start
+
+  return [ zip_bboxs_confs(output) for output in outputs ], seconds
+
+
+def get_iou(a, b) -> float:
+  inter_w = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+  inter_h = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+  inter = inter_w * inter_h
+  union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+
+  return inter / union if union > 0 else 0.0
+
+
+def compare_boxes(reference:list, boxes:list, iou_threshold:float=0.5) -> dict:
+  """
+  Greedily match the boxes of one image to the reference boxes by IoU
+
+  :return: number of matched, missing and extra boxes, largest coordinate and conf difference of the matches
+  """
+  unmatched = list(range(len(boxes)))
+  coord_diffs = [0]
+  conf_diffs = [0.0]
+
+  for ref in reference:
+    ious = [ get_iou(ref, boxes[i]) for i in unmatched ]
+    if not ious or max(ious) < iou_threshold:
+      continue
+
+    match = boxes[ unmatched.pop(int(np.argmax(ious))) ]
+    coord_diffs.append( max( abs(r - m) for r, m in zip(ref[:4], match[:4]) ) )
+    conf_diffs.append( abs(ref[4] - match[4]) )
+
+  num_matched = len(boxes) - len(unmatched)
+
+  return {
+    'matched': num_matched,
+    'missing': len(reference) - num_matched,
+    'extra': len(unmatched),
+    'max_coord_diff': max(coord_diffs),
+    'max_conf_diff': max(conf_diffs),
+  }
+
+
+def get_average_height(boxes:list) -> float:
+  # as get_staff_bboxs
+  if not boxes:
+    return None
+  return sum( y2 - y1 for _, y1, _, y2, _ in boxes ) / len(boxes)
+
+
+def summarize(reference:list, results:list, seconds:float, reference_seconds:float, heights:bool=False) -> dict:
+  comparisons = [ compare_boxes(ref, boxes) for ref, boxes in zip(reference, results) ]
+
+  summary = {
+    'images': len(results),
+    'seconds': seconds,
+    'images_per_second': len(results) / seconds if seconds else None,
+    'speedup': reference_seconds / seconds if seconds else None,
+    'identical_images': sum( ref == boxes for ref, boxes in zip(reference, results) ),
+    'images_with_missing_or_extra': sum( 1 for c in comparisons if c['missing'] or c['extra'] ),
+    'missing': sum( c['missing'] for c in comparisons ),
+    'extra': sum( c['extra'] for c in comparisons ),
+    'max_coord_diff': max( (c['max_coord_diff'] for c in comparisons), default=0 ),
+    'max_conf_diff': max( (c['max_conf_diff'] for c in comparisons), default=0.0 ),
+  }
+
+  if heights:
+    height_diffs = [
+      abs(get_average_height(ref) - get_average_height(boxes))
+      for ref, boxes in zip(reference, results) if ref and boxes
+    ]
+    summary['max_staff_height_diff'] = max(height_diffs, default=0.0)
+
+  return summary
+
+
+def get_crops(page_images:list[np.ndarray], page_boxes:list, conf_threshold:float=0.4) -> list[np.ndarray]:
+  """
+  Left halves of the system crops, as crop_system_images and detect_crop_staffs_by_batch
+  """
+  return [
+    crop_left_half(page_image[y1:y2, x1:x2])
+    for page_image, boxes in zip(page_images, page_boxes)
+    for x1, y1, x2, y2, conf in boxes if conf >= conf_threshold and x2 > x1 and y2 > y1
+  ]
+
+
+def benchmark_backends(
+  checkpoint_dir:Path,
+  page_paths:list[Path],
+  backends:list[str],
+  batch_size:int=16,
+  device:str='cpu',
+  calibration_data:str=None
+) -> dict:
+  """
+  :param checkpoint_dir: path to the YOLO model checkpoints
+  :param page_paths: page images to run the models on
+  :param backends: backends compared to 'pytorch'
+  :return: {'pytorch': timings, backend: {'systems': summary, 'staff_heights': summary}, ...}
+  """
+  page_images = [ imread(p, cv2.IMREAD_COLOR) for p in page_paths ]
+
+  yolo_system, yolo_staff_height = load_yolo_models(checkpoint_dir)
+  system_boxes, system_seconds = run_model(yolo_system, page_images, batch_size=batch_size, device=device)
+
+  crops = get_crops(page_images, system_boxes)
+  height_boxes, height_seconds = run_model(yolo_staff_height, crops, batch_size=batch_size, device=device)
+
+  report = {
+    'pytorch': {
+      'systems': {'images': len(page_images), 'seconds': system_seconds},
+      'staff_heights': {'images': len(crops), 'seconds': height_seconds},
+    }
+  }
+
+  for backend in backends:
+    yolo_system, yolo_staff_height = load_yolo_models(checkpoint_dir, backend=backend, calibration_data=calibration_data)
+
+    boxes, seconds = run_model(yolo_system, page_images, batch_size=batch_size, device=device)
+    report[backend] = {'systems': summarize(system_boxes, boxes, seconds, system_seconds)}
+
+    boxes, seconds = run_model(yolo_staff_height, crops, batch_size=batch_size, device=device)
+    report[backend]['staff_heights'] = summarize(height_boxes, boxes, seconds, height_seconds, heights=True)
+
+  return report
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='python -m ytsv.benchmarks.backends')
+  parser.add_argument('-c', '--checkpoint-dir', type=str, default='checkpoints', help='Path to YOLO model checkpoints directory')
+  parser.add_argument('-i', '--image-dir', type=str, required=True, help='Dataset or segment directory, searched recursively for original page images')
+  parser.add_argument('-n', '--num-images', type=int, default=256, help='Number of page images, default is 256')
+  parser.add_argument('--backends', type=str, nargs='+', default=['onnx'], choices=list(YOLO_BACKENDS), help='Backends to compare, default is onnx')
+  parser.add_argument('--batch-size', type=int, default=16, help='Batch size for YOLO inference, default is 16')
+  parser.add_argument('--device', type=str, default='cpu', help='Device to run YOLO models on')
+  parser.add_argument('--calibration-data', type=str, default=None, help='Dataset yaml for INT8 calibration')
+  parser.add_argument('-o', '--out-path', type=str, default=None, help='If given, write the report to this JSON file')
+
+  args = parser.parse_args()
+
+  # pages only, not the crops next to them in images/cropped and images/crop_resized
+  page_paths = sorted( p for p in Path(args.image_dir).rglob('*') if p.suffix in IMAGE_SUFFIXES and p.parent.name == 'original' )[:args.num_images]
+
+  report = benchmark_backends(
+    Path(args.checkpoint_dir),
+    page_paths,
+    args.backends,
+    batch_size=args.batch_size,
+    device=args.device,
+    calibration_data=args.calibration_data
+  )
+
+  print(json.dumps(report, indent=2))
+
+  if args.out_path:
+    with open(args.out_path, 'w') as f:
+      json.dump(report, f, indent=2)
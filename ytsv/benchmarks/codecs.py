@@ -0,0 +1,112 @@
+"""
+Encode time and size of the image codecs on the images of a processed dataset.
+
+Pages (images/original), crops (images/cropped) and resized crops
+(images/crop_resized) of a random sample of videos are read once and
+encoded in memory with every codec, so the disk does not take part in the
+timings:
+
+  python -m ytsv.benchmarks.codecs -i <dataset dir> --codecs png png:1 webp npy
+"""
+
+from pathlib import Path
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from ..image_io import ImageCodec, parse_codec, imread, glob_images
+
+
+IMAGE_KINDS = {'pages': 'original', 'crops': 'cropped', 'resized': 'crop_resized'}
+
+DEFAULT_CODECS = ['png', 'png:0', 'png:1', 'png:3', 'png:9', 'webp', 'npy']
+
+
+def get_segment_dirs(image_dir:Path) -> list[Path]:
+  """
+  Segment directories of a dataset directory (<staff count>/segments/<yt_id>), or image_dir if it is one
+  """
+  image_dir = Path(image_dir)
+  if (image_dir / 'images').is_dir():
+    return [image_dir]
+
+  return sorted( seg_dir for seg_dir in image_dir.glob('*/segments/*') if (seg_dir / 'images').is_dir() )
+
+
+def get_image_paths(image_dir:Path, num_images:int=256, num_videos:int=16, seed:int=0) -> dict[str, list[Path]]:
+  """
+  Images of a random sample of videos, only their image directories are listed
+
+  :param image_dir: dataset or segment directory
+  :param num_images: largest number of images of each kind, spread over the videos
+  :param num_videos: number of videos sampled
+  :param seed: seed of the sample
+  :return: {kind: images of all codecs}, kinds as IMAGE_KINDS
+  """
+  seg_dirs = get_segment_dirs(image_dir)
+  seg_dirs = random.Random(seed).sample(seg_dirs, min(num_videos, len(seg_dirs)))
+
+  paths = { kind: [] for kind in IMAGE_KINDS }
+  for kind, dir_name in IMAGE_KINDS.items():
+    for i, seg_dir in enumerate(seg_dirs):
+      # an even share of the remaining images for each remaining video
+      share = -(-(num_images - len(paths[kind])) // (len(seg_dirs) - i))
+      paths[kind] += glob_images(seg_dir / 'images' / dir_name)[:share]
+
+  return paths
+
+
+def benchmark_codec(codec:ImageCodec, images:list[np.ndarray]) -> dict:
+  start = time.perf_counter()
+  sizes = [ len(codec.encode(image)) for image in images ]
+  seconds = time.perf_counter() - start
+
+  raw_bytes = sum( image.nbytes for image in images )
+
+  return {
+    'images': len(images),
+    'seconds': seconds,
+    'images_per_second': len(images) / seconds if seconds else None,
+    'bytes': sum(sizes),
+    'ratio': raw_bytes / sum(sizes) if sizes else None,
+  }
+
+
+def benchmark_codecs(image_paths:dict[str, list[Path]], codecs:list[str]) -> dict:
+  """
+  :param image_paths: {kind: image paths}, e.g. of get_image_paths
+  :param codecs: codec specs, see image_io.ImageCodec
+  :return: {kind: {codec: summary}}
+  """
+  report = {}
+
+  for kind, paths in image_paths.items():
+    images = [ image for image in map(imread, paths) if image is not None ]
+    if not images:
+      continue
+
+    report[kind] = { spec: benchmark_codec(ImageCodec(spec), images) for spec in codecs }
+
+  return report
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='python -m ytsv.benchmarks.codecs')
+  parser.add_argument('-i', '--image-dir', type=str, required=True, help='Dataset or segment directory, the page, crop and resized images are read from a sample of its videos')
+  parser.add_argument('-n', '--num-images', type=int, default=256, help='Number of images of each kind, default is 256')
+  parser.add_argument('-v', '--num-videos', type=int, default=16, help='Number of videos the images are sampled from, default is 16')
+  parser.add_argument('--codecs', type=parse_codec, nargs='+', default=DEFAULT_CODECS, help=f'Codecs to compare, default is {" ".join(DEFAULT_CODECS)}')
+  parser.add_argument('-o', '--out-path', type=str, default=None, help='If given, write the report to this JSON file')
+
+  args = parser.parse_args()
+
+  report = benchmark_codecs(get_image_paths(args.image_dir, args.num_images, args.num_videos), args.codecs)
+
+  print(json.dumps(report, indent=2))
+
+  if args.out_path:
+    with open(args.out_path, 'w') as f:
+      json.dump(report, f, indent=2)
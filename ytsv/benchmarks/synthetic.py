@@ -0,0 +1,466 @@
+"""
+Offline benchmark of the processing stages on synthetic score videos.
+
+Videos are slide shows of rendered staff line pages, with cuts or fades
+between the pages and a tone track that is silent on the title page(s) at
+the start and the blank page(s) at the end. The videos are processed by
+prepare_video and process_video_pages, and the report holds the metrics they
+recorded (see ytsv.metrics): the time of every stage
+
+  extract (sections, pages, audio_decode, silence_trimming, page_extract, audio_export),
+  systems, crop, staff_heights, resize
+
+Without YOLO models, stand-ins return the rendered system boxes and staff
+heights, so cropping and resizing run on the same systems for every model
+and the systems and staff_heights stages only time their bookkeeping.
+The report is written as JSON:
+
+  python -m ytsv.benchmarks.synthetic -o bench --num-videos 2 --duration 120 --report report.json
+"""
+
+from pathlib import Path
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import wave
+
+import cv2
+import numpy as np
+from tqdm.auto import tqdm
+
+from moviepy.config import get_setting
+
+from ..utils import load_yolo_models, get_ts
+
+
+# parts of the extract stage, timed by extract_pages_and_audios
+EXTRACT_PARTS = ['sections', 'pages', 'audio_decode', 'silence_trimming', 'page_extract', 'audio_export']
+STAGE_NAMES = ['extract', *EXTRACT_PARTS, 'systems', 'crop', 'staff_heights', 'resize']
+
+
+def render_page(
+  width:int,
+  height:int,
+  num_systems:int=4,
+  staves_per_system:int=2,
+  title:str=None,
+  rng:np.random.Generator=None
+):
+  """
+  Render a white page with systems of five line staves, bar lines and note heads.
+
+  :param num_systems: number of systems, 0 renders only the title
+  :param title: text at the top of the page
+  :return: (page image, [(lx, ly, rx, ry, conf), ...] of the systems, staff height in pixels)
+  """
+  rng = rng or np.random.default_rng(0)
+  image = np.full((height, width, 3), 255, dtype=np.uint8)
+
+  top = int(height * 0.12)
+  if title:
+    scale = height / 600
+    cv2.putText(image, title, (int(width * 0.1), top - int(height * 0.03)), cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 0, 0), max(1, int(scale * 2)), cv2.LINE_AA)
+
+  if not num_systems:
+    return image, [], 0
+
+  slot = (height - top - int(height * 0.04)) / num_systems
+  gap = max(2, int(0.8 * slot / (8 * staves_per_system - 4))) # distance of two staff lines
+  left, right = int(width * 0.06), int(width * 0.94)
+
+  system_bboxs = []
+  for i in range(num_systems):
+    first_line = int(top + i * slot + 0.1 * slot)
+    staff_tops = [ first_line + 8 * gap * k for k in range(staves_per_system) ]
+
+    for staff_top in staff_tops:
+      for line in range(5):
+        cv2.line(image, (left, staff_top + line * gap), (right, staff_top + line * gap), (0, 0, 0), 1)
+
+      # note heads on lines and spaces
+      for x in range(left + 4 * gap, right - gap, 3 * gap):
+        y = staff_top + int(rng.integers(-2, 11)) * gap // 2
+        cv2.ellipse(image, (x, y), (max(1, int(gap * 0.6)), max(1, gap // 2)), -20, 0, 360, (0, 0, 0), -1)
+
+    bottom_line = staff_tops[-1] + 4 * gap
+    for x in np.linspace(left, right, 5).astype(int):
+      cv2.line(image, (int(x), first_line), (int(x), bottom_line), (0, 0, 0), 1)
+
+    system_bboxs.append( (left, max(0, first_line - 2 * gap), right, min(height, bottom_line + 2 * gap), 1.0) )
+
+  return image, system_bboxs, 4 * gap
+
+
+def render_tone_track(num_frames:int, frame_rate:int, silent_ranges:list, rng:np.random.Generator, note_duration:float=0.25) -> np.ndarray:
+  """
+  Stereo int16 track of decaying sine notes, zero inside the silent frame ranges
+  """
+  track = np.zeros(num_frames, dtype=np.float32)
+  note_frames = int(note_duration * frame_rate)
+  t = np.arange(note_frames) / frame_rate
+  decay = np.exp(-4 * t)
+
+  for start in range(0, num_frames, note_frames):
+    freq = 220 * 2 ** (int(rng.integers(0, 24)) / 12)
+    note = 0.3 * np.sin(2 * np.pi * freq * t) * decay
+    track[start:start + note_frames] = note[:num_frames - start]
+
+  for start, end in silent_ranges:
+    track[start:end] = 0
+
+  return (np.stack([track, 0.8 * track], axis=1) * 32767).astype('<i2')
+
+
+def make_synthetic_video(
+  video_path:Path,
+  duration:float=120,
+  page_duration:float=8,
+  fps:float=30,
+  size:tuple[int, int]=(1280, 720),
+  transition:str='fade',
+  transition_duration:float=0.5,
+  intro_pages:int=1,
+  outro_pages:int=1,
+  num_systems:int=4,
+  audio_frame_rate:int=44100,
+  seed:int=0
+) -> dict:
+  """
+  Write a synthetic score video with an audio track.
+
+  :param video_path: path to the written mp4
+  :param duration: length of the video in seconds
+  :param page_duration: seconds every page is shown, including the transition to the next one
+  :param size: (width, height) of the video
+  :param transition: 'cut' or 'fade'
+  :param transition_duration: seconds of a fade
+  :param intro_pages: silent title pages at the start
+  :param outro_pages: silent blank pages at the end
+  :return: ground truth, {'pages': [{'kind', 'start_frame', 'end_frame', 'system_bboxs', 'staff_height'}, ...]}
+  """
+  rng = np.random.default_rng(seed)
+  width, height = size
+
+  frames_per_page = int(page_duration * fps)
+  num_pages = max(intro_pages + outro_pages + 1, int(duration * fps) // frames_per_page)
+  fade_frames = int(transition_duration * fps) if transition == 'fade' else 0
+
+  pages = []
+  for i in range(num_pages):
+    if i < intro_pages:
+      kind, image, bboxs, staff_height = 'intro', *render_page(width, height, num_systems=0, title=f'Synthetic Score {seed}', rng=rng)
+    elif i >= num_pages - outro_pages:
+      kind, image, bboxs, staff_height = 'outro', *render_page(width, height, num_systems=0, rng=rng)
+    else:
+      kind, image, bboxs, staff_height = 'music', *render_page(width, height, num_systems=num_systems, title=f'{i - intro_pages + 1}', rng=rng)
+
+    pages.append({
+      'kind': kind,
+      'image': image,
+      'start_frame': i * frames_per_page,
+      'end_frame': (i + 1) * frames_per_page,
+      'system_bboxs': bboxs,
+      'staff_height': staff_height,
+    })
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    tmp_video_path = Path(tmp_dir) / 'video.mp4'
+    tmp_audio_path = Path(tmp_dir) / 'audio.wav'
+
+    writer = cv2.VideoWriter(str(tmp_video_path), cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for i, page in enumerate(pages):
+      next_image = pages[i + 1]['image'] if i + 1 < len(pages) else None
+
+      for j in range(frames_per_page):
+        k = j - (frames_per_page - fade_frames)
+        if next_image is not None and k >= 0:
+          alpha = (k + 1) / (fade_frames + 1)
+          writer.write( cv2.addWeighted(page['image'], 1 - alpha, next_image, alpha, 0) )
+        else:
+          writer.write(page['image'])
+    writer.release()
+
+    num_audio_frames = int(num_pages * frames_per_page / fps * audio_frame_rate)
+    to_audio_frame = lambda video_frame: int(video_frame / fps * audio_frame_rate)
+    silent_ranges = [
+      (to_audio_frame(page['start_frame']), to_audio_frame(page['end_frame']))
+      for page in pages if page['kind'] != 'music'
+    ]
+
+    track = render_tone_track(num_audio_frames, audio_frame_rate, silent_ranges, rng)
+    with wave.open(str(tmp_audio_path), 'wb') as wav:
+      wav.setnchannels(2)
+      wav.setsampwidth(2)
+      wav.setframerate(audio_frame_rate)
+      wav.writeframes(track.tobytes())
+
+    video_path.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run([
+      get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+      '-i', str(tmp_video_path), '-i', str(tmp_audio_path),
+      '-c:v', 'copy', '-c:a', 'aac', '-shortest',
+      str(video_path)
+    ], check=True, stdin=subprocess.DEVNULL)
+
+  return {
+    'pages': [ { k: v for k, v in page.items() if k != 'image' } for page in pages ],
+  }
+
+
+class RenderedModel:
+  """
+  Stand-in for a YOLO model that returns the rendered boxes, so that the
+  stages after it run on what make_synthetic_video drew. The expected
+  outputs are consumed in the order the images are passed to the model.
+  """
+  backend = 'rendered'
+
+  def __init__(self, bboxs:list[list[tuple]]):
+    """
+    :param bboxs: [(lx, ly, rx, ry, conf), ...] of every image it will be called with, in order
+    """
+    self.bboxs = list(bboxs)
+    self.num_calls = 0
+
+  def to(self, device):
+    return self
+
+  def __call__(self, batch, device='cpu', verbose=False, **kwargs):
+    import torch
+    from ultralytics.engine.results import Results
+
+    outputs = []
+    for image in batch:
+      bboxs = self.bboxs[self.num_calls] if self.num_calls < len(self.bboxs) else []
+      self.num_calls += 1
+
+      boxes = torch.tensor([ [lx, ly, rx, ry, conf, 0] for lx, ly, rx, ry, conf in bboxs ], dtype=torch.float32).reshape(-1, 6)
+      outputs.append( Results(image, 'image.png', {0: 'system'}, boxes=boxes) )
+
+    return outputs
+
+
+def get_truth_page(truth:dict, frame_idx:int) -> dict:
+  for page in truth['pages']:
+    if page['start_frame'] <= frame_idx < page['end_frame']:
+      return page
+  return truth['pages'][-1]
+
+
+def get_rendered_models(truth:dict, page_frames:list[int], staves_per_system:int=2) -> list[RenderedModel]:
+  """
+  Stand-ins for [system detection model, staff height detection model] that
+  return the rendered systems of the pages at page_frames and staff boxes of
+  the rendered staff height for each of their systems
+  """
+  truth_pages = [ get_truth_page(truth, frame_idx) for frame_idx in page_frames ]
+
+  system_bboxs = [ page['system_bboxs'] for page in truth_pages ]
+  staff_bboxs = [
+    [ (0, k * 2 * page['staff_height'], 10, (2 * k + 1) * page['staff_height'], 1.0) for k in range(staves_per_system) ]
+    for page in truth_pages for _ in page['system_bboxs']
+  ]
+
+  return [RenderedModel(system_bboxs), RenderedModel(staff_bboxs)]
+
+
+def benchmark_video(
+  metadata:list[str],
+  out_dir:Path,
+  truth:dict,
+  target_height:int=18,
+  sparse_sections:bool=False,
+  yolo_models:list=None,
+  batch_size:int=16,
+  device:str='cpu'
+) -> dict:
+  """
+  Run prepare_video and process_video_pages on one video and collect the
+  timings their stages recorded (see ytsv.metrics).
+
+  :param metadata: row of the video, [yt_id, staff_count]
+  :param out_dir: dataset directory of the video
+  :param truth: ground truth returned by make_synthetic_video
+  :param yolo_models: optional [system detection model, staff height detection model] to time,
+    by default the systems and staffs are the rendered ones
+  :return: {'timings': {stage: seconds}, 'metrics': {stage: metrics}, 'checks': {...}}
+  """
+  from .. import prepare_video, process_video_pages
+  from ..metrics import VideoMetrics
+
+  metrics = VideoMetrics(metadata[0])
+
+  seg_dir, pages = prepare_video(metadata, out_dir, extract_kwargs={'sparse_sections': sparse_sections}, resume=False, keep_pages=True, metrics=metrics)
+  page_frames = [ int(page_image_path.stem.split(':')[2]) for page_image_path, _ in pages ]
+
+  process_video_pages(
+    seg_dir,
+    yolo_models or get_rendered_models(truth, page_frames),
+    target_height=target_height,
+    device=device,
+    pages=pages,
+    batch_size=batch_size,
+    metrics=metrics
+  )
+
+  stages = metrics.to_dict()['stages']
+  extract = stages['extract']
+
+  timings = { stage: values['wall_time'] for stage, values in stages.items() }
+  timings.update({ part: extract[f'{part}_time'] for part in EXTRACT_PARTS })
+
+  kept_kinds = [ get_truth_page(truth, frame_idx)['kind'] for frame_idx in page_frames ]
+
+  return {
+    'timings': timings,
+    'metrics': stages,
+    'checks': {
+      'rendered_pages': len(truth['pages']),
+      'detected_pages': extract['pages_detected'],
+      'music_pages': sum( 1 for page in truth['pages'] if page['kind'] == 'music' ),
+      'kept_pages': extract['pages'],
+      'kept_silent_pages': sum( 1 for kind in kept_kinds if kind != 'music' ),
+      'crops': stages['crop']['crops'],
+      'resized': stages['resize']['resized'],
+    },
+  }
+
+
+def load_tiny_yolo_models() -> list:
+  """
+  Untrained YOLOv8n models built from the ultralytics config, no download
+  needed. Their detections are meaningless, only their timings are used.
+  """
+  from ultralytics import YOLO
+
+  return [ YOLO('yolov8n.yaml'), YOLO('yolov8n.yaml') ]
+
+
+def run_benchmark(
+  out_dir:Path,
+  num_videos:int=1,
+  video_kwargs:dict=None,
+  yolo_models:list=None,
+  target_height:int=18,
+  sparse_sections:bool=False,
+  batch_size:int=16,
+  device:str='cpu'
+) -> dict:
+  """
+  :param out_dir: dataset directory of the synthetic videos, they are written to
+    synthetic/mp4/ and their outputs to synthetic/segments/
+  :param num_videos: number of videos, rendered with seeds 0, 1, ...
+  :param video_kwargs: keyword arguments for make_synthetic_video
+  :param yolo_models: optional [system detection model, staff height detection model] to time
+  :return: report with the timings of every video and their totals
+  """
+  video_kwargs = video_kwargs or {}
+  videos = []
+
+  for seed in tqdm(range(num_videos), desc='Synthetic'):
+    video_id = f'synthetic{str(seed).zfill(4)}'
+    metadata = [video_id, 'synthetic']
+    video_path = out_dir / 'synthetic' / 'mp4' / f'{video_id}.mp4'
+
+    truth = make_synthetic_video(video_path, seed=seed, **video_kwargs)
+
+    shutil.rmtree(out_dir / 'synthetic' / 'segments' / video_id, ignore_errors=True)
+    result = benchmark_video(
+      metadata,
+      out_dir,
+      truth,
+      target_height=target_height,
+      sparse_sections=sparse_sections,
+      yolo_models=yolo_models,
+      batch_size=batch_size,
+      device=device
+    )
+
+    videos.append({'yt_id': video_id, 'seed': seed, **result})
+
+  totals = {
+    stage: sum( video['timings'][stage] for video in videos )
+    for stage in STAGE_NAMES if any( stage in video['timings'] for video in videos )
+  }
+
+  return {
+    'created_at': get_ts(),
+    'environment': {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'opencv': cv2.__version__,
+      'numpy': np.__version__,
+    },
+    'config': {
+      'num_videos': num_videos,
+      'video': video_kwargs,
+      'target_height': target_height,
+      'sparse_sections': sparse_sections,
+      'yolo': bool(yolo_models),
+      'batch_size': batch_size,
+      'device': device,
+    },
+    'totals': totals,
+    'videos': videos,
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='python -m ytsv.benchmarks.synthetic')
+  parser.add_argument('-o', '--out-dir', type=str, required=True, help='Directory of the synthetic videos and outputs')
+  parser.add_argument('-r', '--report', type=str, default=None, help='Path to the JSON report, default is <out-dir>/report.json')
+  parser.add_argument('-n', '--num-videos', type=int, default=1, help='Number of synthetic videos, default is 1')
+  parser.add_argument('--duration', type=float, default=120, help='Length of every video in seconds, default is 120')
+  parser.add_argument('--page-duration', type=float, default=8, help='Seconds every page is shown, default is 8')
+  parser.add_argument('--fps', type=float, default=30, help='Frames per second, default is 30')
+  parser.add_argument('--width', type=int, default=1280, help='Video width, default is 1280')
+  parser.add_argument('--height', type=int, default=720, help='Video height, default is 720')
+  parser.add_argument('--transition', type=str, default='fade', choices=['fade', 'cut'], help='Transition between pages, default is fade')
+  parser.add_argument('--intro-pages', type=int, default=1, help='Silent title pages at the start, default is 1')
+  parser.add_argument('--outro-pages', type=int, default=1, help='Silent blank pages at the end, default is 1')
+  parser.add_argument('--sparse-sections', action='store_true', help='Detect sections with get_section_list_sparse')
+  parser.add_argument('--target-height', type=int, default=18, help='Target staff height for resizing, default is 18')
+  parser.add_argument('--yolo', type=str, default='none', choices=['none', 'tiny', 'checkpoints'], help='Also time YOLO inference with untrained yolov8n models (tiny) or the models in --checkpoint-dir')
+  parser.add_argument('-c', '--checkpoint-dir', type=str, default='checkpoints', help='Path to YOLO model checkpoints directory')
+  parser.add_argument('--batch-size', type=int, default=16, help='Batch size for YOLO inference, default is 16')
+  parser.add_argument('--device', type=str, default='cpu', help='Device to run YOLO models on')
+
+  args = parser.parse_args()
+
+  out_dir = Path(args.out_dir)
+
+  yolo_models = None
+  if args.yolo == 'tiny':
+    yolo_models = load_tiny_yolo_models()
+  elif args.yolo == 'checkpoints':
+    yolo_models = load_yolo_models(Path(args.checkpoint_dir))
+
+  report = run_benchmark(
+    out_dir,
+    num_videos=args.num_videos,
+    video_kwargs={
+      'duration': args.duration,
+      'page_duration': args.page_duration,
+      'fps': args.fps,
+      'size': (args.width, args.height),
+      'transition': args.transition,
+      'intro_pages': args.intro_pages,
+      'outro_pages': args.outro_pages,
+    },
+    yolo_models=yolo_models,
+    target_height=args.target_height,
+    sparse_sections=args.sparse_sections,
+    batch_size=args.batch_size,
+    device=args.device
+  )
+
+  report_path = Path(args.report) if args.report else out_dir / 'report.json'
+  with open(report_path, 'w') as f:
+    json.dump(report, f, indent=2)
+
+  print(json.dumps(report['totals'], indent=2))
@@ -0,0 +1,536 @@
+"""
+Samples of the processed dataset, one per page.
+
+A sample joins what the processing stages left in the segment directory of
+a video: the audio segment of the page, its system bounding boxes, and the
+resized crop and staff boxes of every system.
+
+DatasetReader keeps a persistent index of all samples for random access.
+"""
+
+from pathlib import Path
+import os
+import csv
+import json
+import wave
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from .audio_utils import AudioTrackReader, get_audio_track_paths, get_segment_name
+from .dedup import load_aliases
+from .image_io import find_image_path, glob_images
+from .detections import YOLO_SYSTEM, SYSTEM, STAFF, load_detections, group_bboxs, parse_page_stem
+
+
+def get_segment_dir(dataset_dir:Path, metadata:list[str]) -> Path:
+  """
+  :param metadata: row of the metadata file
+  """
+  yt_id, *_, staff_count = metadata
+  return dataset_dir / staff_count / 'segments' / yt_id
+
+
+def get_page_key(yt_id:str, page:int) -> str:
+  return f'{yt_id}:{str(page).zfill(4)}'
+
+
+def parse_audio_segment_name(segment_path:Path) -> tuple[int, float, float]:
+  """
+  :return: (page, start_time, end_time) of '{yt_id}:{page}:{start_time}:{end_time}.wav'
+  """
+  *_, page, start_time, end_time = segment_path.stem.split(':')
+  return int(page), float(start_time), float(end_time)
+
+
+def load_video_systems(seg_dir:Path) -> dict[str, list[dict]]:
+  """
+  Systems of the pages of a video as in collect_video_samples, from its detection store
+
+  :return: {page stem: systems} of the pages the system model detected anything on
+  """
+  yt_id = seg_dir.name
+  crop_resized_dir = seg_dir / 'images' / 'crop_resized'
+
+  detections = load_detections(seg_dir)
+  system_bboxs = group_bboxs(detections, SYSTEM, yt_id)
+  staff_bboxs = group_bboxs(detections, STAFF, yt_id)
+
+  video_systems = {}
+
+  for page_stem in group_bboxs(detections, YOLO_SYSTEM, yt_id):
+    systems = []
+    for i, (lx, ly, rx, ry, conf) in enumerate(system_bboxs.get(page_stem, [])):
+      crop_stem = f'{page_stem}:{str(i).zfill(4)}'
+      crop_resized_path = find_image_path(crop_resized_dir / f'{crop_stem}.png')
+
+      systems.append({
+        'index': i,
+        'bbox': [lx, ly, rx, ry],
+        'conf': conf,
+        'staff_bboxs': staff_bboxs.get(crop_stem, []),
+        'crop_resized': crop_resized_path if crop_resized_path.exists() else None,
+      })
+
+    video_systems[page_stem] = systems
+
+  return video_systems
+
+
+def collect_video_samples(seg_dir:Path) -> list[dict]:
+  """
+  Samples of the pages of a processed video, in page order.
+
+  Each sample is a dict with
+    key: '{yt_id}:{page}'
+    yt_id, page, frame, start_time, end_time
+    audio: path of the audio segment, or (AudioTrackReader, index) with a single audio file
+    systems: list of dicts with
+      index: index of the system on the page
+      bbox: [lx, ly, rx, ry] in the page image
+      conf: detection confidence
+      staff_bboxs: staff boxes [lx, ly, rx, ry, conf] in the crop, empty if none were detected
+      crop_resized: path of the resized crop, None if the system was not resized
+
+  :param seg_dir: path to the segment directory of the video
+  """
+  yt_id = seg_dir.name
+  audio_dir = seg_dir / 'audio' / 'original'
+  image_dir = seg_dir / 'images'
+
+  samples = {}
+
+  track_path, index_path = get_audio_track_paths(audio_dir, yt_id)
+
+  if index_path.exists():
+    reader = AudioTrackReader(track_path, index_path)
+    for i, entry in enumerate(reader.index):
+      page = int(entry['page'])
+      samples[page] = {'start_time': float(entry['start_time']), 'end_time': float(entry['end_time']), 'audio': (reader, i)}
+
+  else:
+    for segment_path in audio_dir.glob(f'{yt_id}:*.wav'):
+      page, start_time, end_time = parse_audio_segment_name(segment_path)
+      samples[page] = {'start_time': start_time, 'end_time': end_time, 'audio': segment_path}
+
+  # pages without detected systems have no detections
+  frames = {}
+  systems = {}
+
+  video_systems = { seg_dir: load_video_systems(seg_dir) }
+
+  for page_stem, page_systems in video_systems[seg_dir].items():
+    page, frame = parse_page_stem(page_stem)
+    frames[page] = frame
+    systems[page] = page_systems
+
+  # duplicate pages share the systems and crops of their first instance, see ytsv.dedup
+  dataset_dir = seg_dir.parents[2]
+  for page_stem, source in load_aliases(seg_dir).items():
+    page, frame = parse_page_stem(page_stem)
+    source_path = dataset_dir / source
+    source_seg_dir = source_path.parents[2]
+
+    if source_seg_dir not in video_systems:
+      video_systems[source_seg_dir] = load_video_systems(source_seg_dir)
+
+    frames[page] = frame
+    systems[page] = video_systems[source_seg_dir].get(source_path.stem, [])
+
+  for page_image_path in glob_images(image_dir / 'original', f'{yt_id}:*'):
+    _, page, frame = page_image_path.stem.split(':')
+    frames.setdefault(int(page), int(frame))
+
+  return [
+    {
+      'key': get_page_key(yt_id, page),
+      'yt_id': yt_id,
+      'page': page,
+      'frame': frames.get(page),
+      **samples[page],
+      'systems': systems.get(page, []),
+    }
+    for page in sorted(samples)
+  ]
+
+
+def get_sample_audio_bytes(sample:dict) -> bytes:
+  """
+  wav file of the audio segment of a sample
+  """
+  audio = sample['audio']
+
+  if isinstance(audio, tuple):
+    reader, i = audio
+    return reader.get_segment_bytes(i)
+
+  return Path(audio).read_bytes()
+
+
+PAGE_DTYPE = np.dtype([
+  ('video', np.int32), # index in the video table
+  ('page', np.int32),
+  ('frame', np.int32), # -1 if unknown
+  ('start_time', np.float64),
+  ('end_time', np.float64),
+  ('audio_index', np.int32), # index in the segment index of a single audio file, -1 for a file per page
+  ('system_start', np.int64), # first row of the page in the system table
+  ('num_systems', np.int32),
+])
+
+SYSTEM_DTYPE = np.dtype([
+  ('index', np.int32),
+  ('bbox', np.int32, (4,)), # lx, ly, rx, ry in the page image
+  ('conf', np.float32),
+  ('num_staffs', np.int32),
+  ('staff_height', np.float32), # average staff height, 0 if no staff was detected
+  ('has_crop_resized', np.bool_),
+])
+
+
+def get_video_signature(seg_dir:Path) -> list[int]:
+  """
+  Modification times of the manifest and the output directories of a video,
+  any change of the outputs changes at least one of them
+  """
+  paths = [
+    seg_dir / 'manifest.json',
+    seg_dir / 'audio' / 'original',
+    seg_dir / 'images' / 'original',
+    seg_dir / 'images' / 'crop_resized',
+  ]
+
+  return [ p.stat().st_mtime_ns if p.exists() else 0 for p in paths ]
+
+
+class DatasetReader:
+  def __init__(self, dataset_dir:Path, metadata_path:Path=None, index_dir:Path=None, update:bool=True):
+    """
+    Random access to the pages of the processed dataset through a persistent index.
+
+    The index is a page table and a system table of fixed size rows, loaded
+    memory-mapped, plus a log of the videos with one JSON line per entry.
+    The index only grows by appending: a new or changed video appends its
+    rows to the tables and its entry to the log, and the rows of its previous
+    entry count as replaced. Sample i is a row of the page table, its systems
+    are a contiguous slice of the system table, so every lookup is O(1).
+
+    :param dataset_dir: path to the dataset directory
+    :param metadata_path: path to the metadata file, needed to build or update the index
+    :param index_dir: directory of the index files, default is <dataset_dir>/index
+    :param update: if True, add new videos and rescan changed ones before loading
+    """
+    self.dataset_dir = Path(dataset_dir)
+    self.index_dir = Path(index_dir) if index_dir else self.dataset_dir / 'index'
+
+    if update and metadata_path:
+      self.update(metadata_path)
+
+    self.load()
+
+  def load(self):
+    self.videos = load_video_log(self.index_dir / 'videos.jsonl')
+
+    self.pages = load_table(self.index_dir / 'pages.bin', PAGE_DTYPE)
+    self.systems = load_table(self.index_dir / 'systems.bin', SYSTEM_DTYPE)
+
+    # rows of the current entry of every video, in the order the entries were logged
+    self.page_rows = np.zeros(0, np.int64)
+    live_videos = get_live_videos(self.videos)
+    if live_videos:
+      self.page_rows = np.concatenate([ np.arange(video['page_start'], video['page_start'] + video['num_pages']) for video in live_videos ])
+
+    self._audio_readers = {}
+
+  def update(self, metadata_path:Path):
+    """
+    Bring the index up to date with the segment directories of the videos
+    in the metadata file. Only videos that are new or whose outputs or
+    metadata changed are scanned. Videos that are no longer in the metadata
+    file or have no segment directory are removed.
+    """
+    with open(metadata_path, 'r') as f:
+      reader = csv.reader(f)
+      header = next(reader)
+      metadata = list(reader)
+
+    self.index_dir.mkdir(parents=True, exist_ok=True)
+    self.load()
+    old_videos = { video['yt_id']: video for video in get_live_videos(self.videos) }
+
+    # rows an interrupted update appended after the last logged entry stay unreferenced
+    page_start = num_pages = len(self.pages)
+    system_start = num_systems = len(self.systems)
+
+    entries = []
+    page_tables = []
+    system_tables = []
+
+    for row in tqdm(metadata, desc='Index', leave=False):
+      seg_dir = get_segment_dir(self.dataset_dir, row)
+      if not seg_dir.exists():
+        continue
+
+      signature = get_video_signature(seg_dir)
+      video_metadata = dict(zip(header, row))
+      old_video = old_videos.pop(row[0], None)
+
+      if old_video and old_video['signature'] == signature and old_video['metadata'] == video_metadata:
+        continue
+
+      pages, systems, audio = get_video_tables(seg_dir)
+      aliases = { str(int(page_stem.split(':')[1])): source for page_stem, source in load_aliases(seg_dir).items() }
+
+      pages['video'] = len(self.videos) + len(entries)
+      pages['system_start'] += num_systems
+
+      entries.append({
+        'yt_id': row[0],
+        'seg_dir': str(seg_dir.relative_to(self.dataset_dir)),
+        'metadata': video_metadata,
+        'signature': signature,
+        'audio': audio,
+        'aliases': aliases,
+        'page_start': num_pages,
+        'num_pages': len(pages),
+      })
+      num_pages += len(pages)
+      num_systems += len(systems)
+      page_tables.append(pages)
+      system_tables.append(systems)
+
+    entries += [ {'yt_id': yt_id, 'removed': True} for yt_id in old_videos ]
+
+    if not entries:
+      return
+
+    # the log is appended last, its entries refer to rows of the tables
+    self.pages = self.systems = None
+    append_table(self.index_dir / 'pages.bin', PAGE_DTYPE, page_start, page_tables)
+    append_table(self.index_dir / 'systems.bin', SYSTEM_DTYPE, system_start, system_tables)
+
+    append_video_log(self.index_dir / 'videos.jsonl', entries)
+
+    self.load()
+
+    # keep the replaced rows from outgrowing the current ones
+    if len(self.pages) > 2 * len(self.page_rows) + 1000:
+      self.compact()
+
+  def compact(self):
+    """
+    Rewrite the index with only the rows of the current entries
+    """
+    live_videos = get_live_videos(self.videos)
+
+    videos = []
+    page_tables = []
+    system_tables = []
+    num_pages = 0
+    num_systems = 0
+
+    for video in live_videos:
+      pages = np.array(self.pages[video['page_start']:video['page_start']+video['num_pages']])
+      systems = np.zeros(0, SYSTEM_DTYPE)
+
+      if len(pages):
+        system_start = pages['system_start'][0]
+        systems = np.array(self.systems[system_start:pages['system_start'][-1]+pages['num_systems'][-1]])
+        pages['system_start'] += num_systems - system_start
+
+      pages['video'] = len(videos)
+      videos.append({ **video, 'page_start': num_pages })
+      num_pages += len(pages)
+      num_systems += len(systems)
+      page_tables.append(pages)
+      system_tables.append(systems)
+
+    self.pages = self.systems = None
+    save_table(self.index_dir / 'pages.bin', PAGE_DTYPE, page_tables)
+    save_table(self.index_dir / 'systems.bin', SYSTEM_DTYPE, system_tables)
+
+    tmp_path = self.index_dir / '.videos.jsonl.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(''.join( json.dumps(video) + '\n' for video in videos ))
+    os.replace(tmp_path, self.index_dir / 'videos.jsonl')
+
+    self.load()
+
+  def __len__(self):
+    return len(self.page_rows)
+
+  def get_seg_dir(self, video_idx:int) -> Path:
+    return self.dataset_dir / self.videos[video_idx]['seg_dir']
+
+  def get_page(self, i:int) -> np.void:
+    """
+    Row of sample i in the page table
+    """
+    return self.pages[self.page_rows[i]]
+
+  def get_audio_path(self, i:int) -> Path:
+    """
+    Path of the audio segment of sample i, or of the whole track with a single audio file
+    """
+    page = self.get_page(i)
+    video = self.videos[page['video']]
+    audio_dir = self.get_seg_dir(page['video']) / 'audio' / 'original'
+
+    if video['audio'] == 'track':
+      return get_audio_track_paths(audio_dir, video['yt_id'])[0]
+
+    return audio_dir / get_segment_name(video['yt_id'], int(page['page']), float(page['start_time']), float(page['end_time']))
+
+  def get_audio(self, i:int) -> np.ndarray:
+    """
+    int16 samples of the audio segment of sample i, shape (frames, channels)
+    """
+    page = self.get_page(i)
+    audio_path = self.get_audio_path(i)
+
+    if page['audio_index'] >= 0:
+      reader = self._audio_readers.get(audio_path)
+      if reader is None:
+        reader = self._audio_readers[audio_path] = AudioTrackReader(audio_path)
+      return reader[int(page['audio_index'])]
+
+    with wave.open(str(audio_path), 'rb') as wav:
+      data = wav.readframes(wav.getnframes())
+      return np.frombuffer(data, dtype='<i2').reshape(-1, wav.getnchannels())
+
+  def get_crop_paths(self, i:int) -> list[Path]:
+    """
+    Paths of the resized crops of the systems of sample i that have one
+    """
+    page = self.get_page(i)
+    video = self.videos[page['video']]
+    crop_dir = self.get_seg_dir(page['video']) / 'images' / 'crop_resized'
+    page_stem = f'{get_page_key(video["yt_id"], int(page["page"]))}:{page["frame"]}'
+
+    # the crops of a duplicate page are the ones of its first instance
+    source = video.get('aliases', {}).get(str(int(page['page'])))
+    if source:
+      source_path = self.dataset_dir / source
+      crop_dir = source_path.parent.parent / 'crop_resized'
+      page_stem = source_path.stem
+
+    systems = self.systems[page['system_start']:page['system_start']+page['num_systems']]
+
+    return [ find_image_path(crop_dir / f'{page_stem}:{str(system["index"]).zfill(4)}.png') for system in systems if system['has_crop_resized'] ]
+
+  def __getitem__(self, i:int) -> dict:
+    page = self.get_page(i)
+    video = self.videos[page['video']]
+    systems = self.systems[page['system_start']:page['system_start']+page['num_systems']]
+
+    return {
+      'key': get_page_key(video['yt_id'], int(page['page'])),
+      'yt_id': video['yt_id'],
+      'metadata': video['metadata'],
+      'page': int(page['page']),
+      'frame': int(page['frame']),
+      'start_time': float(page['start_time']),
+      'end_time': float(page['end_time']),
+      'audio_path': self.get_audio_path(i),
+      'systems': systems,
+      'crop_paths': self.get_crop_paths(i),
+    }
+
+
+def get_video_tables(seg_dir:Path) -> tuple[np.ndarray, np.ndarray, str]:
+  """
+  :return: (page table, system table, 'track' or 'segments') of a video,
+    system_start relative to the video
+  """
+  samples = collect_video_samples(seg_dir)
+
+  pages = np.zeros(len(samples), dtype=PAGE_DTYPE)
+  systems = np.zeros(sum( len(sample['systems']) for sample in samples ), dtype=SYSTEM_DTYPE)
+  audio = 'segments'
+
+  system_start = 0
+  for i, sample in enumerate(samples):
+    audio_index = -1
+    if isinstance(sample['audio'], tuple):
+      audio_index = sample['audio'][1]
+      audio = 'track'
+
+    frame = sample['frame'] if sample['frame'] is not None else -1
+    pages[i] = (0, sample['page'], frame, sample['start_time'], sample['end_time'], audio_index, system_start, len(sample['systems']))
+
+    for system in sample['systems']:
+      staff_bboxs = system['staff_bboxs']
+      staff_height = sum( y2 - y1 for _, y1, _, y2, _ in staff_bboxs ) / len(staff_bboxs) if staff_bboxs else 0
+
+      systems[system_start] = (system['index'], system['bbox'], system['conf'], len(staff_bboxs), staff_height, system['crop_resized'] is not None)
+      system_start += 1
+
+  return pages, systems, audio
+
+
+def load_table(path:Path, dtype:np.dtype) -> np.ndarray:
+  """
+  Memory-mapped rows of a table file, a partial row at the end is ignored
+  """
+  num_rows = path.stat().st_size // dtype.itemsize if path.exists() else 0
+  if num_rows == 0:
+    return np.zeros(0, dtype)
+
+  return np.memmap(path, dtype=dtype, mode='r', shape=(num_rows,))
+
+
+def append_table(path:Path, dtype:np.dtype, num_rows:int, tables:list[np.ndarray]):
+  """
+  Append rows to a table file after its first num_rows rows
+  """
+  with open(path, 'ab') as f:
+    f.truncate(num_rows * dtype.itemsize)
+    for table in tables:
+      f.write(table.astype(dtype, copy=False).tobytes())
+
+
+def save_table(path:Path, dtype:np.dtype, tables:list[np.ndarray]):
+  tmp_path = path.with_name(f'.{path.name}.tmp')
+  append_table(tmp_path, dtype, 0, tables)
+  os.replace(tmp_path, path)
+
+
+def load_video_log(path:Path) -> list[dict]:
+  """
+  Entries of the video log, a partial line at the end is ignored
+  """
+  if not path.exists():
+    return []
+
+  entries = []
+  with open(path, 'r') as f:
+    for line in f:
+      if not line.endswith('\n'):
+        break
+      entries.append(json.loads(line))
+
+  return entries
+
+
+def append_video_log(path:Path, entries:list[dict]):
+  """
+  Append entries to the video log after its last complete line
+  """
+  with open(path, 'ab+') as f:
+    f.seek(0)
+    f.truncate(f.read().rfind(b'\n') + 1)
+    f.write(''.join( json.dumps(entry) + '\n' for entry in entries ).encode())
+
+
+def get_live_videos(entries:list[dict]) -> list[dict]:
+  """
+  Current entry of every video in the log, in log order. A later entry
+  of a video replaces the earlier ones, a removal entry drops the video.
+  """
+  last_entries = {}
+  for i, entry in enumerate(entries):
+    last_entries.pop(entry['yt_id'], None)
+    if not entry.get('removed'):
+      last_entries[entry['yt_id']] = i
+
+  return [ entries[i] for i in sorted(last_entries.values()) ]
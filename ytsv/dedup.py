@@ -0,0 +1,339 @@
+"""
+Perceptual deduplication of the pages of score videos.
+
+Repeats, da capo sections and title pages between movements show the same
+page several times. Every page gets a difference hash (dHash) of a
+grayscale thumbnail. A page whose hash is close to the one of an earlier
+page, and whose thumbnail matches that page pixel by pixel, is recorded as
+an alias of it instead of running both YOLO models, cropping and resizing
+it again:
+
+  <segment dir>/aliases.json   {"<page stem>": {"source": "<source page image, relative to the dataset dir>",
+                                                 "extract": "<extract signature of the source video>"}}
+
+Pages of different scores often share their layout, so the hash only
+selects candidates and the thumbnail comparison decides. Hashes are looked
+up by bands, two hashes within max_distance bits share at least one band.
+
+With an index file, the pages of earlier videos are candidates as well
+(cross-video aliases). Only the videos that were processed completely are
+added to it.
+
+The extract signature is a hash of the extract stage inputs of a video in
+its manifest. It changes whenever the pages of the video are extracted
+anew, e.g. after the mp4 was downloaded again, and its page images then no
+longer match the ones that were hashed. Pages whose signature is not the
+current one of their video are no candidates, and a resumed video whose
+aliases point to such pages reruns its systems stage, see get_stale_aliases.
+"""
+
+from pathlib import Path
+import hashlib
+import json
+import threading
+
+import cv2
+import numpy as np
+
+from .image_io import imread
+from .manifest import load_manifest
+
+
+DEFAULT_HASH_SIZE = 16
+DEFAULT_MAX_DISTANCE = 7
+DEFAULT_MAX_PIXEL_DIFF = 0.002
+
+THUMBNAIL_SCALE = 4
+PIXEL_DIFF_THRESHOLD = 32
+
+
+def get_aliases_path(seg_dir:Path) -> Path:
+  return seg_dir / 'aliases.json'
+
+
+def load_alias_entries(seg_dir:Path) -> dict:
+  """
+  :return: {page stem: {'source': source page path, 'extract': extract signature}}, empty without aliases
+  """
+  aliases_path = get_aliases_path(seg_dir)
+  if not aliases_path.exists():
+    return {}
+
+  with open(aliases_path, 'r') as f:
+    return json.load(f)
+
+
+def load_aliases(seg_dir:Path) -> dict:
+  """
+  :return: {page stem: path of the source page image relative to the dataset dir}, empty without aliases
+  """
+  return { page_stem: entry['source'] for page_stem, entry in load_alias_entries(seg_dir).items() }
+
+
+def get_extract_signature(extract_inputs:dict) -> str:
+  """
+  Short hash of the inputs of the extract stage of a video, None if they are unknown
+  """
+  if extract_inputs is None:
+    return None
+
+  return hashlib.sha256(json.dumps(extract_inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_extract_signature(seg_dir:Path) -> str:
+  """
+  Current extract signature of a video, from its manifest
+  """
+  entry = load_manifest(seg_dir)['stages'].get('extract')
+  return get_extract_signature(entry['inputs']) if entry else None
+
+
+def get_stale_aliases(seg_dir:Path) -> list[str]:
+  """
+  Page stems of the aliases of a video whose source video was extracted again since
+
+  :param seg_dir: segment directory of the video, dataset_dir/<staff count>/segments/<yt_id>
+  """
+  dataset_dir = seg_dir.parents[2]
+  signatures = {} # {source seg dir: extract signature}
+  stale = []
+
+  for page_stem, entry in load_alias_entries(seg_dir).items():
+    source_seg_dir = (dataset_dir / entry['source']).parents[2]
+    if source_seg_dir not in signatures:
+      signatures[source_seg_dir] = load_extract_signature(source_seg_dir)
+
+    if entry.get('extract') is None or entry['extract'] != signatures[source_seg_dir]:
+      stale.append(page_stem)
+
+  return stale
+
+
+def get_thumbnail(page_image:np.ndarray) -> np.ndarray:
+  """
+  Grayscale page image at a quarter of its size
+  """
+  if page_image.ndim == 3:
+    page_image = cv2.cvtColor(page_image, cv2.COLOR_BGR2GRAY)
+
+  height, width = page_image.shape
+  return cv2.resize(page_image, (max(1, width // THUMBNAIL_SCALE), max(1, height // THUMBNAIL_SCALE)), interpolation=cv2.INTER_AREA)
+
+
+def get_dhash(thumbnail:np.ndarray, hash_size:int=DEFAULT_HASH_SIZE) -> int:
+  """
+  Difference hash of hash_size * hash_size bits, whether each pixel is brighter than its right neighbour
+  """
+  small = cv2.resize(thumbnail, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+  bits = (small[:, 1:] > small[:, :-1]).flatten()
+
+  return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def get_pixel_diff(a:np.ndarray, b:np.ndarray) -> float:
+  """
+  Fraction of thumbnail pixels that differ noticeably, 1.0 for different sizes
+  """
+  if a.shape != b.shape:
+    return 1.0
+
+  return float(np.count_nonzero(cv2.absdiff(a, b) > PIXEL_DIFF_THRESHOLD)) / a.size
+
+
+class PageHashCache:
+  def __init__(
+    self,
+    dataset_dir:Path,
+    index_path:Path=None,
+    hash_size:int=DEFAULT_HASH_SIZE,
+    max_distance:int=DEFAULT_MAX_DISTANCE,
+    max_pixel_diff:float=DEFAULT_MAX_PIXEL_DIFF
+  ):
+    """
+    :param dataset_dir: path to the dataset directory, alias sources are relative to it
+    :param index_path: optional JSONL file of the page hashes of earlier videos, enables cross-video aliases
+    :param hash_size: side of the dHash grid, the hash has hash_size ** 2 bits
+    :param max_distance: largest Hamming distance of the hashes of duplicate pages
+    :param max_pixel_diff: largest fraction of differing thumbnail pixels of duplicate pages
+    """
+    self.dataset_dir = dataset_dir
+    self.index_path = index_path
+    self.hash_size = hash_size
+    self.max_distance = max_distance
+    self.max_pixel_diff = max_pixel_diff
+
+    # every hash is split into max_distance + 1 bands
+    self.num_bands = max_distance + 1
+    self.band_bits = -(-hash_size ** 2 // self.num_bands)
+
+    self.lock = threading.Lock()
+    self.pages = [] # [(hash, page image path relative to the dataset dir, yt_id, extract signature)]
+    self.bands = {} # {(band, value): [index in pages]}
+    self.thumbnails = {} # {index in pages: thumbnail} of the videos in progress
+    self.pending = {} # {yt_id: [index in pages]} not yet in the index file
+    self.signatures = {} # {yt_id: current extract signature}
+
+    if index_path is not None and index_path.exists():
+      with open(index_path, 'r') as f:
+        for line in f:
+          page = json.loads(line)
+          self.add_page(int(page['hash'], 16), page['path'], page['yt_id'], page.get('extract'))
+
+  def get_inputs(self) -> dict:
+    """
+    Settings recorded in the manifest of the systems stage
+    """
+    return {
+      'hash_size': self.hash_size,
+      'max_distance': self.max_distance,
+      'max_pixel_diff': self.max_pixel_diff,
+      'across_videos': self.index_path is not None,
+    }
+
+  def get_bands(self, page_hash:int) -> list[tuple[int, int]]:
+    mask = (1 << self.band_bits) - 1
+    return [ (band, (page_hash >> (band * self.band_bits)) & mask) for band in range(self.num_bands) ]
+
+  def add_page(self, page_hash:int, page_path:str, yt_id:str, extract_signature:str, thumbnail:np.ndarray=None) -> int:
+    index = len(self.pages)
+    self.pages.append( (page_hash, page_path, yt_id, extract_signature) )
+    for band in self.get_bands(page_hash):
+      self.bands.setdefault(band, []).append(index)
+
+    if thumbnail is not None:
+      self.thumbnails[index] = thumbnail
+
+    return index
+
+  def get_thumbnail(self, index:int) -> np.ndarray:
+    """
+    Thumbnail of a page of the cache, read from disk for pages of earlier videos
+    """
+    if index not in self.thumbnails:
+      page_image = imread(self.dataset_dir / self.pages[index][1], cv2.IMREAD_GRAYSCALE)
+      return get_thumbnail(page_image) if page_image is not None else None
+
+    return self.thumbnails[index]
+
+  def get_signature(self, yt_id:str, page_path:str) -> str:
+    """
+    Current extract signature of the video of a page, read from its manifest for earlier videos
+    """
+    if yt_id not in self.signatures:
+      self.signatures[yt_id] = load_extract_signature((self.dataset_dir / page_path).parents[2])
+
+    return self.signatures[yt_id]
+
+  def find_source(self, page_hash:int, thumbnail:np.ndarray, yt_id:str) -> dict:
+    """
+    :return: alias entry of an earlier page that the page duplicates, None if there is none
+    """
+    candidates = sorted({ index for band in self.get_bands(page_hash) for index in self.bands.get(band, []) })
+    pending = set(self.pending.get(yt_id, ()))
+
+    for index in candidates:
+      source_hash, source_path, source_yt_id, source_signature = self.pages[index]
+
+      # pages of the same video from an earlier run are being replaced
+      if source_yt_id == yt_id and index not in pending:
+        continue
+      if source_yt_id != yt_id and self.index_path is None:
+        continue
+      if (page_hash ^ source_hash).bit_count() > self.max_distance:
+        continue
+      # the video was extracted again since, its page images changed
+      if source_yt_id != yt_id and (source_signature is None or source_signature != self.get_signature(source_yt_id, source_path)):
+        continue
+
+      source_thumbnail = self.get_thumbnail(index)
+      if source_thumbnail is not None and get_pixel_diff(thumbnail, source_thumbnail) <= self.max_pixel_diff:
+        return {'source': source_path, 'extract': source_signature}
+
+    return None
+
+  def dedup_pages(self, yt_id:str, extract_signature:str, page_image_paths:list[Path], page_images:list[np.ndarray]=None) -> tuple[list[int], dict]:
+    """
+    Split the pages of a video into first instances and aliases.
+
+    :param yt_id: YouTube id of the video
+    :param extract_signature: extract signature of the video, see get_extract_signature
+    :param page_image_paths: page images in page order
+    :param page_images: the page images, read from page_image_paths if None
+    :return: (indices of the pages to process, {page stem: alias entry})
+    """
+    unique = []
+    aliases = {}
+
+    for i, page_image_path in enumerate(page_image_paths):
+      source = self.add_video_page(yt_id, extract_signature, page_image_path, page_images[i] if page_images is not None else None)
+      if source is None:
+        unique.append(i)
+      else:
+        aliases[Path(page_image_path).stem] = source
+
+    return unique, aliases
+
+  def add_video_page(self, yt_id:str, extract_signature:str, page_image_path:Path, page_image:np.ndarray=None) -> dict:
+    """
+    Look up a page of a video in progress and add it as a source if it is not a duplicate.
+    Safe to call from several threads.
+
+    :param extract_signature: extract signature of the video, see get_extract_signature
+    :return: alias entry {'source': source page path, 'extract': its extract signature} if the page is a duplicate, else None
+    """
+    if page_image is None:
+      page_image = imread(page_image_path, cv2.IMREAD_GRAYSCALE)
+
+    thumbnail = get_thumbnail(page_image)
+    page_hash = get_dhash(thumbnail, self.hash_size)
+
+    with self.lock:
+      self.signatures[yt_id] = extract_signature
+      source = self.find_source(page_hash, thumbnail, yt_id)
+      if source is None:
+        page_path = str(Path(page_image_path).relative_to(self.dataset_dir))
+        self.pending.setdefault(yt_id, []).append( self.add_page(page_hash, page_path, yt_id, extract_signature, thumbnail) )
+
+    return source
+
+  def finish_video(self, yt_id:str, completed:bool=True):
+    """
+    Drop the thumbnails of a video and append its pages to the index file.
+    Pages of videos that did not complete stay candidates of this run only.
+    """
+    with self.lock:
+      indices = self.pending.pop(yt_id, [])
+      for index in indices:
+        self.thumbnails.pop(index, None)
+
+      # without an index only pages of the same video are compared
+      if self.index_path is None:
+        for index in indices:
+          for band in self.get_bands(self.pages[index][0]):
+            self.bands[band].remove(index)
+
+      if not completed or self.index_path is None or not indices:
+        return
+
+      with open(self.index_path, 'a') as f:
+        for index in indices:
+          page_hash, page_path, _, extract_signature = self.pages[index]
+          f.write(json.dumps({'hash': f'{page_hash:x}', 'path': page_path, 'yt_id': yt_id, 'extract': extract_signature}) + '\n')
+
+
+def write_aliases(seg_dir:Path, aliases:dict) -> list[Path]:
+  """
+  Write the aliases of a video, remove an outdated file if it has none
+
+  :return: [aliases path] if it was written, else []
+  """
+  aliases_path = get_aliases_path(seg_dir)
+
+  if not aliases:
+    aliases_path.unlink(missing_ok=True)
+    return []
+
+  with open(aliases_path, 'w') as f:
+    json.dump(aliases, f, indent=2)
+
+  return [aliases_path]
@@ -0,0 +1,261 @@
+"""
+Per-video store of the YOLO detections.
+
+segments/<yt_id>/detections.npy holds every box of a video as one NumPy
+structured array, one row per box:
+
+  kind    YOLO_SYSTEM (system model output of a page), SYSTEM (system that
+          passed the confidence threshold and was cropped) or STAFF (staff
+          model output of a crop)
+  page, frame   the page image <yt_id>:<page>:<frame>.png
+  system  index of the crop on its page for STAFF boxes, -1 otherwise
+  bbox    lx, ly, rx, ry in the page image, or in the crop for STAFF boxes
+  conf    detection confidence
+
+Rows are sorted by kind, page and system, the boxes of one image by y, x.
+Each stage replaces the rows of its kind and drops the rows of the stages
+after it, like the manifest. load_detections memory-maps the file, so
+statistics over all boxes of the dataset are a few array operations:
+
+  for yt_id, detections in iter_video_detections(dataset_dir, metadata_path):
+    staffs = detections[detections['kind'] == STAFF]
+    staff_heights = staffs['bbox'][:, 3] - staffs['bbox'][:, 1]
+
+Videos processed before the store existed keep their text files
+(<page>_yolo_bboxs.txt, <page>_system_bboxs.txt, <crop>_staff_heights.txt),
+which load_detections reads instead. export_text_sidecars writes the text
+files of a store.
+"""
+
+from pathlib import Path
+import os
+import csv
+
+import numpy as np
+
+from .system_utils import save_bboxs, load_bboxs
+
+
+DETECTIONS_NAME = 'detections.npy'
+
+YOLO_SYSTEM = 0
+SYSTEM = 1
+STAFF = 2
+
+# kind of the rows written by each stage, in the order of manifest.STAGES
+STAGE_KINDS = {'systems': YOLO_SYSTEM, 'crop': SYSTEM, 'staff_heights': STAFF}
+
+DETECTION_DTYPE = np.dtype([
+  ('kind', np.uint8),
+  ('page', np.int32),
+  ('frame', np.int32),
+  ('system', np.int32), # index of the crop on its page for STAFF boxes, -1 otherwise
+  ('bbox', np.int32, (4,)), # lx, ly, rx, ry
+  ('conf', np.float32),
+])
+
+# suffixes of the text files of each kind
+TEXT_SUFFIXES = {YOLO_SYSTEM: '_yolo_bboxs.txt', SYSTEM: '_system_bboxs.txt', STAFF: '_staff_heights.txt'}
+
+
+def get_detections_path(seg_dir:Path) -> Path:
+  return seg_dir / DETECTIONS_NAME
+
+
+def get_page_stem(yt_id:str, page:int, frame:int) -> str:
+  return f'{yt_id}:{str(page).zfill(4)}:{frame}'
+
+
+def parse_page_stem(page_stem:str) -> tuple[int, int]:
+  """
+  :return: (page, frame) of '{yt_id}:{page}:{frame}'
+  """
+  _, page, frame = page_stem.rsplit(':', 2)
+  return int(page), int(frame)
+
+
+def split_crop_stem(crop_stem:str) -> tuple[str, int]:
+  """
+  :return: (page stem, system) of '{page stem}:{system}'
+  """
+  page_stem, system = crop_stem.rsplit(':', 1)
+  return page_stem, int(system)
+
+
+def to_detections(kind:int, page_stem:str, bboxs:list, system:int=-1) -> np.ndarray:
+  """
+  :param kind: YOLO_SYSTEM, SYSTEM or STAFF
+  :param page_stem: stem of the page image
+  :param bboxs: [(lx, ly, rx, ry, conf), ...]
+  :param system: index of the crop on the page for STAFF boxes
+  """
+  page, frame = parse_page_stem(page_stem)
+
+  detections = np.zeros(len(bboxs), dtype=DETECTION_DTYPE)
+  detections['kind'] = kind
+  detections['page'] = page
+  detections['frame'] = frame
+  detections['system'] = system
+
+  if len(bboxs):
+    detections['bbox'] = [ bbox[:4] for bbox in bboxs ]
+    detections['conf'] = [ bbox[4] for bbox in bboxs ]
+
+  return detections
+
+
+def sort_detections(detections:np.ndarray) -> np.ndarray:
+  # lexsort is stable, the boxes of one image keep their order
+  return detections[np.lexsort( (detections['system'], detections['page'], detections['kind']) )]
+
+
+def load_detections(seg_dir:Path, mmap_mode:str='r') -> np.ndarray:
+  """
+  Detections of a video, from the text files if it has no store
+
+  :param mmap_mode: mode of np.load, None reads the store into memory
+  """
+  detections_path = get_detections_path(seg_dir)
+  if not detections_path.exists():
+    return read_text_sidecars(seg_dir)
+
+  return np.load(detections_path, mmap_mode=mmap_mode)
+
+
+def save_detections(seg_dir:Path, stage:str, detections:list[np.ndarray]) -> Path:
+  """
+  Replace the rows of a stage, drop the rows of the stages after it and save atomically.
+
+  :param stage: 'systems', 'crop' or 'staff_heights'
+  :param detections: arrays of the rows of the stage, e.g. of to_detections
+  :return: path of the store
+  """
+  kind = STAGE_KINDS[stage]
+
+  kept = np.zeros(0, dtype=DETECTION_DTYPE)
+  if kind > YOLO_SYSTEM:
+    kept = load_detections(seg_dir)
+    kept = kept[kept['kind'] < kind]
+
+  detections_path = get_detections_path(seg_dir)
+  tmp_path = detections_path.with_name(f'.{DETECTIONS_NAME}.{os.getpid()}.tmp.npy')
+
+  np.save(tmp_path, sort_detections( np.concatenate([kept, *detections]) ))
+  os.replace(tmp_path, detections_path)
+
+  return detections_path
+
+
+def group_bboxs(detections:np.ndarray, kind:int, yt_id:str) -> dict[str, list]:
+  """
+  Boxes of one kind by the image they were detected on, in store order
+
+  :return: {page stem: bboxs}, or {crop stem: bboxs} for STAFF, bboxs as [[lx, ly, rx, ry, conf], ...]
+  """
+  detections = detections[detections['kind'] == kind]
+
+  groups = {}
+  for page, frame, system, bbox, conf in zip(
+    detections['page'].tolist(),
+    detections['frame'].tolist(),
+    detections['system'].tolist(),
+    detections['bbox'].tolist(),
+    detections['conf'].tolist()
+  ):
+    stem = get_page_stem(yt_id, page, frame)
+    if kind == STAFF:
+      stem = f'{stem}:{str(system).zfill(4)}'
+    groups.setdefault(stem, []).append( [*bbox, conf] )
+
+  return groups
+
+
+def get_text_sidecar_dirs(seg_dir:Path) -> dict[int, Path]:
+  image_dir = seg_dir / 'images'
+  return {YOLO_SYSTEM: image_dir / 'original', SYSTEM: image_dir / 'original', STAFF: image_dir / 'cropped'}
+
+
+def read_text_sidecars(seg_dir:Path) -> np.ndarray:
+  """
+  Detections of a video from its text files, empty if it has none
+  """
+  detections = []
+
+  for kind, sidecar_dir in get_text_sidecar_dirs(seg_dir).items():
+    suffix = TEXT_SUFFIXES[kind]
+    for sidecar_path in sidecar_dir.glob(f'*{suffix}'):
+      stem = sidecar_path.name[:-len(suffix)]
+      if kind == STAFF:
+        page_stem, system = split_crop_stem(stem)
+        detections.append( to_detections(kind, page_stem, load_bboxs(sidecar_path), system=system) )
+      else:
+        detections.append( to_detections(kind, stem, load_bboxs(sidecar_path)) )
+
+  return sort_detections( np.concatenate([np.zeros(0, dtype=DETECTION_DTYPE), *detections]) )
+
+
+def export_text_sidecars(seg_dir:Path, detections:np.ndarray=None) -> list[Path]:
+  """
+  Write the text files of the detections of a video, as written before the store existed.
+  Every page with YOLO_SYSTEM boxes gets a system box file, which is empty if none of them was cropped.
+
+  :return: paths of the written files
+  """
+  yt_id = seg_dir.name
+  detections = load_detections(seg_dir) if detections is None else detections
+  sidecar_dirs = get_text_sidecar_dirs(seg_dir)
+
+  groups = { kind: group_bboxs(detections, kind, yt_id) for kind in TEXT_SUFFIXES }
+  groups[SYSTEM] = { page_stem: groups[SYSTEM].get(page_stem, []) for page_stem in groups[YOLO_SYSTEM] }
+
+  sidecar_paths = []
+  for kind, bboxs_by_stem in groups.items():
+    if bboxs_by_stem:
+      sidecar_dirs[kind].mkdir(parents=True, exist_ok=True)
+
+    for stem, bboxs in bboxs_by_stem.items():
+      sidecar_path = sidecar_dirs[kind] / f'{stem}{TEXT_SUFFIXES[kind]}'
+      save_bboxs(bboxs, sidecar_path)
+      sidecar_paths.append(sidecar_path)
+
+  return sidecar_paths
+
+
+def iter_segment_dirs(dataset_dir:Path, metadata_path:Path):
+  """
+  Segment directories of the processed videos of a metadata file
+  """
+  from .dataset import get_segment_dir
+
+  with open(metadata_path, 'r') as f:
+    reader = csv.reader(f)
+    header = next(reader)
+    metadata = list(reader)
+
+  for row in metadata:
+    seg_dir = get_segment_dir(dataset_dir, row)
+    if seg_dir.exists():
+      yield seg_dir
+
+
+def iter_video_detections(dataset_dir:Path, metadata_path:Path, mmap_mode:str='r'):
+  """
+  Detections of the processed videos of a metadata file
+
+  :return: generator of (yt_id, detections)
+  """
+  for seg_dir in iter_segment_dirs(dataset_dir, metadata_path):
+    yield seg_dir.name, load_detections(seg_dir, mmap_mode=mmap_mode)
+
+
+def export_dataset_text_sidecars(dataset_dir:Path, metadata_path:Path) -> int:
+  """
+  Write the text files of all videos of a metadata file that have a store
+
+  :return: number of written files
+  """
+  return sum(
+    len(export_text_sidecars(seg_dir))
+    for seg_dir in iter_segment_dirs(dataset_dir, metadata_path)
+    if get_detections_path(seg_dir).exists()
+  )
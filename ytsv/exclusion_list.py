@@ -12,6 +12,10 @@ exclude_composers = {
   },
 }
 
+exclude_videos = {
+  'string_quartet': set(),
+}
+
 exclude_pages = {
   'string_quartet': {
     # 240720 last blanks + potraits
@@ -0,0 +1,126 @@
+"""
+Lookup of the videos and pages that are left out of the dataset.
+
+The lists of exclusion_list.py, optionally extended by a JSON file of the
+same layout, are compiled into sets once per run:
+
+  {
+    "exclude_composers": {"string_quartet": ["felix_mendelssohn"], ...},
+    "exclude_videos": {"all": ["<yt_id>", ...], ...},
+    "exclude_pages": {"string_quartet": ["<yt_id>:0065", ...], ...}
+  }
+
+Composer lists apply to the videos whose Category matches the group
+('string quartet' -> 'string_quartet'), or to every video for the group
+'all'. Video ids and page keys are unique, so their group is informational.
+"""
+
+from pathlib import Path
+import re
+import json
+
+from . import exclusion_list
+
+
+ALL_GROUPS = 'all'
+
+# columns of the metadata file
+COMPOSER_COLUMN = 4
+CATEGORY_COLUMN = 8
+
+
+def normalize_name(name:str) -> str:
+  """
+  'Felix Mendelssohn' -> 'felix_mendelssohn'
+  """
+  return re.sub(r'[^0-9a-z]+', '_', name.lower()).strip('_')
+
+
+def get_page_number(page_image_path:Path) -> int:
+  """
+  Page number of a page image path, <yt_id>:<page>:<frame>.png
+  """
+  return int(Path(page_image_path).stem.split(':')[-2])
+
+
+class ExclusionList:
+  def __init__(self, composers:dict=None, videos:dict=None, pages:dict=None):
+    """
+    :param composers: {group: composer names}
+    :param videos: {group: yt_ids}
+    :param pages: {group: '<yt_id>:<page>' keys}
+    """
+    self.composers = {
+      group: frozenset( normalize_name(composer) for composer in names )
+      for group, names in (composers or {}).items()
+    }
+    self.videos = frozenset( yt_id for yt_ids in (videos or {}).values() for yt_id in yt_ids )
+
+    pages_by_video = {}
+    for keys in (pages or {}).values():
+      for key in keys:
+        yt_id, page = key.rsplit(':', 1)
+        pages_by_video.setdefault(yt_id, set()).add(int(page))
+    self.pages = { yt_id: frozenset(pages) for yt_id, pages in pages_by_video.items() }
+
+  @classmethod
+  def load(cls, path:Path=None) -> 'ExclusionList':
+    """
+    Lists of exclusion_list.py, extended by the JSON file at path if given
+    """
+    lists = {
+      'composers': { group: set(names) for group, names in exclusion_list.exclude_composers.items() },
+      'videos': { group: set(yt_ids) for group, yt_ids in exclusion_list.exclude_videos.items() },
+      'pages': { group: set(keys) for group, keys in exclusion_list.exclude_pages.items() },
+    }
+
+    if path is not None:
+      with open(path, 'r') as f:
+        extra = json.load(f)
+
+      for name, groups in lists.items():
+        for group, values in extra.get(f'exclude_{name}', {}).items():
+          groups.setdefault(group, set()).update(values)
+
+    return cls(**lists)
+
+  def is_video_excluded(self, metadata:list[str]) -> bool:
+    """
+    :param metadata: row of the metadata file
+    """
+    if metadata[0] in self.videos:
+      return True
+
+    if len(metadata) <= CATEGORY_COLUMN:
+      return False
+
+    composer = normalize_name(metadata[COMPOSER_COLUMN])
+    group = normalize_name(metadata[CATEGORY_COLUMN])
+
+    return composer in self.composers.get(group, ()) or composer in self.composers.get(ALL_GROUPS, ())
+
+  def get_excluded_pages(self, yt_id:str) -> frozenset:
+    """
+    :return: excluded page numbers of a video
+    """
+    return self.pages.get(yt_id, frozenset())
+
+  def filter_metadata(self, metadata:list[list[str]]) -> tuple[list[list[str]], list[list[str]]]:
+    """
+    :return: (kept rows, excluded rows)
+    """
+    kept, excluded = [], []
+    for row in metadata:
+      (excluded if self.is_video_excluded(row) else kept).append(row)
+
+    return kept, excluded
+
+
+def filter_page_paths(page_image_paths:list[Path], exclude_pages) -> list[Path]:
+  """
+  Page image paths without the excluded page numbers
+  """
+  if not exclude_pages:
+    return page_image_paths
+
+  return [ p for p in page_image_paths if get_page_number(p) not in exclude_pages ]
@@ -0,0 +1,174 @@
+"""
+Codecs of the page, crop and resized images.
+
+Pages, crops and resized crops are each written with their own codec,
+given as a spec string:
+
+  png        PNG with the default settings of OpenCV
+  png:<0-9>  PNG with this zlib compression level, 0 is the fastest and largest
+  webp       lossless WebP, smaller than PNG but slower to encode
+  npy        raw NumPy array, no encoding, for intermediates that are read back soon
+  none       no file, only for the resized crops, which ytsv.retarget can write later
+
+The codec decides the suffix of a file. imread reads all of them, and
+looks for the file of another codec if the path it was given does not
+exist, so readers do not need to know which codec wrote an image.
+
+python -m ytsv.benchmarks.codecs compares the encode time and size of the codecs.
+"""
+
+from pathlib import Path
+import io
+
+import cv2
+import numpy as np
+
+
+DEFAULT_CODEC = 'png'
+
+# writes nothing, pages and crops are skipped with save_pages and save_crops instead
+NO_WRITE_CODEC = 'none'
+
+# suffix of each codec
+CODEC_SUFFIXES = {'png': '.png', 'webp': '.webp', 'npy': '.npy'}
+IMAGE_SUFFIXES = tuple(CODEC_SUFFIXES.values())
+
+# a WebP quality above 100 selects lossless compression
+WEBP_LOSSLESS_QUALITY = 101
+
+
+class ImageCodec:
+  def __init__(self, spec:str=None, allow_none:bool=False):
+    """
+    :param spec: 'png', 'png:<level>', 'webp' or 'npy', None is 'png'
+    :param allow_none: if True, also 'none', which has no suffix and writes nothing
+    """
+    self.spec = spec or DEFAULT_CODEC
+
+    if self.spec == NO_WRITE_CODEC:
+      if not allow_none:
+        raise ValueError(f'image codec {NO_WRITE_CODEC!r} is only available for the resized crops, pages and crops are skipped with save_pages and save_crops')
+      self.name = NO_WRITE_CODEC
+      self.level = None
+      self.suffix = None
+      return
+
+    name, _, level = self.spec.partition(':')
+    if name not in CODEC_SUFFIXES or (level and (name != 'png' or not level.isdigit() or int(level) > 9)):
+      raise ValueError(f'unknown image codec {self.spec!r}, expected png, png:<0-9>, webp or npy')
+
+    self.name = name
+    self.level = int(level) if level else None
+    self.suffix = CODEC_SUFFIXES[name]
+
+  def get_params(self) -> list[int]:
+    """
+    Parameters of cv2.imwrite and cv2.imencode, none for the defaults of OpenCV
+    """
+    if self.name == 'png' and self.level is not None:
+      return [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+    if self.name == 'webp':
+      return [cv2.IMWRITE_WEBP_QUALITY, WEBP_LOSSLESS_QUALITY]
+    return []
+
+  def encode(self, image:np.ndarray) -> bytes:
+    """
+    Contents of the file write would produce
+    """
+    if self.name == 'npy':
+      buffer = io.BytesIO()
+      np.save(buffer, image)
+      return buffer.getvalue()
+
+    success, data = cv2.imencode(self.suffix, image, self.get_params())
+    if not success:
+      raise ValueError(f'failed to encode image as {self.spec}')
+
+    return data.tobytes()
+
+  def write(self, path:Path, image:np.ndarray) -> bool:
+    """
+    Write an image and remove the image of another codec with the same stem,
+    which a run with that codec left behind
+
+    :param path: output path with the suffix of the codec
+    :return: False if the image could not be written, like cv2.imwrite
+    """
+    if self.name == 'npy':
+      try:
+        with open(path, 'wb') as f:
+          np.save(f, image)
+      except OSError:
+        return False
+    elif not cv2.imwrite(str(path), image, self.get_params()):
+      return False
+
+    for suffix in IMAGE_SUFFIXES:
+      if suffix != self.suffix:
+        Path(path).with_suffix(suffix).unlink(missing_ok=True)
+
+    return True
+
+
+def parse_codec(spec:str) -> str:
+  """
+  argparse type of codec specs, raises ValueError for unknown ones
+  """
+  return ImageCodec(spec).spec
+
+
+def parse_resized_codec(spec:str) -> str:
+  """
+  argparse type of the codec of the resized crops, which can also be 'none'
+  """
+  return ImageCodec(spec, allow_none=True).spec
+
+
+def find_image_path(path:Path) -> Path:
+  """
+  path if it exists, else the existing image of another codec with the same stem, else path
+  """
+  path = Path(path)
+  if path.exists():
+    return path
+
+  for suffix in IMAGE_SUFFIXES:
+    other_path = path.with_suffix(suffix)
+    if other_path.exists():
+      return other_path
+
+  return path
+
+
+def glob_images(image_dir:Path, pattern:str='*') -> list[Path]:
+  """
+  Sorted images of all codecs in image_dir whose stem matches pattern
+  """
+  return sorted( p for suffix in IMAGE_SUFFIXES for p in Path(image_dir).glob(f'{pattern}{suffix}') )
+
+
+def imread(path:Path, flags:int=cv2.IMREAD_UNCHANGED) -> np.ndarray:
+  """
+  cv2.imread for images of all codecs, None if there is no image
+
+  :param path: image path, the image of another codec is read if it does not exist
+  :param flags: cv2.IMREAD_UNCHANGED, cv2.IMREAD_COLOR or cv2.IMREAD_GRAYSCALE
+  """
+  path = find_image_path(path)
+
+  if path.suffix != '.npy':
+    return cv2.imread(str(path), flags)
+
+  try:
+    image = np.load(path)
+  except OSError:
+    return None
+
+  if flags == cv2.IMREAD_GRAYSCALE and image.ndim == 3:
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+  if flags == cv2.IMREAD_COLOR and image.ndim == 2:
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+  if flags == cv2.IMREAD_COLOR and image.shape[2] == 4:
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+
+  return image
@@ -0,0 +1,161 @@
+"""
+Per-video manifest of completed processing stages.
+
+segments/<yt_id>/manifest.json records, for every stage that finished, the
+inputs it ran with (mp4 size/mtime, model checkpoint hash, target height, ...)
+and the files it produced. A rerun can then skip every stage whose inputs are
+unchanged and whose outputs still exist, and resume at the first stale one.
+"""
+
+from pathlib import Path
+import os
+import json
+import hashlib
+from functools import lru_cache
+
+from .utils import get_ts
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# in processing order, rerunning a stage invalidates all stages after it
+STAGES = ['extract', 'systems', 'crop', 'staff_heights', 'resize']
+
+
+def get_file_signature(file_path:Path) -> dict:
+  stat = Path(file_path).stat()
+  return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+@lru_cache(maxsize=None)
+def _get_file_hash(file_path:str, size:int, mtime:float) -> str:
+  sha256 = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha256.update(chunk)
+
+  return sha256.hexdigest()
+
+
+def get_file_hash(file_path:Path) -> str:
+  """
+  sha256 of a file, cached as long as its size and mtime do not change
+  """
+  signature = get_file_signature(file_path)
+  return _get_file_hash(str(file_path), signature['size'], signature['mtime'])
+
+
+def get_model_hash(yolo) -> str:
+  """
+  Hash of the checkpoint a YOLO model was loaded or exported from, None if unknown
+  """
+  checkpoint_path = getattr(yolo, 'source_checkpoint_path', None) or getattr(yolo, 'ckpt_path', None)
+  if not checkpoint_path or not Path(checkpoint_path).is_file():
+    return None
+
+  return get_file_hash(checkpoint_path)
+
+
+def get_model_inputs(yolo) -> dict:
+  """
+  Stage inputs of a YOLO model, the backend is only recorded for exported models
+  """
+  inputs = {'checkpoint': get_model_hash(yolo)}
+
+  backend = getattr(yolo, 'backend', 'pytorch')
+  if backend != 'pytorch':
+    inputs['backend'] = backend
+
+  return inputs
+
+
+def load_manifest(seg_dir:Path) -> dict:
+  manifest_path = seg_dir / MANIFEST_NAME
+
+  if not manifest_path.exists():
+    return {'yt_id': seg_dir.name, 'stages': {}}
+
+  try:
+    with open(manifest_path, 'r') as f:
+      return json.load(f)
+  except json.JSONDecodeError:
+    # interrupted write of an older version, start over
+    return {'yt_id': seg_dir.name, 'stages': {}}
+
+
+def save_manifest(seg_dir:Path, manifest:dict):
+  manifest_path = seg_dir / MANIFEST_NAME
+  tmp_path = manifest_path.with_name(f'.{MANIFEST_NAME}.{os.getpid()}.tmp')
+
+  with open(tmp_path, 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+  # atomic, a crash never leaves a half written manifest
+  os.replace(tmp_path, manifest_path)
+
+
+def is_stage_done(seg_dir:Path, manifest:dict, stage:str, inputs:dict) -> bool:
+  """
+  True if the stage finished with the same inputs and all of its outputs
+  still exist. Stages have to be checked in order: since mark_stage_done
+  drops the records of the following stages, a stage can only be recorded
+  if the stages before it were up to date when it ran.
+  """
+  entry = manifest['stages'].get(stage)
+  if entry is None:
+    return False
+
+  # compare as JSON, e.g. tuples are stored as lists
+  if entry['inputs'] != json.loads(json.dumps(inputs)):
+    return False
+
+  return all( (seg_dir / output).exists() for output in entry['outputs'] )
+
+
+def get_first_stale_stage(seg_dir:Path, manifest:dict, stage_inputs:dict) -> int:
+  """
+  :param stage_inputs: inputs of every stage, {stage: inputs}
+  :return: index in STAGES of the first stage to run, len(STAGES) if all are done
+  """
+  for i, stage in enumerate(STAGES):
+    if not is_stage_done(seg_dir, manifest, stage, stage_inputs[stage]):
+      return i
+
+  return len(STAGES)
+
+
+def get_stage_outputs(seg_dir:Path, manifest:dict, stage:str, suffix:str|tuple[str]=None, directory:str=None) -> list[Path]:
+  """
+  :param suffix: if given, only outputs with this suffix or one of these suffixes, e.g. '.png'
+  :param directory: if given, only outputs in this directory of seg_dir, e.g. 'images/cropped'
+  """
+  outputs = [ seg_dir / output for output in manifest['stages'][stage]['outputs'] ]
+
+  if suffix:
+    suffixes = (suffix,) if isinstance(suffix, str) else tuple(suffix)
+    outputs = [ output for output in outputs if output.suffix in suffixes ]
+
+  if directory:
+    outputs = [ output for output in outputs if output.parent == seg_dir / directory ]
+
+  return outputs
+
+
+def mark_stage_done(seg_dir:Path, manifest:dict, stage:str, inputs:dict, outputs:list[Path], **values):
+  """
+  Record a finished stage, drop the records of all stages after it and save.
+
+  :param outputs: files produced by the stage
+  :param values: extra JSON-serializable results of the stage, e.g. staff heights
+  """
+  for next_stage in STAGES[STAGES.index(stage)+1:]:
+    manifest['stages'].pop(next_stage, None)
+
+  manifest['stages'][stage] = {
+    'inputs': inputs,
+    'outputs': [ str(Path(output).relative_to(seg_dir)) for output in outputs ],
+    'completed_at': get_ts(),
+    **values
+  }
+
+  save_manifest(seg_dir, manifest)
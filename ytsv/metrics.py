@@ -0,0 +1,228 @@
+"""
+Per-video, per-stage metrics of the processing stages.
+
+Every stage run for a video records its wall time, CPU time, the peak RSS
+of the whole process so far (getrusage has no per-stage peak) and stage
+specific counters (decoded frames, pages, crops, skipped items, bytes
+written, fill of the model batches, ...).
+MetricsWriter appends one JSON line per video and can keep a Prometheus
+text file with the totals per stage up to date, for the textfile collector
+of node_exporter.
+"""
+
+from pathlib import Path
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+from .utils import get_ts
+
+
+# Prometheus names of the summed stage values, the others are ytsv_stage_<key>_total
+PROMETHEUS_NAMES = {
+  'wall_time': 'ytsv_stage_wall_seconds_total',
+  'cpu_time': 'ytsv_stage_cpu_seconds_total',
+  'bytes_written': 'ytsv_stage_written_bytes_total',
+}
+
+
+def get_peak_rss() -> int:
+  """
+  Peak resident set size of this process in bytes
+  """
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on linux, bytes on macOS
+  return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def get_bytes_written(paths:list[Path]) -> int:
+  return sum( Path(p).stat().st_size for p in paths if Path(p).is_file() )
+
+
+def get_batch_fill(batch_items:int, batch_slots:float) -> float:
+  """
+  Ratio of used to available slots of the batches that were submitted to a model
+  """
+  if not batch_slots:
+    return None
+  return batch_items / batch_slots
+
+
+class StageTimer:
+  def __init__(self, name:str, cpu_clock=time.process_time):
+    """
+    :param name: name of the stage
+    :param cpu_clock: clock of the CPU time, time.process_time for the whole process,
+      time.thread_time if other threads work on other videos at the same time
+    """
+    self.name = name
+    self.cpu_clock = cpu_clock
+    self.counters = {}
+
+    self.wall_time = None
+    self.cpu_time = None
+    self.process_peak_rss = None
+    self.failed = False
+
+  def add(self, **counters):
+    """
+    Add to counters of the stage, None values are skipped
+    """
+    for key, value in counters.items():
+      if value is not None:
+        self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, **values):
+    """
+    Set values of the stage that are not summed, e.g. ratios
+    """
+    self.counters.update({ key: value for key, value in values.items() if value is not None })
+
+  def add_time(self, wall_time:float, cpu_time:float):
+    """
+    Add time measured outside of the context manager, e.g. the share of a video
+    in a batch of several videos
+    """
+    self.wall_time = (self.wall_time or 0) + wall_time
+    self.cpu_time = (self.cpu_time or 0) + cpu_time
+    self.process_peak_rss = get_peak_rss()
+
+  def __enter__(self):
+    self._start_wall = time.perf_counter()
+    self._start_cpu = self.cpu_clock()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self.add_time(time.perf_counter() - self._start_wall, self.cpu_clock() - self._start_cpu)
+    self.failed = exc_type is not None
+
+  def to_dict(self) -> dict:
+    batch_fill_ratio = get_batch_fill(self.counters.get('batch_items'), self.counters.get('batch_slots'))
+
+    return {
+      'wall_time': self.wall_time,
+      'cpu_time': self.cpu_time,
+      'process_peak_rss': self.process_peak_rss,
+      'failed': self.failed,
+      **self.counters,
+      **({'batch_fill_ratio': batch_fill_ratio} if batch_fill_ratio is not None else {}),
+    }
+
+
+class VideoMetrics:
+  def __init__(self, yt_id:str, cpu_clock=time.process_time):
+    """
+    :param yt_id: id of the video
+    :param cpu_clock: clock of the CPU time of the stages, see StageTimer
+    """
+    self.yt_id = yt_id
+    self.cpu_clock = cpu_clock
+    self.started_at = get_ts()
+    self.stages = {} # {stage: StageTimer or dict from a worker process}
+    self.error = None
+
+  def stage(self, name:str) -> StageTimer:
+    """
+    Timer of a stage, use as a context manager around the stage
+    """
+    self.stages[name] = StageTimer(name, cpu_clock=self.cpu_clock)
+    return self.stages[name]
+
+  def get_stage(self, name:str) -> StageTimer:
+    """
+    Timer of a stage that is measured in parts with StageTimer.add_time, created on first use
+    """
+    if name not in self.stages:
+      self.stages[name] = StageTimer(name, cpu_clock=self.cpu_clock)
+    return self.stages[name]
+
+  def update(self, stages:dict):
+    """
+    Add stages measured in another process, {stage: StageTimer.to_dict()}
+    """
+    self.stages.update(stages)
+
+  def to_dict(self) -> dict:
+    stages = { name: stage.to_dict() if isinstance(stage, StageTimer) else stage for name, stage in self.stages.items() }
+
+    return {
+      'yt_id': self.yt_id,
+      'started_at': self.started_at,
+      'finished_at': get_ts(),
+      'failed': self.error is not None or any( stage['failed'] for stage in stages.values() ),
+      'error': self.error,
+      'wall_time': sum( stage['wall_time'] or 0 for stage in stages.values() ),
+      'cpu_time': sum( stage['cpu_time'] or 0 for stage in stages.values() ),
+      'stages': stages,
+    }
+
+
+class MetricsWriter:
+  def __init__(self, jsonl_path:Path, prometheus_path:Path=None):
+    """
+    :param jsonl_path: file the metrics of every video are appended to
+    :param prometheus_path: optional Prometheus text file with the totals of this run
+    """
+    self.jsonl_path = jsonl_path
+    self.prometheus_path = prometheus_path
+
+    self.lock = threading.Lock()
+    self.num_videos = 0
+    self.num_failed = 0
+    self.peak_rss = 0
+    self.totals = {} # {(stage, key): value}
+
+  def write(self, metrics:VideoMetrics):
+    record = metrics.to_dict()
+
+    with self.lock:
+      with open(self.jsonl_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+      if self.prometheus_path:
+        self.add_totals(record)
+        self.write_prometheus()
+
+  def add_totals(self, record:dict):
+    self.num_videos += 1
+    self.num_failed += int(record['failed'])
+
+    for stage, values in record['stages'].items():
+      for key, value in values.items():
+        if key == 'process_peak_rss':
+          self.peak_rss = max(self.peak_rss, value or 0)
+        # ratios are not summed
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and not key.endswith('_ratio'):
+          self.totals[(stage, key)] = self.totals.get((stage, key), 0) + value
+        elif key == 'failed' and value:
+          self.totals[(stage, 'failed_runs')] = self.totals.get((stage, 'failed_runs'), 0) + 1
+
+  def write_prometheus(self):
+    lines = [
+      '# HELP ytsv_videos_total Videos processed in this run',
+      '# TYPE ytsv_videos_total counter',
+      f'ytsv_videos_total {self.num_videos}',
+      '# HELP ytsv_videos_failed_total Videos that failed in this run',
+      '# TYPE ytsv_videos_failed_total counter',
+      f'ytsv_videos_failed_total {self.num_failed}',
+      '# HELP ytsv_process_peak_rss_bytes Peak resident set size of the process',
+      '# TYPE ytsv_process_peak_rss_bytes gauge',
+      f'ytsv_process_peak_rss_bytes {self.peak_rss}',
+    ]
+
+    for key in sorted({ key for _, key in self.totals }):
+      name = PROMETHEUS_NAMES.get(key, f'ytsv_stage_{key}_total')
+
+      lines.append(f'# TYPE {name} counter')
+      for (stage, stage_key), value in sorted(self.totals.items()):
+        if stage_key == key:
+          lines.append(f'{name}{{stage="{stage}"}} {value}')
+
+    # the collector must never read a partially written file
+    tmp_path = self.prometheus_path.with_name(f'.{self.prometheus_path.name}.tmp')
+    with open(tmp_path, 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, self.prometheus_path)
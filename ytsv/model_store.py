@@ -0,0 +1,263 @@
+"""
+Local store of the YOLO model checkpoints.
+
+Checkpoints are streamed to a .part file in chunks, so a download never
+holds the whole checkpoint in memory and an interrupted one resumes with
+an HTTP range request, or is kept if it was already complete. A finished
+download is checked against its pinned sha256 (MODEL_SHA256) or, for
+models without one, against the sha256 recorded next to it when it was
+first downloaded, and moved into place with an atomic rename. A mismatch
+with a pinned sha256 is an error. A recorded sha256 only trusts whatever
+was downloaded first, so using a checkpoint without a pinned one warns
+with its sha256, to be pinned in MODEL_SHA256. A file lock per checkpoint
+makes parallel workers on one node wait for a single download instead of
+racing each other.
+
+The store directory can be shared by several checkpoint directories and
+runs (--model-cache-dir or YTSV_MODEL_CACHE). In offline mode
+(--offline or YTSV_OFFLINE=1) nothing is downloaded and every checkpoint
+must already be in the store.
+"""
+
+from pathlib import Path
+import os
+import json
+import fcntl
+import warnings
+from contextlib import contextmanager
+
+import requests
+
+from .utils import YOLO_MODELS_URLS, get_ts
+from .manifest import get_file_hash
+
+
+# sha256 of the released checkpoints, {checkpoint name: sha256}. Checkpoints
+# without one are checked against the hash recorded at their first download,
+# with an UnpinnedChecksumWarning.
+MODEL_SHA256 = {}
+
+CACHE_DIR_ENV = 'YTSV_MODEL_CACHE'
+OFFLINE_ENV = 'YTSV_OFFLINE'
+
+
+class ChecksumError(Exception):
+  pass
+
+
+class UnpinnedChecksumWarning(UserWarning):
+  pass
+
+
+def warn_unpinned(name:str, sha256:str):
+  warnings.warn(
+    f'YOLO model checkpoint {name} has no pinned sha256, its content is trusted as first seen '
+    f'(sha256 {sha256}), pin it in ytsv.model_store.MODEL_SHA256',
+    UnpinnedChecksumWarning,
+    stacklevel=3
+  )
+
+
+def get_default_cache_dir(checkpoint_dir:Path) -> Path:
+  """
+  Store directory from YTSV_MODEL_CACHE, the checkpoint directory otherwise
+  """
+  cache_dir = os.environ.get(CACHE_DIR_ENV)
+  return Path(cache_dir) if cache_dir else checkpoint_dir
+
+
+def is_offline() -> bool:
+  return os.environ.get(OFFLINE_ENV, '').lower() in {'1', 'true', 'yes'}
+
+
+@contextmanager
+def file_lock(lock_path:Path):
+  """
+  Exclusive lock between processes, held while the context is open
+  """
+  with open(lock_path, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_range_total(content_range:str) -> int:
+  """
+  Full size of the file from a Content-Range header, e.g. 'bytes */1234' of
+  a 416 response, None if it is missing or unknown
+  """
+  if not content_range or '/' not in content_range:
+    return None
+
+  total = content_range.rsplit('/', 1)[1].strip()
+  return int(total) if total.isdigit() else None
+
+
+class ModelStore:
+  def __init__(
+    self,
+    cache_dir:Path,
+    offline:bool=False,
+    urls:dict=None,
+    sha256:dict=None,
+    chunk_size:int=1<<20,
+    timeout:float=60
+  ):
+    """
+    :param cache_dir: directory of the stored checkpoints
+    :param offline: if True, never download, missing checkpoints raise FileNotFoundError
+    :param urls: {checkpoint name: url}, default is utils.YOLO_MODELS_URLS
+    :param sha256: {checkpoint name: expected sha256}, default is MODEL_SHA256
+    :param chunk_size: bytes read from the response at once
+    :param timeout: seconds to wait for the server before giving up
+    """
+    self.cache_dir = Path(cache_dir)
+    self.offline = offline
+    self.urls = urls if urls is not None else YOLO_MODELS_URLS
+    self.sha256 = sha256 if sha256 is not None else MODEL_SHA256
+    self.chunk_size = chunk_size
+    self.timeout = timeout
+
+  def get_path(self, name:str) -> Path:
+    return self.cache_dir / name
+
+  def get_hash_path(self, path:Path) -> Path:
+    return path.with_name(path.name + '.sha256')
+
+  def get_expected_hash(self, name:str, path:Path) -> str:
+    """
+    Pinned sha256 of a checkpoint, else the one recorded at its download, None if neither exists
+    """
+    if self.sha256.get(name):
+      return self.sha256[name]
+
+    hash_path = self.get_hash_path(path)
+    if hash_path.exists():
+      with open(hash_path, 'r') as f:
+        return json.load(f)['sha256']
+
+    return None
+
+  def record_hash(self, name:str, path:Path, sha256:str):
+    hash_path = self.get_hash_path(path)
+    tmp_path = hash_path.with_name(f'.{hash_path.name}.tmp')
+
+    with open(tmp_path, 'w') as f:
+      json.dump({'name': name, 'sha256': sha256, 'url': self.urls.get(name), 'created_at': get_ts()}, f)
+    os.replace(tmp_path, hash_path)
+
+  def is_valid(self, name:str, path:Path) -> bool:
+    """
+    Check a stored checkpoint, a checkpoint without any known hash (e.g. copied
+    into the store by hand) is accepted and its hash recorded. Accepting a
+    checkpoint without a pinned hash warns.
+    """
+    if not path.is_file():
+      return False
+
+    sha256 = get_file_hash(path)
+    expected = self.get_expected_hash(name, path)
+
+    if expected is None:
+      self.record_hash(name, path, sha256)
+    elif sha256 != expected:
+      return False
+
+    if not self.sha256.get(name):
+      warn_unpinned(name, sha256)
+
+    return True
+
+  def fetch(self, name:str) -> Path:
+    """
+    Path of a checkpoint in the store, downloaded if it is missing or corrupt
+
+    :param name: checkpoint name, a key of urls
+    :return: path to the verified checkpoint
+    """
+    return self.download(name, self.get_path(name))
+
+  def download(self, name:str, path:Path) -> Path:
+    """
+    Download a checkpoint to path unless a verified copy is already there.
+
+    :param name: checkpoint name, a key of urls
+    :param path: destination of the checkpoint
+    :return: path
+    """
+    if self.is_valid(name, path):
+      return path
+
+    if self.offline:
+      if path.is_file():
+        raise ChecksumError(f'sha256 of the YOLO model checkpoint {path} does not match {self.get_expected_hash(name, path)} and downloads are disabled (offline)')
+      raise FileNotFoundError(f'YOLO model checkpoint {name} is missing in {path.parent} and downloads are disabled (offline)')
+
+    if name not in self.urls:
+      raise KeyError(f'No download url for YOLO model checkpoint {name}')
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with file_lock(path.with_name(f'.{path.name}.lock')):
+      # another process may have finished the download while we waited
+      if self.is_valid(name, path):
+        return path
+
+      part_path = path.with_name(path.name + '.part')
+      self.download_part(self.urls[name], part_path)
+
+      sha256 = get_file_hash(part_path)
+      expected = self.sha256.get(name)
+
+      if expected and sha256 != expected:
+        part_path.unlink()
+        raise ChecksumError(f'sha256 of the downloaded YOLO model checkpoint {name} is {sha256}, expected {expected}')
+
+      os.replace(part_path, path)
+      self.record_hash(name, path, sha256)
+
+      if not expected:
+        warn_unpinned(name, sha256)
+
+    return path
+
+  def download_part(self, url:str, part_path:Path):
+    """
+    Stream url to part_path, continuing a partial file with a range request
+    """
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    with requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=self.timeout) as r:
+      if r.status_code == 416:
+        # the part is already complete, e.g. the process died before moving it into place,
+        # it is verified like any finished download
+        if get_range_total(r.headers.get('Content-Range')) == offset:
+          return
+
+        # the file changed on the server
+        part_path.unlink()
+        return self.download_part(url, part_path)
+
+      if r.status_code not in (200, 206):
+        raise Exception(f'Failed to download YOLO model checkpoint from {url}: HTTP {r.status_code}')
+
+      # servers that ignore the range send the whole file again
+      if r.status_code == 200:
+        offset = 0
+
+      expected_size = None
+      if 'Content-Length' in r.headers:
+        expected_size = offset + int(r.headers['Content-Length'])
+
+      with open(part_path, 'ab' if offset else 'wb') as f:
+        for chunk in r.iter_content(chunk_size=self.chunk_size):
+          f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+    size = part_path.stat().st_size
+    if expected_size is not None and size != expected_size:
+      raise IOError(f'Incomplete download of {url}: {size} of {expected_size} bytes, rerun to resume')
@@ -0,0 +1,448 @@
+"""
+Streaming version of process_videos_from_scratch.
+
+Every stage runs in its own thread and passes items to the next stage through
+a bounded queue:
+
+  decode -> system YOLO -> crop -> staff height YOLO -> resize
+
+so the decoder of the next video keeps running while the models work on the
+pages of the current one, and the queue sizes cap the number of pages and
+crops that are in flight at once. The YOLO stages fill their batches with
+items of all videos in flight and flush a partial batch after a deadline.
+
+Decoded pages and crops (views of the pages) travel through the queues with
+their paths, so no stage reads back what an earlier stage just wrote.
+
+With resume, a video enters the pipeline at its first stale stage (see
+ytsv.manifest): the outputs of the last up to date stage are put directly
+into the queue of the stale one.
+
+The stages of a video are measured in parts (see ytsv.metrics): each batch
+is timed on its stage thread and its time and slots are split across the
+videos in it by their number of items. The CPU time is the one of the stage
+threads, since the other threads work on other videos meanwhile.
+"""
+
+from pathlib import Path
+import threading
+import queue
+import time
+
+from tqdm.auto import tqdm
+
+from ultralytics import YOLO
+
+from .system_utils import get_system_bboxs, crop_system_images, crop_left_half, get_staff_bboxs, resize_systems
+from .utils import format_logger_msg
+from .metrics import VideoMetrics, get_bytes_written
+from .manifest import STAGES, load_manifest, get_stage_outputs, mark_stage_done
+from .exclusions import filter_page_paths
+from .image_io import IMAGE_SUFFIXES, find_image_path, imread
+from .dedup import write_aliases, get_extract_signature
+from .detections import YOLO_SYSTEM, SYSTEM, STAFF, STAGE_KINDS, to_detections, split_crop_stem, load_detections, save_detections, group_bboxs
+
+
+# marks the end of the items of one video, travels through all stages behind them
+VIDEO_DONE = 'VIDEO_DONE'
+
+
+class VideoJob:
+  def __init__(self, metadata:list[str]):
+    self.metadata = metadata
+    self.yt_id = metadata[0]
+    self.failed = False
+
+    self.seg_dir = None
+    self.manifest = None
+    self.stage_inputs = None
+    self.start_stage = 0 # index in STAGES of the first stage to run
+
+    # outputs of the stages run in this pipeline, {stage: [path, ...]}
+    self.outputs = { stage: [] for stage in STAGES }
+    # rows of the detection store of the stages run in this pipeline, {stage: [array, ...]}
+    self.detections = { stage: [] for stage in STAGE_KINDS }
+    self.staff_heights = []
+    self.aliases = {} # {page stem: alias entry}, duplicate pages that skip the pipeline
+
+    self.metrics = VideoMetrics(self.yt_id, cpu_clock=time.thread_time)
+    self.lock = threading.Lock()
+
+  def fail(self, error:Exception):
+    self.failed = True
+    self.metrics.error = self.metrics.error or repr(error)
+
+  def record_batch(self, stage:str, num_items:int, batch_len:int, batch_size:int, wall_time:float, cpu_time:float):
+    """
+    Add the share of this video in a batch of a stage to its metrics
+
+    :param num_items: number of items of this video in the batch
+    :param batch_len: number of items in the batch
+    :param batch_size: number of slots of the batch
+    """
+    share = num_items / batch_len
+    timer = self.metrics.get_stage(stage)
+    timer.add_time(wall_time * share, cpu_time * share)
+
+    # only the YOLO stages run batches of more than one item
+    if batch_size > 1:
+      timer.add(batches=share, batch_items=num_items, batch_slots=batch_size * share)
+
+  def finish_stage(self, stage:str):
+    """
+    Record a stage in the manifest once the VIDEO_DONE marker passed it
+    """
+    if self.failed or STAGES.index(stage) < self.start_stage:
+      return
+
+    values = {'staff_heights': self.staff_heights} if stage == 'staff_heights' else {}
+    outputs = self.outputs[stage] + (write_aliases(self.seg_dir, self.aliases) if stage == 'systems' else [])
+
+    with self.lock:
+      if stage in STAGE_KINDS:
+        outputs.append( save_detections(self.seg_dir, stage, self.detections[stage]) )
+      mark_stage_done(self.seg_dir, self.manifest, stage, self.stage_inputs[stage], outputs, **values)
+
+    self.metrics.get_stage(stage).add(bytes_written=get_bytes_written(outputs))
+
+
+def run_stage(
+  in_queue:queue.Queue, 
+  out_queue:queue.Queue, 
+  process_batch, 
+  batch_size:int=1, 
+  logger=None, 
+  name:str='', 
+  batch_timeout:float=None
+):
+  """
+  Generic stage loop.
+
+  Items are (job, payload) tuples. They are collected into batches of up to
+  batch_size items, which may mix items of several videos. A VIDEO_DONE
+  marker is held back until the items of its video in the current batch
+  are flushed, so all outputs of a video are ahead of its marker.
+  A partial batch is flushed batch_timeout seconds after its first item
+  arrived. Without batch_timeout it is flushed at the marker of every
+  video instead, so batches never span videos.
+  process_batch maps a list of items to a list of output items.
+  None is the shutdown signal and is forwarded to the next stage.
+  If name is one of manifest.STAGES, the stage is recorded in the manifest
+  of each video when its marker passes, and the time of every batch is
+  added to the metrics of the videos in it.
+  """
+  batch = []
+  held_markers = []
+  deadline = None
+
+  def forward_marker(item):
+    # the marker is forwarded even if recording the stage fails, or the main loop would wait for it forever
+    job = item[0]
+    if name in STAGES:
+      try:
+        job.finish_stage(name)
+      except Exception as e:
+        job.fail(e)
+        if logger:
+          logger.exception(format_logger_msg(name, {'yt_id': job.yt_id, 'error': repr(e)}))
+    out_queue.put(item)
+
+  def flush():
+    if batch:
+      start_wall = time.perf_counter()
+      start_cpu = time.thread_time()
+      try:
+        outputs = process_batch(batch)
+      except Exception as e:
+        for job in { job for job, _ in batch }:
+          job.fail(e)
+          if logger:
+            logger.exception(format_logger_msg(name, {'yt_id': job.yt_id, 'error': repr(e)}))
+        outputs = []
+
+      if name in STAGES:
+        wall_time = time.perf_counter() - start_wall
+        cpu_time = time.thread_time() - start_cpu
+        for job in { job for job, _ in batch }:
+          num_items = sum( 1 for batch_job, _ in batch if batch_job is job )
+          job.record_batch(name, num_items, len(batch), batch_size, wall_time, cpu_time)
+
+      for output in outputs:
+        out_queue.put(output)
+
+      batch.clear()
+
+    for item in held_markers:
+      forward_marker(item)
+    held_markers.clear()
+
+  while True:
+    try:
+      timeout = max(0, deadline - time.monotonic()) if deadline is not None else None
+      item = in_queue.get(timeout=timeout)
+    except queue.Empty:
+      flush()
+      deadline = None
+      continue
+
+    if item is None:
+      flush()
+      out_queue.put(None)
+      break
+
+    job, payload = item
+
+    if isinstance(payload, str) and payload == VIDEO_DONE:
+      if not batch_timeout:
+        flush()
+        deadline = None
+        forward_marker(item)
+      elif any( batch_job is job for batch_job, _ in batch ):
+        held_markers.append(item)
+      else:
+        forward_marker(item)
+
+      continue
+
+    if job.failed:
+      continue
+
+    batch.append(item)
+    if deadline is None and batch_timeout:
+      deadline = time.monotonic() + batch_timeout
+
+    if len(batch) >= batch_size:
+      flush()
+      deadline = None
+
+
+def process_videos_pipelined(
+  metadata:list[list[str]],
+  dataset_dir:Path,
+  yolo_models:list[YOLO],
+  target_height:int|list[int]=18,
+  device:str='cpu',
+  extract_kwargs:dict=None,
+  batch_size:int=64,
+  queue_size:int=256,
+  decode_threads:int=1,
+  batch_timeout:float=0.5,
+  save_crops:bool=True,
+  resume:bool=True,
+  exclusions=None,
+  page_cache=None,
+  crop_codec:str=None,
+  resized_codec:str=None,
+  metrics_writer=None,
+  logger=None
+):
+  """
+  :param metadata: rows of the metadata file
+  :param dataset_dir: path to the dataset directory
+  :param yolo_models: [system detection model, staff height detection model]
+  :param target_height: target staff height for resizing cropped images, or a list of heights, see resize_systems
+  :param device: device to run YOLO models on
+  :param extract_kwargs: extra keyword arguments for extract_pages_and_audios
+  :param batch_size: batch size for YOLO inference, default is 64
+  :param queue_size: maximum number of items waiting between two stages, default is 256
+  :param decode_threads: number of videos decoded at the same time, default is 1
+  :param batch_timeout: seconds a partial YOLO batch waits for items of other videos,
+    if 0 or None every video is batched separately, default is 0.5
+  :param save_crops: if False, cropped images are only kept in memory until they are resized
+  :param resume: if True, skip the stages of each video that are up to date in its manifest
+  :param exclusions: optional ExclusionList, excluded pages are neither decoded nor batched
+  :param page_cache: optional PageHashCache, duplicate pages are recorded as aliases on the decoding threads
+  :param crop_codec: codec of the cropped images, see image_io.ImageCodec, default is png
+  :param resized_codec: codec of the resized images, default is png, 'none' writes no resized images
+  :param metrics_writer: optional MetricsWriter the metrics of every video are written to
+    once it left the pipeline
+  :param logger: logger for failed videos
+  :return: ids of the failed videos
+  """
+  from . import get_video_paths, get_stage_inputs, get_start_stage, prepare_video, get_video_extract_kwargs
+
+  yolo_system, yolo_staff_height = yolo_models
+
+  job_queue = queue.Queue()
+  page_queue = queue.Queue(maxsize=queue_size)
+  bbox_queue = queue.Queue(maxsize=queue_size)
+  crop_queue = queue.Queue(maxsize=queue_size)
+  height_queue = queue.Queue(maxsize=queue_size)
+  done_queue = queue.Queue()
+
+  for row in metadata:
+    job_queue.put(VideoJob(row))
+
+  def decode():
+    while True:
+      try:
+        job = job_queue.get_nowait()
+      except queue.Empty:
+        break
+
+      try:
+        start(job)
+      except Exception as e:
+        job.fail(e)
+        if logger:
+          logger.exception(format_logger_msg('decode', {'yt_id': job.yt_id, 'error': repr(e)}))
+
+      page_queue.put( (job, VIDEO_DONE) )
+
+  def start(job):
+    mp4_path, job.seg_dir = get_video_paths(job.metadata, dataset_dir)
+    job.manifest = load_manifest(job.seg_dir)
+    video_extract_kwargs = get_video_extract_kwargs(job.metadata, extract_kwargs, exclusions)
+    exclude_pages = (video_extract_kwargs or {}).get('exclude_pages')
+    job.stage_inputs = get_stage_inputs(
+      mp4_path, 
+      yolo_models, 
+      target_height=target_height, 
+      extract_kwargs=video_extract_kwargs, 
+      save_crops=save_crops, 
+      exclude_pages=exclude_pages,
+      page_cache=page_cache,
+      crop_codec=crop_codec,
+      resized_codec=resized_codec
+    )
+
+    save_pages = (extract_kwargs or {}).get('save_pages', True)
+    job.start_stage = get_start_stage(job.seg_dir, job.manifest, job.stage_inputs, save_pages=save_pages, save_crops=save_crops, resume=resume)
+    extract_signature = get_extract_signature(job.stage_inputs['extract'])
+
+    def put_page(page_path, page_image):
+      if page_cache:
+        source = page_cache.add_video_page(job.yt_id, extract_signature, page_path, page_image)
+        if source is not None:
+          job.aliases[Path(page_path).stem] = source
+          return
+      page_queue.put( (job, (page_path, page_image)) )
+
+    if job.start_stage == 0:
+      prepare_video(
+        job.metadata,
+        dataset_dir,
+        extract_kwargs=video_extract_kwargs,
+        on_page=put_page,
+        resume=False,
+        metrics=job.metrics
+      )
+      # prepare_video recorded the extract stage
+      job.manifest = load_manifest(job.seg_dir)
+      return
+
+    # enter the pipeline at the first stale stage, images are read from disk where needed
+    if job.start_stage == STAGES.index('systems'):
+      page_paths = get_stage_outputs(job.seg_dir, job.manifest, 'extract', suffix=IMAGE_SUFFIXES, directory='images/original')
+      for page_path in filter_page_paths(page_paths, exclude_pages):
+        put_page(page_path, None)
+
+    elif job.start_stage == STAGES.index('crop'):
+      image_dir = job.seg_dir / 'images' / 'original'
+      for page_stem, bboxs in group_bboxs(load_detections(job.seg_dir), YOLO_SYSTEM, job.yt_id).items():
+        bbox_queue.put( (job, (find_image_path(image_dir / f'{page_stem}.png'), bboxs, None)) )
+
+    elif job.start_stage == STAGES.index('staff_heights'):
+      for crop_path in get_stage_outputs(job.seg_dir, job.manifest, 'crop', suffix=IMAGE_SUFFIXES, directory='images/cropped'):
+        crop_queue.put( (job, (crop_path, None)) )
+
+    elif job.start_stage == STAGES.index('resize'):
+      crop_paths = get_stage_outputs(job.seg_dir, job.manifest, 'crop', suffix=IMAGE_SUFFIXES, directory='images/cropped')
+      staff_heights = job.manifest['stages']['staff_heights']['staff_heights']
+      for crop_path, staff_height in zip(crop_paths, staff_heights):
+        height_queue.put( (job, (crop_path, staff_height, None)) )
+
+  def detect_systems(batch):
+    page_images = [
+      page_image if page_image is not None else imread(page_path)
+      for _, (page_path, page_image) in batch
+    ]
+    outputs = yolo_system(page_images, device=device, verbose=False)
+
+    bbox_items = []
+    for (job, (page_path, _)), page_image, output in zip(batch, page_images, outputs):
+      output.path = str(page_path)
+      bboxs = get_system_bboxs(output)
+      if bboxs:
+        job.detections['systems'].append( to_detections(YOLO_SYSTEM, Path(page_path).stem, bboxs) )
+        bbox_items.append( (job, (Path(page_path), bboxs, page_image)) )
+      job.metrics.get_stage('systems').add(pages=1, skipped=0 if bboxs else 1)
+
+    return bbox_items
+
+  def crop(batch):
+    job, (page_path, bboxs, page_image) = batch[0]
+    crop_paths, crop_images, system_bboxs = crop_system_images(page_path, bboxs, image=page_image, save_crops=save_crops, codec=crop_codec)
+
+    job.outputs['crop'] += crop_paths if save_crops else []
+    job.detections['crop'].append( to_detections(SYSTEM, page_path.stem, system_bboxs) )
+    job.metrics.get_stage('crop').add(pages=1, crops=len(crop_paths))
+
+    return [ (job, (crop_path, crop_image)) for crop_path, crop_image in zip(crop_paths, crop_images) ]
+
+  def detect_staff_heights(batch):
+    outputs = yolo_staff_height([
+      crop_left_half(crop_image if crop_image is not None else crop_path)
+      for _, (crop_path, crop_image) in batch
+    ], device=device, verbose=False)
+
+    height_items = []
+    for (job, (crop_path, crop_image)), output in zip(batch, outputs):
+      output.path = str(crop_path)
+      staff_height, staff_bboxs = get_staff_bboxs(output)
+
+      job.staff_heights.append(staff_height)
+      job.metrics.get_stage('staff_heights').add(crops=1, skipped=0 if staff_height else 1)
+      page_stem, system = split_crop_stem(Path(crop_path).stem)
+      job.detections['staff_heights'].append( to_detections(STAFF, page_stem, staff_bboxs, system=system) )
+
+      height_items.append( (job, (crop_path, staff_height, crop_image)) )
+
+    return height_items
+
+  def resize(batch):
+    job, (crop_path, staff_height, crop_image) = batch[0]
+    resized_paths = resize_systems([crop_path], [staff_height], target_height=target_height, crop_images=[crop_image], logger=logger, codec=resized_codec)
+    job.outputs['resize'] += resized_paths
+    job.metrics.get_stage('resize').add(crops=1, resized=len(resized_paths), skipped=0 if staff_height else 1)
+    return []
+
+  decoders = [ threading.Thread(target=decode, daemon=True) for _ in range(decode_threads) ]
+  stages = [
+    threading.Thread(target=run_stage, args=(page_queue, bbox_queue, detect_systems, batch_size, logger, 'systems', batch_timeout), daemon=True),
+    threading.Thread(target=run_stage, args=(bbox_queue, crop_queue, crop, 1, logger, 'crop'), daemon=True),
+    threading.Thread(target=run_stage, args=(crop_queue, height_queue, detect_staff_heights, batch_size, logger, 'staff_heights', batch_timeout), daemon=True),
+    threading.Thread(target=run_stage, args=(height_queue, done_queue, resize, 1, logger, 'resize'), daemon=True),
+  ]
+
+  for thread in decoders + stages:
+    thread.start()
+
+  def close_pipeline():
+    for thread in decoders:
+      thread.join()
+    page_queue.put(None)
+
+  threading.Thread(target=close_pipeline, daemon=True).start()
+
+  failed = []
+
+  with tqdm(total=len(metadata)) as pbar:
+    while True:
+      item = done_queue.get()
+      if item is None:
+        break
+
+      job, _ = item
+      if job.failed:
+        failed.append(job.yt_id)
+      if page_cache:
+        page_cache.finish_video(job.yt_id, completed=not job.failed)
+      if metrics_writer:
+        metrics_writer.write(job.metrics)
+      pbar.update(1)
+
+  for thread in stages:
+    thread.join()
+
+  return failed
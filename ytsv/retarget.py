@@ -0,0 +1,135 @@
+"""
+Rebuild the resized crops of processed videos for other target heights.
+
+Resizing only needs the system and staff boxes of the detection store (see
+ytsv.detections) and the page images, so a new target height does not
+decode the videos or run the YOLO models again. Every page is read once
+and cut into its systems, which are resized for all target heights by
+resize_systems. Videos processed without saving their pages are resized
+from their saved crops instead. The first height is written to
+crop_resized, the others to crop_resized_<height>, and the resize stage of
+the manifest is updated.
+
+  python -m ytsv -d <dataset dir> -m <metadata> --retarget 24 32 -w 8
+"""
+
+from pathlib import Path
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+from tqdm.auto import tqdm
+
+from .system_utils import get_average_staff_height, get_resize_inputs, resize_systems
+from .manifest import load_manifest, mark_stage_done
+from .image_io import find_image_path, glob_images, imread
+from .detections import SYSTEM, STAFF, load_detections, group_bboxs
+from .utils import get_logger, format_logger_msg
+from .dataset import get_segment_dir
+
+
+def retarget_video(seg_dir:Path, target_heights:list[int], update_manifest:bool=True, codec:str=None) -> dict:
+  """
+  Resize the crops of one video for target_heights without running the YOLO models.
+
+  :param seg_dir: path to the segment directory of the video
+  :param target_heights: target staff heights, the first one is written to crop_resized
+  :param update_manifest: if True, record the new resize stage in the manifest
+  :param codec: codec of the resized images, see image_io.ImageCodec, default is png
+  :return: counts of pages, crops, resized and skipped crops
+  """
+  manifest = load_manifest(seg_dir)
+  stats = {'pages': 0, 'crops': 0, 'resized': 0, 'skipped': 0}
+  resized_image_paths = []
+
+  detections = load_detections(seg_dir)
+  staff_bboxs = group_bboxs(detections, STAFF, seg_dir.name)
+
+  image_dir = seg_dir / 'images'
+
+  if not glob_images(image_dir / 'original') and not glob_images(image_dir / 'cropped'):
+    raise FileNotFoundError(f'retargeting needs saved pages or crops, {seg_dir.name} was processed with neither (--no-save-pages and --no-save-crops)')
+
+  for page_stem, bboxs in group_bboxs(detections, SYSTEM, seg_dir.name).items():
+    page_image_path = find_image_path(image_dir / 'original' / f'{page_stem}.png')
+
+    crop_image_paths = [ image_dir / 'cropped' / f'{page_stem}:{str(i).zfill(4)}.png' for i in range(len(bboxs)) ]
+    staff_heights = [
+      get_average_staff_height(staff_bboxs[p.stem]) if p.stem in staff_bboxs else False
+      for p in crop_image_paths
+    ]
+
+    # crops are cut from the page, or read from cropped/ if the page was not saved
+    crop_images = None
+    if page_image_path.exists():
+      page_image = imread(page_image_path)
+      crop_images = [ page_image[ly:ry, lx:rx] for lx, ly, rx, ry, _ in bboxs ]
+    elif not all( find_image_path(p).exists() for p, h in zip(crop_image_paths, staff_heights) if h ):
+      raise FileNotFoundError(f'retargeting needs saved pages or crops, {page_stem} has neither')
+
+    paths = resize_systems(crop_image_paths, staff_heights, target_height=target_heights, crop_images=crop_images, codec=codec)
+    resized_image_paths += paths
+
+    stats['pages'] += 1
+    stats['crops'] += len(crop_image_paths)
+    stats['resized'] += len(paths)
+    stats['skipped'] += sum( 1 for h in staff_heights if not h )
+
+  if update_manifest and 'staff_heights' in manifest['stages']:
+    mark_stage_done(seg_dir, manifest, 'resize', get_resize_inputs(target_heights, codec=codec), resized_image_paths)
+
+  return stats
+
+
+def init_worker():
+  cv2.setNumThreads(1)
+
+
+def retarget_videos(dataset_dir:Path, metadata_path:Path, target_heights:list[int], workers:int=1, codec:str=None) -> dict:
+  """
+  Resize the crops of all processed videos of a metadata file for target_heights.
+
+  :param dataset_dir: path to the dataset directory
+  :param metadata_path: path to the metadata file
+  :param target_heights: target staff heights, the first one is written to crop_resized
+  :param workers: number of processes resizing different videos, default is 1
+  :param codec: codec of the resized images, default is png
+  :return: {yt_id: counts of retarget_video}
+  """
+  with open(metadata_path, 'r') as f:
+    reader = csv.reader(f)
+    header = next(reader)
+    metadata = list(reader)
+
+  logger = get_logger(dataset_dir / 'ytsv.log')
+
+  seg_dirs = [ get_segment_dir(dataset_dir, row) for row in metadata ]
+  seg_dirs = [ seg_dir for seg_dir in seg_dirs if seg_dir.exists() ]
+
+  results = {}
+
+  if workers <= 1:
+    for seg_dir in tqdm(seg_dirs, desc='Retarget'):
+      try:
+        results[seg_dir.name] = retarget_video(seg_dir, target_heights, codec=codec)
+      except Exception as e:
+        logger.exception(format_logger_msg('retarget_video', {'yt_id': seg_dir.name, 'error': repr(e)}))
+
+    return results
+
+  with ProcessPoolExecutor(
+    max_workers=workers,
+    mp_context=multiprocessing.get_context('spawn'),
+    initializer=init_worker
+  ) as executor:
+    futures = { executor.submit(retarget_video, seg_dir, target_heights, codec=codec): seg_dir for seg_dir in seg_dirs }
+
+    for future in tqdm(as_completed(futures), total=len(futures), desc='Retarget'):
+      seg_dir = futures[future]
+      try:
+        results[seg_dir.name] = future.result()
+      except Exception as e:
+        logger.exception(format_logger_msg('retarget_video', {'yt_id': seg_dir.name, 'error': repr(e)}))
+
+  return results
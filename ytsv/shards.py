@@ -0,0 +1,180 @@
+"""
+Sequential tar shards of the processed dataset for training.
+
+Every page becomes one sample of consecutive tar members sharing its key
+(webdataset layout):
+
+  {key}.json          page metadata, system and staff boxes
+  {key}.wav           audio segment
+  {key}.{i:04d}.png   resized crop of the i-th system, .webp or .npy for other codecs
+
+A shard holds one video, or a fixed number of pages. index.json lists the
+shards and, for every sample, the byte range of its members in the shard,
+so a single sample can also be read with one seek.
+"""
+
+from pathlib import Path
+import os
+import io
+import json
+import tarfile
+import csv
+
+from tqdm.auto import tqdm
+
+from .dataset import get_segment_dir, collect_video_samples, get_sample_audio_bytes
+from .utils import get_ts
+
+
+INDEX_NAME = 'index.json'
+
+
+def get_sample_members(sample:dict, metadata:dict=None) -> list[tuple[str, bytes]]:
+  """
+  :param sample: sample from collect_video_samples
+  :param metadata: fields of the metadata row of the video
+  :return: [(member name, data), ...] of the sample
+  """
+  key = sample['key']
+
+  members = []
+  systems = []
+
+  for system in sample['systems']:
+    crop_name = None
+    if system['crop_resized'] is not None:
+      crop_name = f'{key}.{str(system["index"]).zfill(4)}{Path(system["crop_resized"]).suffix}'
+      members.append( (crop_name, Path(system['crop_resized']).read_bytes()) )
+
+    systems.append({ **{ k: v for k, v in system.items() if k != 'crop_resized' }, 'crop_resized': crop_name })
+
+  info = {
+    'key': key,
+    'yt_id': sample['yt_id'],
+    'page': sample['page'],
+    'frame': sample['frame'],
+    'start_time': sample['start_time'],
+    'end_time': sample['end_time'],
+    'metadata': metadata or {},
+    'systems': systems,
+  }
+
+  return [
+    (f'{key}.json', json.dumps(info).encode()),
+    (f'{key}.wav', get_sample_audio_bytes(sample)),
+  ] + members
+
+
+class ShardWriter:
+  def __init__(self, out_dir:Path, pages_per_shard:int=None):
+    """
+    :param out_dir: directory of the shards and their index
+    :param pages_per_shard: pages per shard, if None every video is one shard
+    """
+    self.out_dir = out_dir
+    self.out_dir.mkdir(parents=True, exist_ok=True)
+    self.pages_per_shard = pages_per_shard
+
+    self.shards = []
+    self.tar = None
+    self.tmp_path = None
+
+  def open_shard(self, name:str):
+    self.close_shard()
+
+    # written under a temporary name, a shard in the index is always complete
+    self.tmp_path = self.out_dir / f'.{name}.tmp'
+    self.tar = tarfile.open(self.tmp_path, 'w')
+    self.shards.append({'name': name, 'num_samples': 0, 'samples': []})
+
+  def close_shard(self):
+    if self.tar is None:
+      return
+
+    self.tar.close()
+    os.replace(self.tmp_path, self.out_dir / self.shards[-1]['name'])
+    self.tar = None
+
+  def add_sample(self, key:str, members:list[tuple[str, bytes]]):
+    if self.tar is None or (self.pages_per_shard and self.shards[-1]['num_samples'] >= self.pages_per_shard):
+      self.open_shard(f'shard-{str(len(self.shards)).zfill(6)}.tar')
+
+    offset = self.tar.fileobj.tell()
+
+    for name, data in members:
+      tarinfo = tarfile.TarInfo(name)
+      tarinfo.size = len(data)
+      self.tar.addfile(tarinfo, io.BytesIO(data))
+
+    shard = self.shards[-1]
+    shard['num_samples'] += 1
+    shard['samples'].append({'key': key, 'offset': offset, 'size': self.tar.fileobj.tell() - offset})
+
+  def add_video(self, yt_id:str, samples:list[dict], metadata:dict=None):
+    if not samples:
+      return
+
+    if not self.pages_per_shard:
+      self.open_shard(f'{yt_id}.tar')
+
+    for sample in samples:
+      self.add_sample(sample['key'], get_sample_members(sample, metadata))
+
+  def close(self):
+    self.close_shard()
+
+    index = {
+      'created_at': get_ts(),
+      'pages_per_shard': self.pages_per_shard,
+      'num_samples': sum( shard['num_samples'] for shard in self.shards ),
+      'shards': self.shards,
+    }
+
+    index_path = self.out_dir / INDEX_NAME
+    tmp_path = self.out_dir / f'.{INDEX_NAME}.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def export_shards(dataset_dir:Path, metadata_path:Path, out_dir:Path, pages_per_shard:int=None):
+  """
+  Pack the processed videos of a metadata file into tar shards.
+
+  :param dataset_dir: path to the dataset directory
+  :param metadata_path: path to the metadata file
+  :param out_dir: directory of the shards and their index
+  :param pages_per_shard: pages per shard, if None every video is one shard
+  """
+  with open(metadata_path, 'r') as f:
+    reader = csv.reader(f)
+    header = next(reader)
+    metadata = list(reader)
+
+  with ShardWriter(out_dir, pages_per_shard=pages_per_shard) as writer:
+    for row in tqdm(metadata, desc='Shards'):
+      seg_dir = get_segment_dir(dataset_dir, row)
+      if not seg_dir.exists():
+        continue
+
+      writer.add_video(row[0], collect_video_samples(seg_dir), metadata=dict(zip(header, row)))
+
+
+def read_shard_sample(shard_path:Path, offset:int, size:int) -> dict[str, bytes]:
+  """
+  Members of one sample, from its byte range in the shard index
+
+  :return: {member name: data}
+  """
+  with open(shard_path, 'rb') as f:
+    f.seek(offset)
+    data = f.read(size)
+
+  with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+    return { member.name: tar.extractfile(member).read() for member in tar.getmembers() }
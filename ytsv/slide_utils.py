@@ -9,7 +9,11 @@ from time import time
 from pathlib import Path
 import shutil
 import re
+import math
 import logging
+import subprocess
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 import csv
 import pandas as pd
@@ -19,10 +23,11 @@ import numpy as np
 
 from tqdm.auto import tqdm
 
-from moviepy.video.io.VideoFileClip import VideoFileClip
-from pydub import AudioSegment, silence
+from moviepy.config import get_setting
 
 from .utils import format_logger_msg as format_msg
+from .audio_utils import LoudnessEnvelope, AudioSegmentWriter, SEGMENT_INDEX_DTYPE, iter_pcm_blocks, truncate_wav, get_audio_track_paths, get_segment_name, open_wav_writer
+from .image_io import ImageCodec
 
 
 
@@ -45,6 +50,43 @@ def are_diff(img1, img2, threshold=0.0001):
   return np.sum(diff) > threshold
 
 
+class CountingVideoCapture:
+  """
+  cv2.VideoCapture that counts the frames it decodes. Frames that a seek
+  decodes internally on the way from the keyframe are counted if the
+  keyframes of the video are given, see get_seek_cost.
+  """
+  def __init__(self, video_path, keyframes:np.ndarray=None):
+    self.cap = cv2.VideoCapture(str(video_path))
+    self.keyframes = keyframes
+    self.decoded = 0 # frames returned by grab() or read(), or decoded by a seek
+    self.retrieved = 0 # frames converted to images by retrieve() or read()
+
+  def grab(self):
+    ret = self.cap.grab()
+    self.decoded += int(ret)
+    return ret
+
+  def retrieve(self):
+    ret, frame = self.cap.retrieve()
+    self.retrieved += int(ret)
+    return ret, frame
+
+  def read(self):
+    ret, frame = self.cap.read()
+    self.decoded += int(ret)
+    self.retrieved += int(ret)
+    return ret, frame
+
+  def set(self, prop, value):
+    if prop == cv2.CAP_PROP_POS_FRAMES and self.keyframes is not None:
+      self.decoded += get_seek_cost(self.keyframes, int(value))
+    return self.cap.set(prop, value)
+
+  def __getattr__(self, name):
+    return getattr(self.cap, name)
+
+
 def get_section_list(cap):
   total_frames, fps, width, height = cap.get(cv2.CAP_PROP_FRAME_COUNT), cap.get(cv2.CAP_PROP_FPS), cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
 
@@ -98,6 +140,407 @@ def get_section_list(cap):
   return section_list
 
 
+def get_thumbnail(frame, thumb_width=320):
+  """
+  Small grayscale version of a frame used for sparse transition detection.
+  The blur of get_gray_blur is scaled down with the image, so the thumbnail
+  is about as insensitive to compression noise as the full resolution one.
+  """
+  img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+  scale = min(1.0, thumb_width / img.shape[1])
+  thumb_size = ( max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)) )
+  img = cv2.resize(img, thumb_size, interpolation=cv2.INTER_AREA)
+  img = apply_gaussian_blur(img, amount=5.0 * scale)
+
+  return img
+
+
+def get_diff_flags(thumbs1, thumbs2, diff_threshold=10):
+  """
+  Vectorized are_diff over stacks of thumbnails.
+
+  :param thumbs1: uint8 array of shape (n, h, w)
+  :param thumbs2: uint8 array broadcastable to thumbs1
+  :return: bool array of shape (n,), True where thumbs1[i] differs from thumbs2[i]
+  """
+  diff = np.maximum(thumbs1, thumbs2) - np.minimum(thumbs1, thumbs2)
+  diff = diff.reshape(len(diff), -1)
+
+  return (diff > diff_threshold).any(axis=1)
+
+
+def get_change_signal(cap, step, start_frame=0, end_frame=None, thumb_width=320, diff_threshold=10, block_size=256):
+  """
+  Sample one frame every `step` frames (on the global grid of multiples of
+  step, as in get_section_list) and compare consecutive samples.
+  Skipped frames are only grab()-ed, sampled frames are retrieved and reduced
+  to thumbnails, and the comparison runs block by block in NumPy.
+
+  :param cap: cv2.VideoCapture positioned at start_frame
+  :param step: sampling interval in frames
+  :param start_frame: index of the next frame cap will decode
+  :param end_frame: stop after this frame index (inclusive), None for end of video
+  :return: (sample_idx, changed, num_frames)
+    sample_idx: frame indices of the samples
+    changed: changed[k] is True if sample k differs from sample k-1 (changed[0] is False)
+    num_frames: index of the last decoded frame + 1
+  """
+  sample_idx = []
+  changed = [ np.zeros(1, dtype=bool) ]
+
+  block = None
+  num_in_block = 0 # slot 0 holds the last sample of the previous block
+
+  cnt = start_frame
+
+  while end_frame is None or cnt <= end_frame:
+    # no more frame
+    if not cap.grab():
+      break
+
+    if cnt % step == 0:
+      ret, frame = cap.retrieve()
+      if not ret:
+        break
+
+      thumb = get_thumbnail(frame, thumb_width)
+
+      if block is None:
+        block = np.empty((block_size + 1, *thumb.shape), dtype=np.uint8)
+
+      block[num_in_block] = thumb
+      num_in_block += 1
+      sample_idx.append(cnt)
+
+      if num_in_block == len(block):
+        changed.append( get_diff_flags(block[1:], block[:-1], diff_threshold) )
+        block[0] = block[-1]
+        num_in_block = 1
+
+    cnt += 1
+
+  if num_in_block > 1:
+    changed.append( get_diff_flags(block[1:num_in_block], block[:num_in_block-1], diff_threshold) )
+
+  changed = np.concatenate(changed)[:len(sample_idx)]
+
+  return np.array(sample_idx, dtype=np.int64), changed, cnt
+
+
+def get_sections_from_changes(sample_idx, changed, num_frames):
+  """
+  Turn a change signal into the (start, end, type) list of get_section_list.
+  A section boundary is placed at every sample where the changed flag flips,
+  type 0 is static and type 1 is transition, starting with static.
+  """
+  # changed[0] is False, the state before the first comparison
+  flips = np.flatnonzero( changed[1:] != changed[:-1] ) + 1
+
+  starts = [0] + sample_idx[flips].tolist()
+  ends = [ st - 1 for st in starts[1:] ] + [num_frames - 1]
+
+  return [ (st, ed, i % 2) for i, (st, ed) in enumerate(zip(starts, ends)) ]
+
+
+def refine_section_list(cap, section_list, step, thumb_width=320, diff_threshold=10):
+  """
+  Move coarse section boundaries (on the sampling grid) to the exact frame.
+
+  A transition that starts at a sample s began somewhere in (s-step, s],
+  a static section that starts at s began somewhere in (s-2*step, s-step].
+  Only that window is decoded, after one keyframe-aware seek, instead of
+  decoding every frame of the video.
+  """
+  starts = [ st for st, _, _ in section_list ]
+  num_frames = section_list[-1][1] + 1
+
+  for i in range(1, len(section_list)):
+    st, _, section_type = section_list[i]
+
+    win_end = st if section_type else st - step
+    win_start = max(0, win_end - step)
+
+    cap.set(cv2.CAP_PROP_POS_FRAMES, win_start)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != win_start:
+      continue
+
+    thumbs = []
+    for _ in range(win_start, win_end + 1):
+      ret, frame = cap.read()
+      if not ret:
+        break
+      thumbs.append( get_thumbnail(frame, thumb_width) )
+
+    if len(thumbs) != win_end - win_start + 1:
+      continue
+
+    thumbs = np.stack(thumbs)
+
+    if section_type:
+      # first frame that differs from the last static sample
+      diff_idx = np.flatnonzero( get_diff_flags(thumbs[1:], thumbs[:1], diff_threshold) ) + 1
+      if len(diff_idx):
+        starts[i] = win_start + int(diff_idx[0])
+    else:
+      # frame after the last one that differs from the new static sample
+      diff_idx = np.flatnonzero( get_diff_flags(thumbs[1:], thumbs[-1:], diff_threshold) ) + 1
+      starts[i] = win_start + int(diff_idx[-1]) + 1 if len(diff_idx) else win_start + 1
+
+  # keep every section at least one frame long
+  for i in range(1, len(starts)):
+    starts[i] = max(starts[i], starts[i-1] + 1)
+
+  ends = [ st - 1 for st in starts[1:] ] + [num_frames - 1]
+
+  return [ (st, ed, section_type) for st, ed, (_, _, section_type) in zip(starts, ends, section_list) ]
+
+
+def get_section_list_sparse(cap, thumb_width=320, diff_threshold=10, block_size=256, refine=False):
+  """
+  Drop-in replacement for get_section_list that decodes only the sampled
+  frames and compares small grayscale thumbnails in NumPy blocks.
+
+  Without refine, boundaries fall on the same sampling grid as get_section_list.
+  With refine, each boundary is moved to the exact transition frame, which
+  is at most 2 * fps // 3 frames earlier than the coarse one.
+
+  :param cap: cv2.VideoCapture positioned at frame 0
+  :param thumb_width: width of the grayscale thumbnails in pixels
+  :param diff_threshold: per-pixel intensity difference counted as change
+  :param block_size: number of samples compared per NumPy call
+  :param refine: if True, refine boundaries to frame accuracy
+  """
+  fps = cap.get(cv2.CAP_PROP_FPS)
+  step = max(1, int(fps // 3))
+
+  sample_idx, changed, num_frames = get_change_signal(
+    cap,
+    step,
+    thumb_width=thumb_width,
+    diff_threshold=diff_threshold,
+    block_size=block_size
+  )
+
+  section_list = get_sections_from_changes(sample_idx, changed, num_frames)
+
+  if refine:
+    section_list = refine_section_list(cap, section_list, step, thumb_width=thumb_width, diff_threshold=diff_threshold)
+
+  return section_list
+
+
+def get_chunk_change_signal(video_path, step, start_frame, end_frame, thumb_width=320, diff_threshold=10, block_size=256):
+  """
+  get_change_signal on the frame range [start_frame, end_frame] of a video,
+  run in a worker process of get_section_list_by_chunks.
+
+  :return: (sample_idx, changed, num_frames) as get_change_signal, and
+    (decoded, retrieved) frame counts of the chunk
+  """
+  cap = CountingVideoCapture(video_path)
+
+  if start_frame > 0:
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+    # inaccurate seek, decode from the beginning instead
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != start_frame:
+      cap.release()
+      cap = CountingVideoCapture(video_path)
+      for _ in range(start_frame):
+        if not cap.grab():
+          break
+
+  signal = get_change_signal(
+    cap,
+    step,
+    start_frame=start_frame,
+    end_frame=end_frame,
+    thumb_width=thumb_width,
+    diff_threshold=diff_threshold,
+    block_size=block_size
+  )
+
+  cap.release()
+
+  return signal, (cap.decoded, cap.retrieved)
+
+
+def get_section_list_by_chunks(video_path:Path, num_chunks:int=4, thumb_width=320, diff_threshold=10, block_size=256, refine=False, stats:dict=None):
+  """
+  get_section_list_sparse with the video split into num_chunks frame ranges
+  that are decoded in parallel processes.
+
+  Chunk borders are placed on the sampling grid, and every chunk also decodes
+  the first sample of the next chunk, so the comparison across the border is
+  not lost. The change signals are concatenated and turned into sections
+  once, which gives the same result as a single sequential pass.
+
+  :param video_path: path to the video file
+  :param num_chunks: number of frame ranges (and worker processes)
+  :param refine: if True, refine boundaries to frame accuracy in this process
+  :param stats: optional dict that receives the frames decoded and retrieved in all processes
+  """
+  cap = CountingVideoCapture(video_path)
+  total_frames, fps = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+  step = max(1, int(fps // 3))
+
+  num_samples = math.ceil(total_frames / step)
+  num_chunks = max(1, min(num_chunks, num_samples // 2))
+
+  if num_chunks == 1:
+    section_list = get_section_list_sparse(cap, thumb_width=thumb_width, diff_threshold=diff_threshold, block_size=block_size, refine=refine)
+    cap.release()
+    add_frame_counts(stats, cap.decoded, cap.retrieved)
+    return section_list
+
+  chunk_starts = [ (num_samples * i // num_chunks) * step for i in range(num_chunks) ]
+  # last chunk reads until the end, CAP_PROP_FRAME_COUNT is only an estimate
+  chunk_ends = chunk_starts[1:] + [None]
+
+  with ProcessPoolExecutor(max_workers=num_chunks) as executor:
+    signals, frame_counts = zip(*executor.map(
+      get_chunk_change_signal,
+      [video_path] * num_chunks,
+      [step] * num_chunks,
+      chunk_starts,
+      chunk_ends,
+      [thumb_width] * num_chunks,
+      [diff_threshold] * num_chunks,
+      [block_size] * num_chunks
+    ))
+
+  # stitch: the first sample of a chunk is the last sample of the previous one
+  sample_idx = [ signals[0][0] ]
+  changed = [ signals[0][1] ]
+  for chunk_sample_idx, chunk_changed, _ in signals[1:]:
+    sample_idx.append(chunk_sample_idx[1:])
+    changed.append(chunk_changed[1:])
+
+  sample_idx = np.concatenate(sample_idx)
+  changed = np.concatenate(changed)
+  num_frames = max( num_frames for _, _, num_frames in signals )
+
+  section_list = get_sections_from_changes(sample_idx, changed, num_frames)
+
+  if refine:
+    section_list = refine_section_list(cap, section_list, step, thumb_width=thumb_width, diff_threshold=diff_threshold)
+
+  cap.release()
+
+  add_frame_counts(stats, cap.decoded + sum( decoded for decoded, _ in frame_counts ), cap.retrieved + sum( retrieved for _, retrieved in frame_counts ))
+
+  return section_list
+
+
+def add_frame_counts(stats:dict, decoded:int, retrieved:int):
+  if stats is not None:
+    stats['frames_decoded'] = stats.get('frames_decoded', 0) + decoded
+    stats['frames_retrieved'] = stats.get('frames_retrieved', 0) + retrieved
+
+
+# cv2 seeks to the keyframe before this many frames ahead of the target, and decodes forward from it
+SEEK_BACKOFF = 16
+
+
+def get_keyframe_indices(video_path:Path) -> np.ndarray:
+  """
+  Indices of the keyframes of the first video stream, read from the packet
+  flags by ffmpeg without decoding. Packets are ranked by their presentation
+  time, the order cv2 returns the frames in.
+
+  :return: sorted frame indices, None if ffmpeg cannot read the video
+  """
+  cmd = [
+    get_setting('FFMPEG_BINARY'),
+    '-i', str(video_path),
+    '-loglevel', 'error',
+    '-map', '0:v:0', '-c', 'copy',
+    '-f', 'framecrc', '-'
+  ]
+  result = subprocess.run(cmd, capture_output=True, stdin=subprocess.DEVNULL)
+  if result.returncode != 0:
+    return None
+
+  pts, is_key = [], []
+  for line in result.stdout.decode(errors='replace').splitlines():
+    if line.startswith('#'):
+      continue
+
+    # stream, dts, pts, duration, size, hash[, F=flags], flags are only listed if not just a keyframe
+    fields = [ field.strip() for field in line.split(',') ]
+    flags = next( (int(field[2:], 16) for field in fields[6:] if field.startswith('F=')), 1 )
+    pts.append( int(fields[2]) )
+    is_key.append( bool(flags & 1) )
+
+  if not pts:
+    return None
+
+  order = np.argsort(pts, kind='stable')
+  return np.flatnonzero( np.asarray(is_key)[order] )
+
+
+def get_seek_cost(keyframes:np.ndarray, frame_idx:int) -> int:
+  """
+  Frames a seek to frame_idx decodes, from the keyframe at or before
+  frame_idx - SEEK_BACKOFF up to the target
+  """
+  k = np.searchsorted(keyframes, max(frame_idx - SEEK_BACKOFF, 0), side='right') - 1
+  return frame_idx - int(keyframes[k]) if k >= 0 else frame_idx
+
+
+def read_frames_at(cap, frame_indices, seek_threshold=300, keyframes:np.ndarray=None):
+  """
+  Decode only the frames at the given (ascending) indices.
+
+  Short gaps are skipped with grab(), which demuxes and decodes without the
+  BGR conversion of read(). Long gaps are jumped with CAP_PROP_POS_FRAMES,
+  which seeks to a preceding keyframe and decodes forward from there. With
+  the keyframes of the video, a gap is jumped whenever the seek decodes
+  fewer frames than grabbing through it, otherwise when it is longer than
+  seek_threshold frames, which only pays off when it is longer than a GOP.
+
+  :param cap: opened cv2.VideoCapture positioned at frame 0
+  :param frame_indices: ascending list of frame indices to decode
+  :param seek_threshold: minimum gap in frames to seek instead of grabbing, without keyframes
+  :param keyframes: sorted keyframe indices, see get_keyframe_indices
+  :return: generator of (frame_index, frame)
+  """
+  pos = 0 # index of the next frame to be decoded
+
+  for frame_idx in frame_indices:
+    if keyframes is not None:
+      seek = get_seek_cost(keyframes, frame_idx) < frame_idx - pos
+    else:
+      seek = frame_idx - pos > seek_threshold
+
+    if seek:
+      cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+      pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+      # inaccurate seek (e.g. broken index), retry from one threshold earlier
+      if pos > frame_idx:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, max(0, frame_idx - seek_threshold))
+        pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        if pos > frame_idx:
+          return
+
+    while pos < frame_idx:
+      if not cap.grab():
+        return
+      pos += 1
+
+    ret, frame = cap.read()
+
+    # no more frame
+    if not ret:
+      return
+
+    pos += 1
+
+    yield frame_idx, frame
+
+
 def get_page_list(sec_ls, total_frames, fps, pad):
   first_section_type = sec_ls[0][2]
   last_section_type = sec_ls[-1][2]
@@ -139,11 +582,141 @@ def get_page_list(sec_ls, total_frames, fps, pad):
   return page_list
 
 
-def extract_pages_and_audios(video_path:Path, out_path:Path, drop=(True, True)):
+def get_page_window(page_start:int, page_end:int, fps:float) -> tuple[float, float]:
+  '''
+    returns (start_ms, end_ms) of the audio find_nonsilent_page measures for a page
+  '''
+  # convert frame index to seconds
+  page_start_time = page_start  / fps
+  page_end_time = page_end / fps
+
+  return page_start_time*1000, page_end_time*1000+1
+
+
+def get_page_windows(page_list:list, fps:float, pad:int) -> list[tuple[float, float]]:
+  '''
+    page_list: [(page_frame, page_start, page_end), ...] from get_page_list
+    fps: frames per second of the video
+    pad: padding of the pages in frames
+
+    returns the windows trim_silent_pages may measure, for LoudnessEnvelope.watch_windows.
+    The pad of a page is removed depending on its place in the trimmed list,
+    so every page comes with and without it at either end.
+  '''
+  windows = set()
+  for _, page_start, page_end in page_list:
+    for start in {page_start, page_start + pad}:
+      for end in {page_end, page_end - pad}:
+        windows.add( get_page_window(start, end, fps) )
+
+  return sorted(windows)
+
+
+def find_nonsilent_page(
+  page_list:list, 
+  loudness:LoudnessEnvelope, 
+  fps:float, 
+  pad:int, 
+  ratio_threshold:float, 
+  num_silence_search_sections:int=100, 
+  silence_thresh:float=-50, 
+  reverse:bool=False
+):
+  '''
+    page_list: [(page_frame, page_start, page_end), ...] from get_page_list
+    loudness: LoudnessEnvelope of the whole audio track
+    fps: frames per second of the video
+    pad: padding of the pages in frames, removed before measuring
+    ratio_threshold: minimum non-silent ratio of a page
+    reverse: search from the last page
+
+    returns index of the first (last if reverse) page whose non-silent ratio
+    reaches ratio_threshold, None if there is none
+  '''
+  indices = range(len(page_list))
+
+  for i in (reversed(indices) if reverse else indices):
+    _, page_start, page_end = page_list[i]
+
+    # remove pad
+    page_start = page_start + pad if i > 0 else page_start
+    page_end = page_end - pad if i < len(page_list)-1 else page_end
+
+    # ratio of non-silent windows, None if the page is too short to be searched
+    ratio = loudness.get_nonsilent_ratio(
+      *get_page_window(page_start, page_end, fps), 
+      num_sections=num_silence_search_sections, 
+      silence_thresh=silence_thresh
+    )
+
+    if ratio is not None and ratio >= ratio_threshold:
+      return i
+
+  return None
+
+
+def trim_silent_pages(page_list:list, loudness:LoudnessEnvelope, fps:float, pad:int, drop=(True, True)):
+  '''
+    page_list: [(page_frame, page_start, page_end), ...] from get_page_list
+    loudness: LoudnessEnvelope of the whole audio track
+    drop: (drop_intro, drop_outro)
+
+    returns page_list without the silent pages at its start and end
+  '''
+  # Drop silent intros
+  if drop[0]:
+    start_page_idx = find_nonsilent_page(page_list, loudness, fps, pad, ratio_threshold=0.6)
+    if start_page_idx is not None:
+      page_list = page_list[start_page_idx:]
+
+  # Drop silent outros
+  if drop[1]:
+    end_page_idx = find_nonsilent_page(page_list, loudness, fps, pad, ratio_threshold=0.16, reverse=True)
+    # every page is dropped if none of them is loud enough
+    page_list = page_list[:end_page_idx + 1] if end_page_idx is not None else []
+
+  return page_list
+
+
+def extract_pages_and_audios(
+  video_path:Path, 
+  out_path:Path, 
+  drop=(True, True), 
+  seek_threshold:int=None, 
+  sparse_sections:bool=False, 
+  refine_sections:bool=False,
+  section_workers:int=1,
+  save_pages:bool=True,
+  page_codec:str=None,
+  on_page=None,
+  audio_frame_rate:int=44100,
+  audio_channels:int=2,
+  single_audio_file:bool=False,
+  exclude_pages=None,
+  stats:dict=None
+):
   '''
     video_path: Path or str
     out_path: Path or str
     debug: (drop_intro, drop_outro)
+    seek_threshold: gap in frames above which page frames are reached by seeking instead of grab(),
+      by default a gap is jumped whenever the seek from its keyframe decodes fewer frames
+    sparse_sections: use get_section_list_sparse instead of get_section_list
+    refine_sections: refine sparse section boundaries to frame accuracy
+    section_workers: if > 1, run sparse section detection on this many chunks of the video in parallel
+    save_pages: if False, page images are not written, on_page still receives their paths and frames
+    page_codec: codec of the page images, see image_io.ImageCodec, default is png
+    on_page: optional callback, called with (page_image_path, frame) after each page is extracted
+    audio_frame_rate: sample rate of the audio segments
+    audio_channels: number of channels of the audio segments
+    single_audio_file: write the whole audio track as one wav file with an index of the
+      frame ranges of the pages (see audio_utils.AudioTrackReader) instead of a wav file per page
+    exclude_pages: page numbers that are neither decoded nor written, see exclusions.ExclusionList
+    stats: optional dict that receives counts of the extraction (decoded frames, pages, dropped pages, audio length)
+      and the seconds of its parts (sections_time, pages_time, audio_decode_time, silence_trimming_time,
+      page_extract_time, audio_export_time)
+
+    returns (page_image_paths, audio_paths) of the written files
   '''
 
   video_id = out_path.stem
@@ -156,167 +729,168 @@ def extract_pages_and_audios(video_path:Path, out_path:Path, drop=(True, True)):
   audio_out_path.mkdir(parents=True, exist_ok=True)
   
   # Get video stream 
-  cap = cv2.VideoCapture(str(video_path))
+  cap = CountingVideoCapture(video_path)
   
   total_frames, fps, width, height = cap.get(cv2.CAP_PROP_FRAME_COUNT), cap.get(cv2.CAP_PROP_FPS), cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
 
+  # frames actually decoded, CAP_PROP_FRAME_COUNT is only the container's estimate
+  frame_counts = {}
+
+  part_times = {}
+  lap_start = [time()]
+  def lap(part):
+    now = time()
+    part_times[f'{part}_time'] = now - lap_start[0]
+    lap_start[0] = now
+
   # Get sections
-  section_list = get_section_list(cap)
+  if section_workers > 1:
+    section_list = get_section_list_by_chunks(video_path, num_chunks=section_workers, refine=refine_sections, stats=frame_counts)
+  elif sparse_sections:
+    section_list = get_section_list_sparse(cap, refine=refine_sections)
+  else:
+    section_list = get_section_list(cap)
 
   cap.release()
+  add_frame_counts(frame_counts, cap.decoded, cap.retrieved)
+  lap('sections')
   
   # Get pages
   pad = int(fps / 3) # padding for page duration in frames
   page_list = get_page_list(section_list, total_frames, fps, pad)
+  lap('pages')
   
   # print("page_list : ", page_list)
   
-  # Extract audio
-  video = VideoFileClip(str(video_path))
-  audio = video.audio
-
-  audio_path = audio_out_path / "audio.wav"
-  audio.write_audiofile(str(audio_path), logger=None)
+  # Stream the audio once to measure its loudness and write either the whole track in one file
+  # or a segment of every page, cut to length once the pages that are kept are known
+  audio_track_path, audio_index_path = get_audio_track_paths(audio_out_path, video_id)
+
+  audio_track_tmp_path = audio_track_path.with_name(f'.{audio_track_path.name}.tmp')
+
+  # the envelope only keeps per-millisecond sums, the frames the trimming measures are watched
+  loudness = LoudnessEnvelope(audio_frame_rate, audio_channels)
+  if any(drop):
+    loudness.watch_windows(get_page_windows(page_list, fps, pad))
+
+  # the last page written gets 2 seconds more, every page may turn out to be the last one
+  candidate_paths = {} # page_frame -> segment written while decoding
+  candidate_segments = []
+  if not single_audio_file:
+    for page_frame, page_start, page_end in page_list:
+      candidate_paths[page_frame] = audio_out_path / f'.{video_id}:{page_frame}.wav.tmp'
+      start_frame, end_frame = loudness.ms_to_frame( [page_start / fps * 1000, page_end / fps * 1000 + 2000] ).tolist()
+      candidate_segments.append( (start_frame, end_frame, candidate_paths[page_frame]) )
+
+  try:
+    with open_wav_writer(audio_track_tmp_path, audio_frame_rate, audio_channels) if single_audio_file else nullcontext() as track_wav, \
+        AudioSegmentWriter(candidate_segments, audio_frame_rate, audio_channels) as segment_writer:
+      for block in iter_pcm_blocks(video_path, audio_frame_rate, audio_channels):
+        loudness.add_samples(block)
+        segment_writer.add_samples(block)
+        if track_wav:
+          track_wav.writeframesraw(block.tobytes())
+
+    # only a completely decoded track replaces an existing one
+    if single_audio_file:
+      os.replace(audio_track_tmp_path, audio_track_path)
+    lap('audio_decode')
   
-  audio_segment = AudioSegment.from_wav(audio_path)
-  
-  
-  # Drop silent intros
-  num_silence_search_sections = 100
-  silence_thresh = -50
-  ratio_threshold = 0.6
-    
-  ratios = []
-  
-  start_page_idx = 0
+    num_detected_pages = len(page_list)
 
-  for i, (_, page_start, page_end) in enumerate(page_list):
-    # remove pad
-    page_start = page_start + pad if i > 0 else page_start
-    page_end = page_end - pad if i < len(page_list)-1 else page_end
-    
-    # convert frame index to seconds
-    page_start_time = page_start  / fps
-    page_end_time = page_end / fps
-    
-    # slice audio in milli-second
-    page_audio = audio_segment[page_start_time*1000:page_end_time*1000+1]
-    
-    min_silence_len = len(page_audio) // num_silence_search_sections
-    
-    segments = silence.detect_nonsilent(page_audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=min_silence_len)
-    
-    # silent in "%" (how many silent segments / 100)
-    seg_dur_sum = sum( [ seg[1] - seg[0] for seg in segments ] )
-    ratio = seg_dur_sum / len(page_audio)
-    ratios.append((len(page_audio), ratio))
-    
-    if ratio >= ratio_threshold:
-      start_page_idx = i
-      break
-  
-  if drop[0]:
-    page_list = page_list[start_page_idx:]
+    # Drop silent intros and outros
+    page_list = trim_silent_pages(page_list, loudness, fps, pad, drop=drop)
+    lap('silence_trimming')
   
-  # print("intro non-silent ratios : ", ratios)
+    # Page extraction and saving image files, seeking to the pages costs at most a GOP each
+    keyframes = get_keyframe_indices(video_path) if seek_threshold is None else None
+    cap = CountingVideoCapture(video_path, keyframes)
 
-  # Drop silent outros
-  num_silence_search_sections = 100
-  silence_thresh = -50
-  ratio_threshold = 0.16
-  
-  ratios = []
-  
-  end_page_idx = len(page_list)
-  
-  for i, (_, page_start, page_end) in reversed(list(enumerate(page_list))):
-    # remove pad
-    page_start = page_start + pad if i > 0 else page_start
-    page_end = page_end - pad if i < len(page_list)-1 else page_end
-    
-    # convert frame index to seconds
-    page_start_time = page_start  / fps
-    page_end_time = page_end / fps
-    
-    # slice audio in milli-second
-    page_audio = audio_segment[page_start_time*1000:page_end_time*1000+1]
-    
-    min_silence_len = len(page_audio) // num_silence_search_sections
-    
-    if min_silence_len < 1:
-      end_page_idx = i
-      continue
-    
-    segments = silence.detect_nonsilent(page_audio, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=min_silence_len)
-    
-    # silent in "%" (how many silent segments / 100)
-    seg_dur_sum = sum( [ seg[1] - seg[0] for seg in segments ] )
-    ratio = seg_dur_sum / len(page_audio)
-    ratios.append((len(page_audio), ratio, i))
-    
-    if ratio >= ratio_threshold:
-      break
-    
-    end_page_idx = i
-  
-  if drop[1]:
-    page_list = page_list[:end_page_idx]
-    
-  # print("outro non-silent rations : ", ratios)
-  # print("num page : ", len(page_list))
-  
-  # Page extraction and saving image files
-  cap = cv2.VideoCapture(str(video_path))
+    change_times = []
+    skip_cnt = 0
 
-  get_ls_elem = lambda i, ls: ls[i] if i < len(ls) else None
+    page_image_paths = []
+    codec = ImageCodec(page_codec)
 
-  page_idx = 0
-  cur_page = get_ls_elem(page_idx, page_list)
+    # excluded pages are not even decoded
+    page_indices = [ page_idx for page_idx in range(len(page_list)) if page_idx not in (exclude_pages or ()) ]
+    num_excluded = len(page_list) - len(page_indices)
+    page_frames = [ page_list[page_idx][0] for page_idx in page_indices ]
 
-  cnt = 0
-  skip_cnt = 0
+    for page_idx, (cnt, frame) in zip(page_indices, read_frames_at(cap, page_frames, seek_threshold=300 if seek_threshold is None else seek_threshold, keyframes=keyframes)):
+      _, page_start, page_end = page_list[page_idx]
 
-  change_times = []
-  
-  while True:
-    ret, frame = cap.read()
-    
-    # no more frame
-    if not ret: 
-      break
+      start_time = page_start / fps
+      end_time = page_end / fps
 
-    start_time = cur_page[1] / fps
-    end_time = cur_page[2] / fps
+      # Write the image of the middle of segment
+      page_image_path = image_out_path/f'{video_id}:{str(page_idx - skip_cnt).zfill(4)}:{cnt}{codec.suffix}'
+      if save_pages:
+        codec.write(page_image_path, frame)
+        page_image_paths.append(page_image_path)
 
-    # Write the image of the middle of segment
-    if cnt == cur_page[0]:
-      cv2.imwrite(str(image_out_path/f'{video_id}:{str(page_idx - skip_cnt).zfill(4)}:{cnt}.png'), frame)
-      
       change_times.append((page_idx, skip_cnt, cnt, start_time, end_time))
 
-      page_idx += 1
-      cur_page = get_ls_elem(page_idx, page_list)
-      
-      if not cur_page:
-        break
-    
-    cnt += 1
+      if on_page:
+        on_page(page_image_path, frame)
 
-  cap.release()
+    cap.release()
+    add_frame_counts(frame_counts, cap.decoded, cap.retrieved)
+    lap('page_extract')
   
-  # Slice audio and save wav files
-  for i in range(len(change_times)):
-    page_idx, skip_cnt, cnt, start_time, end_time = change_times[i]
-
-    if i < len(change_times) - 1:
-      segment = audio_segment[start_time*1000 : end_time*1000] # time as millisecond
-    else:
-      # if last segment, add 2 second padding
-      segment = audio_segment[start_time*1000 : min(end_time*1000 + (2*1000), len(audio_segment))] # time as millisecond
-
-    segment_name = os.path.join(audio_out_path, f'{video_id}:{str(page_idx - skip_cnt).zfill(4)}:{start_time}:{end_time}.wav')
-
-    segment.export(segment_name, format="wav")
-
-  # Remove the whole audio file
-  os.remove(audio_path)
\ No newline at end of file
+    # Slice audio and save wav files
+    audio_paths = []
+    audio_index = np.zeros(len(change_times), dtype=SEGMENT_INDEX_DTYPE)
+    audio_len = len(loudness) # in milli-second
+
+    for i in range(len(change_times)):
+      page_idx, skip_cnt, cnt, start_time, end_time = change_times[i]
+
+      segment_start = start_time*1000 # time as millisecond
+      if i < len(change_times) - 1:
+        segment_end = end_time*1000
+      else:
+        # if last written segment, add 2 second padding, also if the pages after it were excluded or not decoded
+        segment_end = min(end_time*1000 + (2*1000), audio_len)
+
+      # frame range of audio_segment[segment_start:segment_end]
+      start_frame, end_frame = loudness.ms_to_frame( [min(segment_start, audio_len), min(segment_end, audio_len)] ).tolist()
+
+      if single_audio_file:
+        audio_index[i] = (page_idx - skip_cnt, start_frame, end_frame, start_time, end_time)
+        continue
+
+      segment_name = os.path.join(audio_out_path, get_segment_name(video_id, page_idx - skip_cnt, start_time, end_time))
+
+      # the segment written while decoding starts at start_frame, or is cut to nothing past the end of the track
+      candidate_path = candidate_paths[page_list[page_idx][0]]
+      truncate_wav(candidate_path, end_frame - start_frame)
+      os.replace(candidate_path, segment_name)
+
+      audio_paths.append(Path(segment_name))
+
+    if single_audio_file:
+      np.save(audio_index_path, audio_index)
+      audio_paths = [audio_track_path, audio_index_path]
+    lap('audio_export')
+  finally:
+    # a partly decoded track, and the segments of pages that were dropped, excluded or not decoded
+    audio_track_tmp_path.unlink(missing_ok=True)
+    for candidate_path in candidate_paths.values():
+      candidate_path.unlink(missing_ok=True)
+
+  if stats is not None:
+    stats.update({
+      **frame_counts,
+      'sections': len(section_list),
+      'pages_detected': num_detected_pages,
+      'pages_dropped_silent': num_detected_pages - len(page_list),
+      'pages_excluded': num_excluded,
+      # pages past the end of the decodable video, e.g. of a truncated download
+      'pages_not_decoded': len(page_indices) - len(change_times),
+      'pages': len(change_times),
+      'audio_seconds': audio_len / 1000,
+      **part_times,
+    })
+
+  return page_image_paths, audio_paths
\ No newline at end of file
@@ -1,11 +1,17 @@
 from pathlib import Path
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
 from tqdm.auto import tqdm
 
 from ultralytics import YOLO
 
+from .utils import format_logger_msg
+from .image_io import ImageCodec, NO_WRITE_CODEC, imread
+
 
 def zip_bboxs_confs(output):
   bboxs = output.boxes.xyxy.int().tolist()
@@ -37,43 +43,123 @@ def load_bboxs(file_path):
   return bboxs
 
 
-def inference_by_batch(image_fns:list[Path], yolo:YOLO, batch_size:int=64, custom_process=None, device:str='cpu'):
+def iter_prefetched_batches(items:list, load, batch_size:int=64, prefetch:int=2, num_threads:int=4):
+  """
+  Yield consecutive batches of items with their loaded values. The next
+  prefetch batches are loaded on a thread pool while the current one is
+  in use, cv2 decoding releases the GIL.
+
+  :param items: items to load
+  :param load: function loading one item
+  :param batch_size: number of items per batch
+  :param prefetch: number of batches loaded ahead, 0 loads each batch when it is needed
+  :param num_threads: number of loader threads
+  :return: generator of (batch items, loaded values)
+  """
+  batches = [ items[i:i+batch_size] for i in range(0, len(items), batch_size) ]
+
+  if prefetch < 1:
+    for batch in batches:
+      yield batch, [ load(item) for item in batch ]
+    return
+
+  with ThreadPoolExecutor(max_workers=num_threads) as executor:
+    pending = deque()
+
+    def submit(batch):
+      pending.append( (batch, [ executor.submit(load, item) for item in batch ]) )
+
+    for batch in batches[:prefetch+1]:
+      submit(batch)
+    next_batch_idx = len(pending)
+
+    while pending:
+      batch, futures = pending.popleft()
+      loaded = [ future.result() for future in futures ]
+
+      if next_batch_idx < len(batches):
+        submit(batches[next_batch_idx])
+        next_batch_idx += 1
+
+      yield batch, loaded
+
+
+def inference_by_batch(
+  image_fns:list[Path], 
+  yolo:YOLO, 
+  batch_size:int=64, 
+  custom_process=None, 
+  device:str='cpu', 
+  images:list[np.ndarray]=None, 
+  prefetch:int=2, 
+  num_loader_threads:int=4,
+  stats:dict=None
+):
   """
   :param image_fns: list of image file paths
   :param yolo: instance of YOLO model
   :param batch_size: batch size for YOLO inference, default is 64
+  :param custom_process: function applied to each image (or image file path) before inference
+  :param images: optional decoded images (BGR) of image_fns, the files are then not read
+  :param prefetch: number of batches decoded and preprocessed ahead of inference, default is 2
+  :param num_loader_threads: number of threads decoding images, default is 4
+  :param stats: optional dict that receives the number of batches submitted to the model,
+    their items and their slots (batch_size per batch)
   """
+  def load(i):
+    image = images[i] if images is not None else None
+
+    if custom_process:
+      return custom_process(image if image is not None else image_fns[i])
+
+    # same decoding as YOLO applies to image paths
+    return image if image is not None else imread(image_fns[i], cv2.IMREAD_COLOR)
+
   num_batches = math.ceil(len(image_fns)/batch_size)
 
   outputs = []
 
-  for cur_batch_idx in tqdm(range(num_batches), leave=False, desc="YOLO Inf"):
-    batch = image_fns[cur_batch_idx*batch_size:(cur_batch_idx+1)*batch_size]
-    
-    if custom_process:
-      batch_paths = batch
-      batch = [ custom_process(b) for b in batch ]
-    
-    
+  batches = iter_prefetched_batches(list(range(len(image_fns))), load, batch_size=batch_size, prefetch=prefetch, num_threads=num_loader_threads)
+
+  for batch_idxs, batch in tqdm(batches, total=num_batches, leave=False, desc="YOLO Inf"):
     batch_output = yolo(batch, device=device, verbose=False)
+
+    if stats is not None:
+      stats['batches'] = stats.get('batches', 0) + 1
+      stats['batch_items'] = stats.get('batch_items', 0) + len(batch)
+      stats['batch_slots'] = stats.get('batch_slots', 0) + batch_size
     
-    if custom_process:
-      for bo, bp in zip(batch_output, batch_paths):
-        bo.path = str(bp)
+    # outputs of in-memory inputs have placeholder paths
+    for bo, i in zip(batch_output, batch_idxs):
+      bo.path = str(image_fns[i])
 
     outputs += batch_output
   
   return outputs
 
 
-def process_yolo_system_output(output):
+def get_system_bboxs(output):
+  """
+  :return: system bboxs [(lx, ly, rx, ry, conf), ...] sorted by y, x, False if none were detected
+  """
   bboxs = output.boxes.xyxy
 
   # skip if no bbox
   if len(bboxs) < 1:
     return False
 
-  bboxs = zip_bboxs_confs(output)
+  return zip_bboxs_confs(output)
+
+
+def process_yolo_system_output(output):
+  """
+  Write the system bboxs of a page to <page>_yolo_bboxs.txt, see ytsv.detections for the store used by the pipeline
+
+  :return: path of the text file, False if no system was detected
+  """
+  bboxs = get_system_bboxs(output)
+  if not bboxs:
+    return False
 
   image_path = Path(output.path)
   yolo_bbox_path = image_path.with_name( image_path.stem + '_yolo_bboxs.txt' )
@@ -83,68 +169,125 @@ def process_yolo_system_output(output):
   return yolo_bbox_path
 
 
-def detect_systems_by_batch(image_fns:list[Path], yolo:YOLO, batch_size:int=64, device:str='cpu'):
+def detect_page_systems_by_batch(image_fns:list[Path], yolo:YOLO, batch_size:int=64, device:str='cpu', images:list[np.ndarray]=None, prefetch:int=2, stats:dict=None):
   """
   :param image_fns: list of image file paths
   :param yolo: instance of YOLO model
   :param batch_size: batch size for YOLO inference, default is 64
+  :param images: optional decoded page images of image_fns, the files are then not read
+  :param prefetch: number of batches decoded ahead of inference, default is 2
+  :param stats: optional dict that receives the batch counts, see inference_by_batch
+  :return: [(page image path, system bboxs), ...] of the pages with detected systems
   """
   
   outputs = inference_by_batch(
     image_fns, 
     yolo=yolo, 
     batch_size=batch_size,
-    device=device
+    device=device,
+    images=images,
+    prefetch=prefetch,
+    stats=stats
   )
 
-  # move model back to cpu
-  if device != 'cpu':
+  # move model back to cpu, exported backends are not torch modules
+  if device != 'cpu' and getattr(yolo, 'backend', 'pytorch') == 'pytorch':
     yolo.to('cpu')
   
-  yolo_bbox_paths = []
+  page_bboxs = []
   
-  for output in outputs:
-    yolo_bbox_path = process_yolo_system_output(output)
-    if yolo_bbox_path:
-      yolo_bbox_paths.append(yolo_bbox_path)
+  for image_fn, output in zip(image_fns, outputs):
+    bboxs = get_system_bboxs(output)
+    if bboxs:
+      page_bboxs.append( (image_fn, bboxs) )
   
 
+  return page_bboxs
+
+
+def detect_systems_by_batch(image_fns:list[Path], yolo:YOLO, batch_size:int=64, device:str='cpu'):
+  """
+  detect_page_systems_by_batch that writes the bboxs of every page to <page>_yolo_bboxs.txt
+
+  :return: paths of the text files of the pages with detected systems
+  """
+  yolo_bbox_paths = []
+
+  for image_fn, bboxs in detect_page_systems_by_batch(image_fns, yolo, batch_size=batch_size, device=device):
+    yolo_bbox_path = Path(image_fn).with_name( Path(image_fn).stem + '_yolo_bboxs.txt' )
+    save_bboxs(bboxs, yolo_bbox_path)
+    yolo_bbox_paths.append(yolo_bbox_path)
+
   return yolo_bbox_paths
 
 
-def crop_systems(yolo_bbox_path:Path, ignore_existing:bool=False, conf_threshold:float=0.4):
+def get_page_image_path(yolo_bbox_path:Path) -> Path:
+  page_image_path = yolo_bbox_path.name.replace('_yolo_bboxs.txt', '.png')
+  return yolo_bbox_path.with_name(page_image_path)
+
+
+def crop_system_images(
+  image_path:Path, 
+  bboxs:list, 
+  image:np.ndarray=None, 
+  ignore_existing:bool=False, 
+  conf_threshold:float=0.4, 
+  save_crops:bool=True,
+  codec:str=None
+):
   """
-  :param yolo_bbox_path: path to the YOLO bbox annotation file
+  :param image_path: path to the page image
+  :param bboxs: system bboxs of the page, [ (lx, ly, rx, ry, conf), ... ]
+  :param image: optional decoded page image, read from disk if None
   :param ignore_existing: if True, skip cropping if cropped image already exists
   :param conf_threshold: confidence threshold for bbox selection
+  :param save_crops: if False, the cropped images are not written
+  :param codec: codec of the cropped images, see image_io.ImageCodec, default is png
+  :return: (crop_image_paths, crop_images, system_bboxs), crop images are views of the page image,
+    system_bboxs are the bboxs of the crops
   """
-  bboxs = load_bboxs(yolo_bbox_path) # [ (lx, ly, rx, ry, conf), ... ]
+  if image is None:
+    image = imread(image_path)
 
-  image_path = yolo_bbox_path.name.replace('_yolo_bboxs.txt', '.png')
-  image_path = yolo_bbox_path.with_name(image_path)
-  image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+  codec = ImageCodec(codec)
 
   crop_image_dir = image_path.parent.parent / 'cropped'
   crop_image_dir.mkdir(exist_ok=True, parents=False)
 
   crop_image_paths = []
+  crop_images = []
   system_bboxs = []
 
   bboxs = [ b for b in bboxs if b[-1] >= conf_threshold ]
 
   for i, (lx, ly, rx, ry, conf) in enumerate(bboxs):
     # save cropped iamge
-    crop_image_path = crop_image_dir / f'{image_path.stem}:{str(i).zfill(4)}.png'
-    if ignore_existing and crop_image_path.exists():
-      crop_image = cv2.imread(crop_image_path, cv2.IMREAD_UNCHANGED)
-    
-    else:
-      crop_image = image[ly:ry, lx:rx]
-      cv2.imwrite(crop_image_path, crop_image)
+    crop_image_path = crop_image_dir / f'{image_path.stem}:{str(i).zfill(4)}{codec.suffix}'
+    crop_image = image[ly:ry, lx:rx]
+
+    if save_crops and not (ignore_existing and crop_image_path.exists()):
+      codec.write(crop_image_path, crop_image)
     
     crop_image_paths.append(crop_image_path)
+    crop_images.append(crop_image)
     system_bboxs.append( (lx, ly, rx, ry, conf) )
   
+  return crop_image_paths, crop_images, system_bboxs
+
+
+def crop_systems(yolo_bbox_path:Path, ignore_existing:bool=False, conf_threshold:float=0.4):
+  """
+  :param yolo_bbox_path: path to a YOLO bbox text file, see ytsv.detections.export_text_sidecars
+  :param ignore_existing: if True, skip cropping if cropped image already exists
+  :param conf_threshold: confidence threshold for bbox selection
+  """
+  crop_image_paths, _, system_bboxs = crop_system_images(
+    get_page_image_path(yolo_bbox_path), 
+    load_bboxs(yolo_bbox_path), 
+    ignore_existing=ignore_existing, 
+    conf_threshold=conf_threshold
+  )
+
   system_bboxs_path = yolo_bbox_path.name.replace('_yolo_bboxs.txt', '_system_bboxs.txt')
   system_bboxs_path = yolo_bbox_path.with_name(system_bboxs_path)
   save_bboxs(system_bboxs, system_bboxs_path)
@@ -152,76 +295,208 @@ def crop_systems(yolo_bbox_path:Path, ignore_existing:bool=False, conf_threshold
   return crop_image_paths
 
 
-def process_yolo_staff_height_output(output):
+def get_staff_bboxs(output):
+  """
+  :return: (average staff height, staff bboxs), (False, []) if no staff was detected
+  """
   bboxs = output.boxes.xyxy
 
   # skip if no bbox
   if len(bboxs) < 1:
-    return False
+    return False, []
 
   bboxs = zip_bboxs_confs(output)
 
+  return get_average_staff_height(bboxs), bboxs
+
+
+def process_yolo_staff_height_output(output):
+  """
+  Write the staff bboxs of a crop to <crop>_staff_heights.txt, see ytsv.detections for the store used by the pipeline
+
+  :return: average staff height, False if no staff was detected
+  """
+  average_staff_height, bboxs = get_staff_bboxs(output)
+  if not bboxs:
+    return False
+
   image_path = Path(output.path)
   staff_height_path = image_path.with_name( image_path.stem + '_staff_heights.txt' )
 
   save_bboxs(bboxs, staff_height_path)
 
-  average_staff_height = sum([ y2 - y1 for (_, y1, _, y2, _) in bboxs ])
-  average_staff_height /= len(bboxs)
-
   return average_staff_height
 
 
-def detect_staff_heights_by_batch(crop_image_fns:list[Path], yolo:YOLO, batch_size:int=64, device:str='cpu'):
+def crop_left_half(image):
+  """
+  :param image: image file path or decoded image
+  """
+  img = image if isinstance(image, np.ndarray) else imread(image)
+  return img[:, :img.shape[1]//2]  # left half
+
+
+def detect_crop_staffs_by_batch(crop_image_fns:list[Path], yolo:YOLO, batch_size:int=64, device:str='cpu', crop_images:list[np.ndarray]=None, prefetch:int=2, stats:dict=None):
   """
   :param crop_image_fns: list of cropped image file paths
   :param yolo: instance of YOLO model
   :param batch_size: batch size for YOLO inference, default is 64
+  :param crop_images: optional decoded cropped images of crop_image_fns, the files are then not read
+  :param prefetch: number of batches decoded ahead of inference, default is 2
+  :param stats: optional dict that receives the batch counts, see inference_by_batch
+  :return: (average staff heights, staff bboxs) of every crop, False and [] for crops without staffs
   """
-  def crop_left_half(image_fn:Path):
-    img = cv2.imread(image_fn, cv2.IMREAD_UNCHANGED)
-    return img[:, :img.shape[1]//2]  # left half
-
   outputs = inference_by_batch(
     crop_image_fns, 
     yolo=yolo, 
     batch_size=batch_size, 
     custom_process=crop_left_half,
-    device=device
+    device=device,
+    images=crop_images,
+    prefetch=prefetch,
+    stats=stats
   )
   
   staff_heights = []
+  staff_bboxs = []
   
   for output in outputs:
-    average_staff_height = process_yolo_staff_height_output(output)
+    average_staff_height, bboxs = get_staff_bboxs(output)
     staff_heights.append(average_staff_height)
+    staff_bboxs.append(bboxs)
   
+  return staff_heights, staff_bboxs
+
+
+def detect_staff_heights_by_batch(crop_image_fns:list[Path], yolo:YOLO, batch_size:int=64, device:str='cpu'):
+  """
+  detect_crop_staffs_by_batch that writes the bboxs of every crop to <crop>_staff_heights.txt
+
+  :return: average staff heights of every crop, False for crops without staffs
+  """
+  staff_heights, staff_bboxs = detect_crop_staffs_by_batch(crop_image_fns, yolo, batch_size=batch_size, device=device)
+
+  for crop_image_fn, bboxs in zip(crop_image_fns, staff_bboxs):
+    if bboxs:
+      save_bboxs(bboxs, Path(crop_image_fn).with_name( Path(crop_image_fn).stem + '_staff_heights.txt' ))
+
   return staff_heights
 
 
-def resize_systems(crop_image_fns:list[Path], staff_heights:list[float], target_height:int=18):
+# a level of the resize pyramid is built from a larger level instead of the
+# crop if that level is at least this many times its size
+PYRAMID_MIN_SCALE = 2
+
+
+def get_target_heights(target_height) -> list[int]:
+  """
+  :param target_height: one target staff height or a list of them
+  """
+  return [target_height] if isinstance(target_height, int) else list(target_height)
+
+
+def get_resize_inputs(target_height, codec:str=None) -> dict:
+  """
+  Inputs of the resize stage as recorded in the manifest, a single height as a
+  number, the codec only if one was given
+  """
+  target_heights = get_target_heights(target_height)
+  inputs = {'target_height': target_heights[0] if len(target_heights) == 1 else target_heights}
+
+  if codec:
+    inputs['codec'] = codec
+
+  return inputs
+
+
+def get_resized_dir_names(target_heights:list[int]) -> list[str]:
+  """
+  Directories of the resized crops next to 'cropped', the first target height
+  is written to crop_resized, the others to crop_resized_<height>
+  """
+  return ['crop_resized'] + [ f'crop_resized_{h}' for h in target_heights[1:] ]
+
+
+def get_average_staff_height(bboxs:list) -> float:
+  """
+  Average staff height of a crop from its staff bboxs
+  """
+  return sum([ y2 - y1 for (_, y1, _, y2, _) in bboxs ]) / len(bboxs)
+
+
+def resize_systems(
+  crop_image_fns:list[Path], 
+  staff_heights:list[float], 
+  target_height:int|list[int]=18, 
+  crop_images:list[np.ndarray]=None, 
+  logger=None, 
+  out_dir_names:list[str]=None,
+  codec:str=None
+):
   """
+  Resize every crop for one or more target staff heights. The levels of a
+  crop are built from the largest to the smallest height, a level is
+  downscaled from the smallest larger level that is at least
+  PYRAMID_MIN_SCALE times its size, else from the crop itself.
+
   :param crop_image_fns: list of cropped image file paths
   :param staff_heights: list of average staff heights corresponding to the cropped images
-  :param target_height: target height for resizing, default is 18
+  :param target_height: target height or list of target heights for resizing, default is 18
+  :param crop_images: optional decoded cropped images of crop_image_fns, the files are then not read
+  :param logger: optional logger for skipped crops and failed writes
+  :param out_dir_names: directories next to 'cropped' the levels are written to, default is get_resized_dir_names
+  :param codec: codec of the resized images, see image_io.ImageCodec, default is png,
+    'none' resizes and writes nothing
+  :return: list of resized image file paths
   """
-  for crop_image_fn, staff_height in zip(crop_image_fns, staff_heights):
+  target_heights = get_target_heights(target_height)
+  out_dir_names = out_dir_names or get_resized_dir_names(target_heights)
+  codec = ImageCodec(codec, allow_none=True)
+
+  if codec.name == NO_WRITE_CODEC:
+    return []
+
+  # largest level first
+  levels = sorted( zip(target_heights, out_dir_names), key=lambda level: -level[0] )
+
+  resized_image_paths = []
+
+  if crop_images is None:
+    crop_images = [None] * len(crop_image_fns)
+
+  for crop_image_fn, staff_height, img in zip(crop_image_fns, staff_heights, crop_images):
     if not staff_height:
-      # need logging
+      if logger:
+        logger.warning(format_logger_msg('resize_systems', {'path': str(crop_image_fn), 'error': 'no staff detected, skipped'}))
       continue
 
-    img = cv2.imread(crop_image_fn, cv2.IMREAD_UNCHANGED)
-    ratio = target_height / staff_height
-    r_w = int(img.shape[1] * ratio)
-    r_h = int(img.shape[0] * ratio)
+    if img is None:
+      img = imread(crop_image_fn)
+
+    resized_levels = []
+
+    for level_height, out_dir_name in levels:
+      ratio = level_height / staff_height
+      r_w = int(img.shape[1] * ratio)
+      r_h = int(img.shape[0] * ratio)
+
+      source = img
+      for resized in resized_levels:
+        if resized.shape[0] >= PYRAMID_MIN_SCALE * r_h and resized.shape[1] >= PYRAMID_MIN_SCALE * r_w:
+          source = resized
+
+      i_r = cv2.resize(source, (r_w, r_h), interpolation=cv2.INTER_AREA)
+      resized_levels.append(i_r)
 
-    i_r = cv2.resize(img, (r_w, r_h), interpolation=cv2.INTER_AREA)
+      i_r_p = crop_image_fn.parent.parent / out_dir_name
+      i_r_p.mkdir(exist_ok=True, parents=False)
 
-    i_r_p = crop_image_fn.parent.parent / 'crop_resized'
-    i_r_p.mkdir(exist_ok=True, parents=False)
+      i_r_p = i_r_p / f'{Path(crop_image_fn).stem}{codec.suffix}'
 
-    i_r_p = i_r_p / crop_image_fn.name
+      if codec.write(i_r_p, i_r) is False:
+        if logger:
+          logger.error(format_logger_msg('resize_systems', {'path': str(i_r_p), 'error': 'failed to write resized image'}))
+      else:
+        resized_image_paths.append(i_r_p)
 
-    if cv2.imwrite(i_r_p, i_r) is False:
-      pass
-      # need logging
\ No newline at end of file
+  return resized_image_paths
\ No newline at end of file
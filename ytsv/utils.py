@@ -1,5 +1,6 @@
 import os
 import sys
+import shutil
 from io import StringIO
 import contextlib
 import logging
@@ -8,7 +9,6 @@ from datetime import datetime
 from pathlib import Path
 
 import json
-import requests
 
 from ultralytics import YOLO
 
@@ -51,29 +51,139 @@ YOLO_MODELS_URLS = {
 
 
 def download_yolo_model_checkpoint(model_name:str, checkpoint_path:Path):
-  r = requests.get( YOLO_MODELS_URLS[model_name], allow_redirects=True )
+  """
+  Streamed, resumable and checksummed download, see model_store.ModelStore
+  """
+  from .model_store import ModelStore
+
+  ModelStore(checkpoint_path.parent).download(model_name, checkpoint_path)
 
-  if r.status_code != 200:
-    raise Exception(f'Failed to download YOLO model checkpoint: {model_name} from {YOLO_MODELS_URLS[model_name]}')
-  
-  checkpoint_path.parent.mkdir(exist_ok=True)
-  with open(checkpoint_path, 'wb') as f:
-    f.write(r.content)
 
+# exported CPU backends, cached next to the .pt checkpoint as
+# {backend: (export arguments, artifact name)}, dynamic shapes keep batched
+# and rectangular inputs the same as with the PyTorch model
+YOLO_BACKENDS = {
+  'onnx': ({'format': 'onnx', 'dynamic': True}, '{stem}.onnx'),
+  'openvino': ({'format': 'openvino', 'dynamic': True}, '{stem}_openvino_model'),
+  'openvino-int8': ({'format': 'openvino', 'dynamic': True, 'int8': True}, '{stem}_int8_openvino_model'),
+}
 
-def load_yolo_model(checkpoint_name, checkpoint_dir:Path) -> YOLO:
+
+def replace_path(src:Path, dst:Path):
+  """
+  os.replace for files and directories, a directory cannot replace a non-empty one
+  """
+  if not (src.is_dir() and dst.exists()):
+    os.replace(src, dst)
+    return
+
+  old_path = dst.with_name(f'.{dst.name}.old')
+  shutil.rmtree(old_path, ignore_errors=True)
+  os.replace(dst, old_path)
+  os.replace(src, dst)
+  shutil.rmtree(old_path, ignore_errors=True)
+
+
+def export_yolo_model(checkpoint_path:Path, backend:str, calibration_data:str=None) -> Path:
+  """
+  Export a checkpoint to a backend once. The artifact is reused as long as
+  the sha256 of the checkpoint recorded next to it matches. Parallel workers
+  wait for a single export, which is written to a temporary directory and
+  renamed into place before its record.
+
+  :param checkpoint_path: path to the .pt checkpoint
+  :param backend: one of YOLO_BACKENDS
+  :param calibration_data: dataset yaml for INT8 calibration, if None ultralytics uses its default
+  :return: path to the exported model file or directory
+  """
+  from .manifest import get_file_hash
+  from .model_store import file_lock
+
+  export_kwargs, artifact_name = YOLO_BACKENDS[backend]
+  artifact_path = checkpoint_path.with_name( artifact_name.format(stem=checkpoint_path.stem) )
+  info_path = artifact_path.with_name( artifact_path.name + '.json' )
+
+  checkpoint_hash = get_file_hash(checkpoint_path)
+
+  def is_exported():
+    if not (artifact_path.exists() and info_path.exists()):
+      return False
+    with open(info_path, 'r') as f:
+      return json.load(f).get('checkpoint') == checkpoint_hash
+
+  if is_exported():
+    return artifact_path
+
+  with file_lock(artifact_path.with_name(f'.{artifact_path.name}.lock')):
+    # another process may have finished the export while we waited
+    if is_exported():
+      return artifact_path
+
+    if export_kwargs.get('int8') and calibration_data:
+      export_kwargs = {**export_kwargs, 'data': calibration_data}
+
+    # ultralytics writes next to the checkpoint, so it is exported from a copy in a temporary directory
+    tmp_dir = artifact_path.with_name(f'.{artifact_path.name}.{os.getpid()}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+
+    try:
+      tmp_checkpoint_path = tmp_dir / checkpoint_path.name
+      shutil.copyfile(checkpoint_path, tmp_checkpoint_path)
+
+      exported_path = Path( YOLO(tmp_checkpoint_path).export(**export_kwargs) )
+
+      # the old artifact is no longer trusted while it is replaced
+      info_path.unlink(missing_ok=True)
+      replace_path(exported_path, artifact_path)
+    finally:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    tmp_path = info_path.with_name(f'.{info_path.name}.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump({'checkpoint': checkpoint_hash, 'backend': backend, 'created_at': get_ts()}, f)
+    os.replace(tmp_path, info_path)
+
+  return artifact_path
+
+
+def load_yolo_model(checkpoint_name, checkpoint_dir:Path, backend:str='pytorch', calibration_data:str=None, store=None) -> YOLO:
+  """
+  :param backend: 'pytorch' or one of YOLO_BACKENDS, exported on first use
+  :param calibration_data: dataset yaml for INT8 calibration
+  :param store: model_store.ModelStore the checkpoint is fetched from, default is a store in checkpoint_dir
+  """
+  from .model_store import ModelStore
+
+  store = store or ModelStore(checkpoint_dir)
   checkpoint_path = checkpoint_dir / checkpoint_name
 
-  if not checkpoint_path.exists():
-    download_yolo_model_checkpoint(checkpoint_name, checkpoint_path)
-  
-  yolo_model = YOLO( checkpoint_path )
+  # checkpoints put into checkpoint_dir by hand take precedence over a shared store
+  if store.cache_dir.resolve() == checkpoint_dir.resolve() or not checkpoint_path.exists():
+    checkpoint_path = store.fetch(checkpoint_name)
+
+  if backend == 'pytorch':
+    return YOLO( checkpoint_path )
+
+  yolo_model = YOLO( export_yolo_model(checkpoint_path, backend, calibration_data=calibration_data), task='detect' )
+
+  # the manifest identifies exported models by their source checkpoint
+  yolo_model.source_checkpoint_path = checkpoint_path
+  yolo_model.backend = backend
 
   return yolo_model
 
 
-def load_yolo_models(checkpoint_dir:Path) -> list:
-  yolo_system = load_yolo_model('ls-yolo-system-v2.0.0.pt', checkpoint_dir)
-  yolo_staff_height = load_yolo_model('ls-yolo-staff-height-v2.0.0.pt', checkpoint_dir)
+def load_yolo_models(checkpoint_dir:Path, backend:str='pytorch', calibration_data:str=None, cache_dir:Path=None, offline:bool=False) -> list:
+  """
+  :param cache_dir: shared model store directory, default is YTSV_MODEL_CACHE or checkpoint_dir
+  :param offline: if True (or YTSV_OFFLINE=1), never download, the checkpoints must be in the store
+  """
+  from .model_store import ModelStore, get_default_cache_dir, is_offline
+
+  store = ModelStore(cache_dir or get_default_cache_dir(checkpoint_dir), offline=offline or is_offline())
+
+  yolo_system = load_yolo_model('ls-yolo-system-v2.0.0.pt', checkpoint_dir, backend=backend, calibration_data=calibration_data, store=store)
+  yolo_staff_height = load_yolo_model('ls-yolo-staff-height-v2.0.0.pt', checkpoint_dir, backend=backend, calibration_data=calibration_data, store=store)
 
-  return [ yolo_system, yolo_staff_height ]
\ No newline at end of file
+  return [ yolo_system, yolo_staff_height ]
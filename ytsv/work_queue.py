@@ -0,0 +1,393 @@
+"""
+Splitting the metadata list over several nodes.
+
+Static: --shard i/N keeps the rows whose yt_id hashes to shard i of N. The
+hash is stable, so every node computes the same partition without talking
+to the others.
+
+Dynamic: nodes sharing a filesystem pull videos from a WorkQueue directory
+
+  leases/<yt_id>.lease   claimed by a node, created with O_EXCL
+  done/<yt_id>.json      finished (or failed) video with its node and error
+
+A node keeps the mtime of its leases fresh from a heartbeat thread. A lease
+whose mtime is older than lease_seconds belongs to a dead node and is
+reclaimed by the next node that reaches it. Every lease holds the node and a
+token of its claim, so a node that was only slow never renews or removes a
+lease that another node claimed after reclaiming its own. Nodes keep polling
+until every video is done, so the work of a node that dies late is picked up
+as well.
+
+Every node writes a summary of its videos, merge_summaries combines them:
+
+  python -m ytsv.work_queue <summary dir> [-o merged.json]
+"""
+
+from pathlib import Path
+import os
+import json
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import uuid
+
+from .utils import get_ts
+
+
+def parse_shard(shard:str) -> tuple[int, int]:
+  """
+  :param shard: 'i/N' with 0 <= i < N
+  :return: (i, N)
+  """
+  index, count = ( int(x) for x in shard.split('/') )
+  if not 0 <= index < count:
+    raise ValueError(f'Invalid shard {shard}, expected i/N with 0 <= i < N')
+
+  return index, count
+
+
+def get_shard_index(yt_id:str, num_shards:int) -> int:
+  # not hash(), which is salted per process
+  return int(hashlib.sha1(yt_id.encode()).hexdigest(), 16) % num_shards
+
+
+def select_shard(metadata:list[list[str]], shard_index:int, num_shards:int) -> list[list[str]]:
+  """
+  Rows of the metadata file in one shard of num_shards
+  """
+  return [ row for row in metadata if get_shard_index(row[0], num_shards) == shard_index ]
+
+
+def get_default_node_id() -> str:
+  return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def write_json(path:Path, data:dict):
+  # several nodes may write the same file, e.g. the result of a reclaimed video
+  tmp_path = path.with_name(f'.{path.name}.{get_default_node_id()}-{threading.get_ident()}.tmp')
+  with open(tmp_path, 'w') as f:
+    json.dump(data, f, indent=2)
+  os.replace(tmp_path, path)
+
+
+class WorkQueue:
+  def __init__(
+    self,
+    queue_dir:Path,
+    node_id:str=None,
+    lease_seconds:float=1800,
+    heartbeat_seconds:float=None,
+    poll_seconds:float=None,
+    retry_failed:bool=False,
+    logger=None
+  ):
+    """
+    :param queue_dir: directory on the shared filesystem
+    :param node_id: name of this node in leases and results, default is <hostname>-<pid>
+    :param lease_seconds: age of the last heartbeat after which a lease is reclaimed
+    :param heartbeat_seconds: interval of the heartbeats, default is lease_seconds / 4
+    :param poll_seconds: interval at which an idle node checks the videos leased by other nodes,
+      default is 10 or heartbeat_seconds if that is shorter
+    :param retry_failed: if True, videos that failed on any node are processed again
+    :param logger: optional logger for reclaimed and lost leases
+    """
+    self.queue_dir = Path(queue_dir)
+    self.lease_dir = self.queue_dir / 'leases'
+    self.done_dir = self.queue_dir / 'done'
+    self.lease_dir.mkdir(parents=True, exist_ok=True)
+    self.done_dir.mkdir(parents=True, exist_ok=True)
+
+    self.node_id = node_id or get_default_node_id()
+    self.lease_seconds = lease_seconds
+    self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 4
+    self.poll_seconds = poll_seconds or min(10, self.heartbeat_seconds)
+    self.retry_failed = retry_failed
+    self.logger = logger
+
+    self.held = {} # {yt_id: token of the claim}
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.heartbeat_thread = None
+
+  def get_lease_path(self, yt_id:str) -> Path:
+    return self.lease_dir / f'{yt_id}.lease'
+
+  def get_done_path(self, yt_id:str) -> Path:
+    return self.done_dir / f'{yt_id}.json'
+
+  def is_done(self, yt_id:str) -> bool:
+    done_path = self.get_done_path(yt_id)
+    if not done_path.exists():
+      return False
+    if not self.retry_failed:
+      return True
+
+    with open(done_path, 'r') as f:
+      return json.load(f)['error'] is None
+
+  def is_expired(self, lease_path:Path) -> bool:
+    try:
+      return time.time() - lease_path.stat().st_mtime > self.lease_seconds
+    except FileNotFoundError:
+      return False
+
+  def reclaim(self, lease_path:Path) -> bool:
+    """
+    Remove an expired lease, only one of the nodes racing for it succeeds
+    """
+    stale_path = lease_path.with_name(f'{lease_path.name}.{self.node_id}.stale')
+    try:
+      os.rename(lease_path, stale_path)
+    except FileNotFoundError:
+      return False
+
+    # the owner renewed it just before the rename, put it back
+    if not self.is_expired(stale_path):
+      try:
+        os.link(stale_path, lease_path)
+      except FileExistsError:
+        pass
+      stale_path.unlink()
+      return False
+
+    with open(stale_path, 'r') as f:
+      owner = f.read()
+    stale_path.unlink()
+
+    if self.logger:
+      self.logger.warning(f'[work_queue]: reclaimed expired lease {lease_path.name}: {owner}')
+
+    return True
+
+  def try_claim(self, yt_id:str) -> bool:
+    if self.is_done(yt_id):
+      return False
+
+    lease_path = self.get_lease_path(yt_id)
+    try:
+      fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      if self.is_expired(lease_path) and self.reclaim(lease_path):
+        return self.try_claim(yt_id)
+      return False
+
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, 'w') as f:
+      json.dump({'node': self.node_id, 'token': token, 'claimed_at': get_ts()}, f)
+
+    with self.lock:
+      self.held[yt_id] = token
+
+    # another node may have finished it between the check and the claim
+    if self.is_done(yt_id):
+      self.release(yt_id)
+      return False
+
+    return True
+
+  def is_owner(self, lease_path:Path, token:str) -> bool:
+    """
+    True if the lease is the one of our claim with token, not the lease of a
+    node that reclaimed it after our heartbeat stopped
+    """
+    try:
+      with open(lease_path, 'r') as f:
+        lease = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return False
+
+    return lease.get('node') == self.node_id and lease.get('token') == token
+
+  def release(self, yt_id:str):
+    with self.lock:
+      token = self.held.pop(yt_id, None)
+
+    lease_path = self.get_lease_path(yt_id)
+    if token is None or not self.is_owner(lease_path, token):
+      return
+
+    # move the lease aside before removing it, a lease that another node claimed meanwhile is put back
+    released_path = lease_path.with_name(f'{lease_path.name}.{self.node_id}.released')
+    try:
+      os.rename(lease_path, released_path)
+    except FileNotFoundError:
+      return
+
+    if not self.is_owner(released_path, token):
+      try:
+        os.link(released_path, lease_path)
+      except FileExistsError:
+        pass
+
+    released_path.unlink()
+
+  def complete(self, yt_id:str, error:str=None):
+    """
+    Record a video as done, or failed with its error, and release its lease.
+    A failure does not replace the success of a node that reclaimed the lease.
+    """
+    done_path = self.get_done_path(yt_id)
+    if error is None or not done_path.exists() or json.loads(done_path.read_text())['error'] is not None:
+      write_json(done_path, {'yt_id': yt_id, 'node': self.node_id, 'finished_at': get_ts(), 'error': error})
+    self.release(yt_id)
+
+  def renew(self):
+    """
+    Refresh the mtime of the leases of this node. A lease that was reclaimed
+    by another node is dropped and left alone.
+    """
+    with self.lock:
+      held = list(self.held.items())
+
+    for yt_id, token in held:
+      lease_path = self.get_lease_path(yt_id)
+
+      if not self.is_owner(lease_path, token):
+        with self.lock:
+          if self.held.get(yt_id) == token:
+            del self.held[yt_id]
+        if self.logger:
+          self.logger.warning(f'[work_queue]: lost lease {lease_path.name} to another node')
+        continue
+
+      try:
+        os.utime(lease_path)
+      except FileNotFoundError:
+        pass
+
+  def heartbeat(self):
+    while not self.stopped.wait(self.heartbeat_seconds):
+      self.renew()
+
+  def iter_batches(self, metadata:list[list[str]], batch_size:int=1):
+    """
+    Claim rows of the metadata file and yield them in batches. Rows leased by
+    other nodes are polled until they are done or their lease expires.
+
+    :param metadata: rows of the metadata file
+    :param batch_size: rows claimed at once
+    :return: generator of lists of claimed rows, complete() them before the next one is claimed
+    """
+    while True:
+      pending = [ row for row in metadata if not self.is_done(row[0]) ]
+      if not pending:
+        return
+
+      claimed = False
+      batch = []
+      for row in pending:
+        if not self.try_claim(row[0]):
+          continue
+
+        claimed = True
+        batch.append(row)
+        if len(batch) >= batch_size:
+          yield batch
+          batch = []
+
+      if batch:
+        yield batch
+
+      # everything left is leased by other nodes
+      if not claimed:
+        time.sleep(self.poll_seconds)
+
+  def __enter__(self):
+    self.stopped.clear()
+    self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+    self.heartbeat_thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stopped.set()
+    self.heartbeat_thread.join()
+
+    # unfinished videos are released for other nodes right away
+    for yt_id in list(self.held):
+      self.release(yt_id)
+
+
+class NodeSummary:
+  def __init__(self, summary_path:Path, node_id:str, shard:tuple[int, int]=None):
+    """
+    :param summary_path: JSON file of this node, rewritten after every update
+    :param node_id: name of this node
+    :param shard: (i, N) if the node processes a static shard
+    """
+    self.summary_path = summary_path
+    self.summary_path.parent.mkdir(parents=True, exist_ok=True)
+    self.node_id = node_id
+    self.shard = shard
+    self.started_at = get_ts()
+    self.start_time = time.monotonic()
+    self.videos = []
+
+  def add(self, results:dict):
+    """
+    :param results: {yt_id: error or None}
+    """
+    self.videos += [ {'yt_id': yt_id, 'error': error} for yt_id, error in results.items() ]
+    self.write()
+
+  def write(self):
+    write_json(self.summary_path, {
+      'node': self.node_id,
+      'shard': f'{self.shard[0]}/{self.shard[1]}' if self.shard else None,
+      'started_at': self.started_at,
+      'updated_at': get_ts(),
+      'wall_time': time.monotonic() - self.start_time,
+      'num_videos': len(self.videos),
+      'num_failed': sum( 1 for video in self.videos if video['error'] is not None ),
+      'videos': self.videos,
+    })
+
+
+def merge_summaries(summary_paths:list[Path]) -> dict:
+  """
+  Combine node summaries. A video processed by several nodes (e.g. after a
+  reclaimed lease) counts once, as failed only if it failed on every node.
+  """
+  nodes = []
+  videos = {}
+  processed_by = {}
+
+  for summary_path in sorted(summary_paths):
+    with open(summary_path, 'r') as f:
+      summary = json.load(f)
+
+    nodes.append({ k: v for k, v in summary.items() if k != 'videos' })
+    for video in summary['videos']:
+      # the late result of a node that lost the lease does not hide a success
+      if videos.get(video['yt_id'], {'error': 'unknown'})['error'] is not None:
+        videos[video['yt_id']] = video
+      processed_by.setdefault(video['yt_id'], []).append(summary['node'])
+
+  failed = sorted( yt_id for yt_id, video in videos.items() if video['error'] is not None )
+
+  return {
+    'merged_at': get_ts(),
+    'num_nodes': len(nodes),
+    'num_videos': len(videos),
+    'num_failed': len(failed),
+    'node_wall_time': sum( node['wall_time'] for node in nodes ),
+    'failed': failed,
+    'processed_more_than_once': { yt_id: node_ids for yt_id, node_ids in processed_by.items() if len(node_ids) > 1 },
+    'nodes': nodes,
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='python -m ytsv.work_queue', description='Merge the summaries of several nodes')
+  parser.add_argument('summary_dir', type=str, help='Directory of the node summaries (*.json)')
+  parser.add_argument('-o', '--out-path', type=str, default=None, help='If given, write the merged summary to this file')
+
+  args = parser.parse_args()
+
+  merged = merge_summaries( list(Path(args.summary_dir).glob('*.json')) )
+
+  if args.out_path:
+    write_json(Path(args.out_path), merged)
+
+  print(json.dumps({ k: v for k, v in merged.items() if k != 'nodes' }, indent=2))